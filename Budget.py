@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Polling-rate planner for the UART budget of a port
+
+Every register read is one Getter exchange: 6 bytes out, 11 back, 1.5 ms
+on the wire at 115200 baud, plus the board's turnaround. The port is
+shared by the periodic consumers (watchdog: the safety rule engine and
+everything fed from its polls, telemetry: the status file) and interactive
+use (operator, emergency).
+
+transaction_time: port time per exchange, as measured by SF8xxx.Link
+max_rate: fastest sustainable poll of a register set within the budget
+plan: rates for the periodic consumers, all scaled back by one factor when
+together they would exceed the budget. Interactive use is never scaled;
+what it used over the link window comes off the budget first.
+
+Link summaries come from SF8xxx.link_stats().
+
+@author: drm1g20
+"""
+
+import SF8xxx as sf8
+
+BUDGET = 0.8            # share of the port the consumers may plan for
+TURNAROUND = 0.002      # s, assumed board turnaround until one is measured
+
+
+def transaction_time(link=None, consumer=sf8.WATCHDOG):
+    """
+    s of port time per Getter exchange: what consumer measured, else the
+    wire time plus the measured (or assumed) turnaround. Never less than the
+    wire time, which a pty or a USB adapter's buffering can hide.
+    """
+    wire = (sf8.GET_FRAME + sf8.REPLY_FRAME) * sf8.BYTE_TIME
+    if link is not None:
+        measured = link['consumers'][sf8.priority_names[consumer]]
+        if measured['per_transaction'] is not None:
+            return max(measured['per_transaction'], wire)
+
+    turnaround = TURNAROUND
+    if link is not None and link['turnaround'] is not None:
+        turnaround = link['turnaround']
+    return wire + turnaround
+
+
+def cost(registers, link=None, consumer=sf8.WATCHDOG):
+    """
+    s of port time for one poll of registers
+    """
+    return len(registers) * transaction_time(link, consumer)
+
+
+def interactive(link):
+    """
+    Share of the port used by operator and emergency commands lately
+    """
+    if link is None:
+        return 0.0
+    return sum(link['consumers'][sf8.priority_names[consumer]]['busy']
+               for consumer in (sf8.EMERGENCY, sf8.OPERATOR))
+
+
+def max_rate(registers, link=None, consumer=sf8.WATCHDOG, budget=BUDGET):
+    """
+    Polls per second of registers the port can sustain, Hz
+    """
+    available = max(0.0, budget - interactive(link))
+    return available / cost(registers, link, consumer)
+
+
+def plan(demands, link=None, budget=BUDGET):
+    """
+    demands: {consumer: (registers, rate Hz)}
+    Returns ({consumer: rate Hz}, load) where load is the share of the port
+    the demands would use; if that exceeds what is left of the budget
+    every rate is scaled by the same factor
+    """
+    load = sum(rate * cost(registers, link, consumer)
+               for consumer, (registers, rate) in demands.items())
+    available = max(0.0, budget - interactive(link))
+
+    factor = 1.0 if load <= available else available / load
+    return ({consumer: rate * factor
+             for consumer, (registers, rate) in demands.items()}, load)
@@ -7,28 +7,247 @@ Created on Sun May 19 11:59:47 2024
 @author: drm1g20
 """
 
-import json
-import SF8xxx as sf8
+import os
+import signal
+import sys
+import threading
 import time
-import Status
+import Jobs
+import Startup
+
+# imported on first use, so the prompt comes up at once
+json = Startup.Lazy('json')
+sf8 = Startup.Lazy('SF8xxx')
+Budget = Startup.Lazy('Budget')
+Dashboard = Startup.Lazy('Dashboard')
+Log = Startup.Lazy('Log')
+Planner = Startup.Lazy('Planner')
+Profiling = Startup.Lazy('Profiling')
+Status = Startup.Lazy('Status')
+Safety = Startup.Lazy('Safety')
+Sequencer = Startup.Lazy('Sequencer')
+Snapshot = Startup.Lazy('Snapshot')
+Stats = Startup.Lazy('Stats')
+Telemetry = Startup.Lazy('Telemetry')
+Worker = Startup.Lazy('Worker')
 
 VERSION = '1.3'
 
+RULES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     'default_rules.json')
+
+# always run as background jobs
+BACKGROUND = ('load', 'reload', 'pump', 'settle', 'batch')
+# run as background jobs when the device is "all"
+SWEEPS = ('qrd', 'qrrd', 'configure', 'int', 'tec', 'dri', 'lock', 'max',
+          'pid', 'snapshot', 'restore')
+
+# config keys written to the device by load/reload -> (SF8xxx setter,
+# register, raw units per config unit)
+SETTINGS = {'driver_current_max': ('set_driver_current_max',
+                                   'DRIVER_CURRENT_MAXIMUM', 10),
+            'tec_temperature': ('set_tec_temperature',
+                                'TEC_TEMPERATURE_VALUE', 100)}
+
 class Console:
-    def __init__(self, logfile="/tmp/sf8_status"):
+    def __init__(self, logfile="/tmp/sf8_status", rules=RULES,
+                 isolate=False, serve=None, source=input):
         self.exit_status = False
         self.devices = {}
+        self.rules = rules
+
+        # all output goes through one ordered writer; commands may run as
+        # background jobs, so each thread keeps its own tokens
+        self.__local = threading.local()
+        self.jobs = {}
+        self.job_seq = 0
+        self.stdout = sys.stdout
+        self.writer = Jobs.Writer(self.stdout)
+        sys.stdout = self.writer
+
+        # isolate: every port served by its own worker process
+        self.isolate = isolate
+        self.table = Worker.StateTable() if isolate else None
+
+        # status file, watchdog and statistics are built on first use and
+        # poll from the first dial, see the properties below
+        self.logfile = logfile
+        self.__status = None
+        self.__safety = None
+        self.__stats = None
+        self.polling = False
+
+        # polling rates asked for, Hz; `link apply` may scale them back
+        self.nominal = None
+
+        # telemetry log, see `record`
+        self.recording = None
+        self.recorder = None
+
+        # what load/reload last applied, see `reload`
+        self.config = None   # filename
+        self.loaded = {}     # alias -> config entry
+        self.applied = {}    # alias -> {'devpath': port}
+        self.watch_end = None
+
+        # HTTP status page, see `dashboard`
+        self.dashboard = None
 
-        self.status = Status(devices, fn=logfile)
-        
         self.__print_intro()
+
+        # serve: (host, port) to take remote commands from a gateway
+        if serve is not None:
+            self.__dashboard(serve[1], serve[0], commands=True)
         
         while not self.exit_status:
-            self.exit_status = self.__command(input("> "))
+            self.writer.prompt()
+            Startup.mark('prompt')
+            try:
+                # source: where command lines come from (Soak feeds it)
+                cmd = source()
+            except EOFError:
+                cmd = 'exit'
+                if self.dashboard is not None and \
+                        self.dashboard.command is not None:
+                    # no terminal: keep serving the gateway
+                    self.__serve_forever()
+            self.writer.typed()
+
+            try:
+                self.exit_status = self.__dispatch(cmd)
+            except Worker.PortTimeout as e:
+                print("[CONSOLE]: Device", e, "not responding. Try",
+                      "\"restart " + str(e) + "\".")
+
+        for job in list(self.jobs.values()):
+            job.cancel.set()
+        for job in list(self.jobs.values()):
+            job.done.wait(5)
+
+        if self.__status is not None:
+            self.__status.end_threads = True
+        if self.__safety is not None:
+            self.__safety.end_threads = True
+        self.__record_stop()
+        self.__watch_stop()
+        self.__dashboard_stop()
 
-        self.status.end_threads = True
+        if self.isolate:
+            for alias in list(self.devices.keys()):
+                self.__hang_up(alias)
+            self.__clean_devices()
+            self.table.unlink()
+
+        self.writer.close()
+        sys.stdout = self.stdout
             
             
+    @property
+    def status(self):
+        """
+        Status file writer
+        """
+        if self.__status is None:
+            self.__status = Status.Status(self.devices, fn=self.logfile)
+        return self.__status
+
+
+    @property
+    def safety(self):
+        """
+        One watchdog pass over every device instead of a thread per device
+        """
+        if self.__safety is None:
+            safety = Safety.RuleEngine(self.devices,
+                                       Safety.load_rules(self.rules))
+            safety.require(Stats.TRACKED)
+            self.__safety = safety
+        return self.__safety
+
+
+    @property
+    def stats(self):
+        """
+        Online statistics of every measurement read, see `stats`
+        """
+        if self.__stats is None:
+            stats = Stats.Stats()
+            stats.listeners.append(self.__drift_event)
+            self.__stats = stats
+        return self.__stats
+
+
+    def __start_polling(self):
+        """
+        Start the status file and watchdog threads, once there is a device
+        """
+        if self.polling:
+            return
+        self.polling = True
+        self.status.run()
+        self.safety.start()
+
+
+    @property
+    def tokens(self):
+        return self.__local.tokens
+
+
+    @tokens.setter
+    def tokens(self, tokens):
+        self.__local.tokens = tokens
+
+
+    def __dispatch(self, cmd: str):
+        """
+        Run a command in the foreground or as a background job
+        """
+        tokens = cmd.split()
+        if not tokens:
+            return
+
+        if tokens[0] == 'bg':
+            if len(tokens) > 1:
+                self.__start_job(' '.join(tokens[1:]))
+            return
+
+        if (tokens[0] in BACKGROUND and tokens[1:2] not in (['watch'],
+                                                            ['stop'])) or \
+                (tokens[0] in SWEEPS and 'all' in tokens[1:]):
+            self.__start_job(cmd)
+            return
+
+        return self.__command(cmd)
+
+
+    def __start_job(self, cmd):
+        if cmd.split()[0] in ('exit', 'bg', 'jobs', 'wait', 'cancel'):
+            print("[CONSOLE]: Cannot run", cmd.split()[0], "as a job.")
+            return
+
+        self.job_seq += 1
+        job = Jobs.Job(self.job_seq, cmd, self.__run_job)
+        self.jobs[job.id] = job
+        print('[' + str(job.id) + ']', cmd)
+        job.thread.start()
+
+
+    def __run_job(self, cmd):
+        self.__command(cmd)
+
+
+    def __each(self):
+        """
+        Snapshot of device aliases for an "all" sweep; stops early if the
+        job running the sweep is cancelled
+        """
+        cancel = Jobs.cancel_event()
+        for alias in list(self.devices.keys()):
+            if cancel is not None and cancel.is_set():
+                return
+            yield alias
+
+
     def __del__(self):
         for d in self.devices.values():
             if not d.connected:
@@ -37,8 +256,7 @@ class Console:
             print("[CONSOLE]: Disconnecting", d.serial_no, "from",
                   d.port)
             
-            d.dev.close()
-            d.__del__()
+            d.close()
             
     
     def __command(self, cmd: str):
@@ -80,9 +298,7 @@ class Console:
                 return
             
             if self.tokens[1] == 'all':
-                for alias, dev in self.devices.items():
-                    print(alias + ':')
-                    self.__qrd(alias)
+                self.__qrd_all()
                 return
             
             print(self.tokens[1] + ':')
@@ -96,7 +312,7 @@ class Console:
                 return
             
             if self.tokens[1] == 'all':
-                for alias, dev in self.devices.items():
+                for alias in self.__each():
                     print(alias + ':')
                     self.__qrrd(alias)
                 return
@@ -109,7 +325,7 @@ class Console:
                 return
             
             if self.tokens[1] == 'all':
-                for dev in self.devices.keys():
+                for dev in self.__each():
                     self.__configure(dev)
                 return
             
@@ -123,7 +339,7 @@ class Console:
                 return
 
             if self.tokens[1] == 'all':
-                for dev in self.devices.keys():
+                for dev in self.__each():
                     self.__interlock(dev, self.tokens[2])
                 return
 
@@ -141,7 +357,7 @@ class Console:
                 
                 if sel == 'stat':
                     if alias == 'all':
-                        for dev in self.devices.keys():
+                        for dev in self.__each():
                             self.__print_tec_state(dev)
                         return
                     
@@ -149,7 +365,7 @@ class Console:
                 
                 elif sel == 'on':
                     if alias == 'all':
-                        for dev in self.devices.keys():
+                        for dev in self.__each():
                             self.__is_tec_on(dev)
                         return
                     
@@ -173,7 +389,7 @@ class Console:
                     return
                 
                 if alias == 'all':
-                    for dev in self.devices.keys():
+                    for dev in self.__each():
                         self.__tec_set(dev, value)
                     return
                 
@@ -184,7 +400,7 @@ class Console:
                     return
                 
                 if alias == 'all':
-                    for dev in self.devices.keys():
+                    for dev in self.__each():
                         self.__tec_temp(dev, int(value))
                     return
                 
@@ -201,7 +417,7 @@ class Console:
                 
                 if sel == 'stat':
                     if alias == 'all':
-                        for dev in self.devices.keys():
+                        for dev in self.__each():
                             self.__print_driver_state(dev)
                         return
                     
@@ -209,7 +425,7 @@ class Console:
                 
                 elif sel == 'on':
                     if alias == 'all':
-                        for dev in self.devices.keys():
+                        for dev in self.__each():
                             self.__is_driver_on(dev)
                         return
                     
@@ -233,7 +449,7 @@ class Console:
                     return
                 
                 if alias == 'all':
-                    for dev in self.devices.keys():
+                    for dev in self.__each():
                         self.__driver_set(dev, value)
                     return    
                         
@@ -244,7 +460,7 @@ class Console:
                     return
                 
                 if alias == 'all':
-                  for dev in self.devices.keys():
+                  for dev in self.__each():
                       self.__driver_current(dev,int(value))
                   return
                 
@@ -264,7 +480,7 @@ class Console:
                 return
             
             if self.tokens[1] == 'all':
-                for dev in self.devices.keys():
+                for dev in self.__each():
                     self.__print_lock_state(dev)
                 return
             
@@ -275,7 +491,7 @@ class Console:
                 return
             
             if self.tokens[1] == 'all':
-                for dev in self.devices.keys():
+                for dev in self.__each():
                     self.__mxma(dev)
                 return
             
@@ -287,18 +503,228 @@ class Console:
 
             self.__load_from_config(self.tokens[1])
 
+        elif root == 'reload':
+            if len(self.tokens) == 1:
+                self.__reload()
+            elif self.tokens[1] == 'watch' and len(self.tokens) <= 3:
+                self.__watch(self.tokens[2] if len(self.tokens) == 3
+                             else self.config)
+            elif self.tokens[1] == 'stop' and len(self.tokens) == 2:
+                self.__watch_stop()
+            elif len(self.tokens) == 2:
+                self.__reload(self.tokens[1])
+            else:
+                print("[CONSOLE]: Want: reload [config], reload watch",
+                      "[config] or reload stop.")
+
+        elif root in ('snapshot', 'restore'):
+            if self.__token_len(3):
+                return
+
+            if not self.__check(self.tokens[1]):
+                return
+
+            if root == 'snapshot':
+                self.__snapshot(self.tokens[1], self.tokens[2])
+            else:
+                self.__restore(self.tokens[1], self.tokens[2])
+
         elif root == 'pid':
             if self.__token_len(3):
                 return
 
             if self.tokens[1] == 'get':
                 if self.tokens[2] == 'all':
-                    for dev in self.devices.keys():
+                    for dev in self.__each():
                         self.__print_pid(dev)
                     return
 
                 self.__print_pid(self.tokens[2])
             
+        elif root in ('plan', 'batch'):
+            if self.__token_len(2):
+                return
+
+            self.__batch(self.tokens[1], execute=(root == 'batch'))
+
+        elif root == 'jobs':
+            self.__list_jobs()
+
+        elif root == 'wait':
+            if len(self.tokens) == 1:
+                for job in list(self.jobs.values()):
+                    job.done.wait()
+                return
+
+            job = self.__job(self.tokens[1])
+            if job is not None:
+                job.done.wait()
+
+        elif root == 'cancel':
+            if self.__token_len(2):
+                return
+
+            job = self.__job(self.tokens[1])
+            if job is not None:
+                job.cancel.set()
+
+        elif root == 'record':
+            if self.__token_len(2):
+                return
+
+            if self.tokens[1] == 'stop':
+                self.__record_stop()
+                return
+
+            self.__record(self.tokens[1])
+
+        elif root == 'stats':
+            if len(self.tokens) == 3 and self.tokens[1] == 'reset':
+                if self.__check(self.tokens[2]):
+                    self.stats.reset(None if self.tokens[2] == 'all'
+                                     else self.tokens[2])
+                return
+
+            if self.__token_len(2):
+                return
+
+            if not self.__check(self.tokens[1]):
+                return
+
+            self.__print_stats(self.tokens[1])
+
+        elif root == 'serve':
+            if len(self.tokens) > 3:
+                print("[CONSOLE]: Want: serve [port] [host].")
+                return
+
+            self.__dashboard(self.tokens[1] if len(self.tokens) > 1 else 8080,
+                             self.tokens[2] if len(self.tokens) > 2
+                             else '127.0.0.1', commands=True)
+
+        elif root == 'dashboard':
+            if len(self.tokens) == 2 and self.tokens[1] == 'stop':
+                self.__dashboard_stop()
+            elif len(self.tokens) <= 2:
+                self.__dashboard(self.tokens[1] if len(self.tokens) == 2
+                                 else 8080)
+            else:
+                print("[CONSOLE]: Want: dashboard [port] or dashboard stop.")
+
+        elif root == 'settle':
+            # settle [device] [tec/dri] [tolerance] [hold s] [timeout s]
+            if self.__token_len(6):
+                return
+
+            if not self.__check(self.tokens[1]) or self.tokens[1] == 'all':
+                return
+
+            self.__settle(*self.tokens[1:])
+
+        elif root == 'pump':
+            if self.__token_len(2):
+                return
+
+            self.__pump(self.tokens[1])
+
+        elif root == 'panic':
+            self.__panic()
+
+        elif root == 'status':
+            if len(self.tokens) > 2 or \
+                    self.tokens[1:] not in ([], ['each'], ['coherent']):
+                print("[CONSOLE]: Want: status [each/coherent].")
+                return
+
+            if len(self.tokens) == 2:
+                self.status.coherent = self.tokens[1] == 'coherent'
+            print("Status file:", self.logfile + ",",
+                  "every board read at the same moment" if self.status.coherent
+                  else "one board at a time", end='')
+            if self.status.coherent and self.status.skew is not None:
+                print(", last skew %.1f ms" % (self.status.skew * 1e3), end='')
+            print(".")
+
+        elif root == 'queue':
+            if self.__token_len(2):
+                return
+
+            if not self.__check(self.tokens[1]):
+                return
+
+            if self.tokens[1] == 'all':
+                for alias in self.__each():
+                    self.__print_queue(alias)
+                return
+
+            self.__print_queue(self.tokens[1])
+
+        elif root == 'profile':
+            # profile [save file] [command]
+            words = self.tokens[1:]
+            filename = None
+            if words[:1] == ['save']:
+                if len(words) < 3:
+                    print("[CONSOLE]: Want: profile save [file] [command].")
+                    return
+                filename, words = words[1], words[2:]
+
+            if not words:
+                print("[CONSOLE]: Want: profile [command].")
+                return
+            if words[0] in ('exit', 'bg', 'wait', 'cancel', 'profile'):
+                print("[CONSOLE]: Cannot profile", words[0] + ".")
+                return
+
+            self.__profile(' '.join(words), filename)
+
+        elif root == 'link':
+            if len(self.tokens) in (2, 3) and \
+                    self.tokens[1] in ('plan', 'apply'):
+                budget = Budget.BUDGET
+                if len(self.tokens) == 3:
+                    try:
+                        budget = float(self.tokens[2])
+                    except ValueError:
+                        print("[CONSOLE]: Want: link plan/apply [budget 0-1].")
+                        return
+                self.__link_plan(budget, self.tokens[1] == 'apply')
+                return
+
+            if self.__token_len(2):
+                return
+
+            if not self.__check(self.tokens[1]):
+                return
+
+            if self.tokens[1] == 'all':
+                for alias in self.__each():
+                    self.__print_link(alias)
+                return
+
+            self.__print_link(self.tokens[1])
+
+        elif root == 'restart':
+            if self.__token_len(2):
+                return
+
+            if not self.__check(self.tokens[1]):
+                return
+
+            if self.tokens[1] == 'all':
+                for alias in self.__each():
+                    self.__restart(alias)
+                return
+
+            self.__restart(self.tokens[1])
+
+        elif root == 'rules':
+            if len(self.tokens) == 3 and self.tokens[1] == 'load':
+                self.__load_rules(self.tokens[2])
+                return
+
+            self.__print_rules()
+
         elif root == 'list':
             self.__list_devs()
             
@@ -314,18 +740,28 @@ class Console:
             print("[CONSOLE]: Already connected to", alias)
             return 
         
-        self.devices[alias] = sf8.SF8xxx(port)
+        if self.isolate:
+            self.devices[alias] = Worker.RemoteSF8xxx(port, alias, self.table,
+                                                      self.rules)
+        else:
+            self.devices[alias] = sf8.SF8xxx(port, watchdog=False)
         
         if not self.devices[alias].connected:
             print("Failed to connect to", port)
+            self.devices[alias].close()  # worker, table slot
             self.devices[alias] = 0
             self.__clean_devices()
             return
         
+        self.applied[alias] = {'devpath': port}
+        if not self.isolate:
+            self.stats.attach(alias, self.devices[alias])
+        self.__start_polling()
         print(self.devices[alias].serial_no, "connected on", 
               self.devices[alias].port, end='. ')
         print("Driver:", "OFF" if self.devices[alias].driver_off else "ON",
               "TEC:", "OFF" if self.devices[alias].tec_off else "ON")
+        Startup.mark('first device')
         
 
     def __load_from_config(self, filename):
@@ -333,11 +769,119 @@ class Console:
         d = json.load(f)
         f.close()
 
+        self.config = filename
+        cancel = Jobs.cancel_event()
         for alias in d.keys():
+            if cancel is not None and cancel.is_set():
+                return
             self.__dial(d[alias]['devpath'], alias)
+            if alias not in self.devices:
+                continue
+            self.loaded[alias] = d[alias]
             self.__driver_current_max(alias, int(d[alias]["driver_current_max"]))
             self.__tec_temp(alias, int(d[alias]["tec_temperature"]))
 
+
+    def __reload(self, filename=None):
+        """
+        Apply only what changed: dial new aliases, hang up removed ones,
+        send only the setters whose value differs from what the device holds
+        (read back in one burst, so writes from any path count)
+        """
+        filename = filename or self.config
+        if filename is None:
+            print("[CONSOLE]: Nothing loaded yet. Want: reload [config].")
+            return
+
+        try:
+            with open(filename, 'r') as f:
+                d = json.load(f)
+        except (OSError, ValueError) as e:
+            print("[CONSOLE]: Cannot reload:", e)
+            return
+        self.config = filename
+
+        sent = avoided = 0
+        dialled, hung_up, changed = [], [], []
+
+        for alias in list(self.loaded):
+            if alias not in d:
+                del self.loaded[alias]
+                if alias in self.devices:
+                    self.__hang_up(alias)
+                    hung_up.append(alias)
+        self.__clean_devices()
+
+        cancel = Jobs.cancel_event()
+        for alias, cfg in d.items():
+            if cancel is not None and cancel.is_set():
+                break
+
+            applied = self.applied.get(alias, {})
+            if alias in self.devices and \
+                    applied.get('devpath') != cfg['devpath']:
+                # moved to another port
+                self.__hang_up(alias)
+                self.__clean_devices()
+            if alias not in self.devices:
+                self.__dial(cfg['devpath'], alias)
+                if alias not in self.devices:
+                    continue
+                dialled.append(alias)
+            self.loaded[alias] = cfg
+
+            keys = [key for key in SETTINGS if key in cfg]
+            held = self.devices[alias].read_registers(
+                [SETTINGS[key][1] for key in keys])
+            for key in keys:
+                setter, register, scale = SETTINGS[key]
+                value = int(cfg[key])
+                if held.get(register) == value * scale:
+                    avoided += 1
+                    continue
+                getattr(self.devices[alias], setter)(value)
+                sent += 1
+                if alias not in dialled and alias not in changed:
+                    changed.append(alias)
+
+        print("Reloaded", filename + ":", sent, "writes sent,", avoided,
+              "avoided.", "Dialled:", ', '.join(dialled) or '-',
+              "Hung up:", ', '.join(hung_up) or '-',
+              "Changed:", ', '.join(changed) or '-')
+
+
+    def __watch(self, filename):
+        """
+        Reload whenever the config file changes
+        """
+        if filename is None:
+            print("[CONSOLE]: Nothing loaded yet. Want: reload watch [config].")
+            return
+
+        self.__watch_stop()
+        end = threading.Event()
+        self.watch_end = end
+
+        def run():
+            last = None
+            while not end.wait(1):
+                try:
+                    mtime = os.stat(filename).st_mtime_ns
+                except OSError:
+                    continue
+                if last is not None and mtime != last:
+                    self.__reload(filename)
+                last = mtime
+
+        threading.Thread(target=run, daemon=True).start()
+        print("Watching", filename)
+
+
+    def __watch_stop(self):
+        if self.watch_end is not None:
+            self.watch_end.set()
+            self.watch_end = None
+
         
     def __hang_up(self, alias):
         if alias not in self.devices.keys():
@@ -347,8 +891,22 @@ class Console:
         print("Disconnecting", 
               self.devices[alias].serial_no, "from", self.devices[alias].port)
         
-        self.devices[alias].__del__()
+        self.stats.detach(alias, self.devices[alias])
+        self.devices[alias].close()
         self.devices[alias] = 0
+        self.applied.pop(alias, None)
+        
+        
+    def __restart(self, alias):
+        dev = self.devices[alias]
+        if not getattr(dev, 'isolated', False):
+            print("[CONSOLE]: Restart needs isolated mode (--isolate)")
+            return
+
+        print("Restarting worker for", alias, "on", dev.port)
+        dev.restart()
+        if not dev.connected:
+            print("Failed to reconnect", alias)
         
         
     def __clean_devices(self):
@@ -371,6 +929,31 @@ class Console:
         self.__print_temperature(alias)
         
         
+    def __qrd_all(self):
+        """
+        Quick rundown of every device, all read at the same moment
+        """
+        report, skew = sf8.coherent_sample(self.devices,
+                                           Planner.READS['qrd'])
+        for alias, readings in report.items():
+            values = {p: v for p, (v, t_send, t_recv) in readings.items()}
+            driver, tec = values['DRIVER_STATE'], values['TEC_STATE']
+            print(alias + ':')
+            print("Driver:\t\t", "?" if driver is None else
+                  "ON" if sf8.decode_driver_state(driver)[1] else "OFF")
+            print("\tValue =", values['DRIVER_CURRENT_MEASURED'], "mA")
+            print("\tSetpoint =", values['DRIVER_CURRENT_VALUE'], "mA")
+            print("\tMax =", values['DRIVER_CURRENT_MAXIMUM'], "mA")
+            print("TEC:\t\t", "?" if tec is None else
+                  "ON" if sf8.decode_tec_state(tec)[0] else "OFF")
+            print("\tTEC =", values['TEC_CURRENT_MEASURED'], "A")
+            print("\tTemp =", values['TEC_TEMPERATURE_MEASURED'], "C")
+
+        if len(report) > 1:
+            print("Skew: %.2f ms across" % (skew * 1e3), len(report),
+                  "devices")
+        
+        
     def __qrrd(self, alias):
         """
         Quicker rundown. Just prints driver, tec current (most important)
@@ -433,6 +1016,7 @@ class Console:
 
 
     def __tec_set(self, alias, value):
+        self.stats.reset(alias)
         if value == 'on':
             self.__tec_on(alias)
             
@@ -464,6 +1048,7 @@ class Console:
             
     
     def __tec_temp(self, alias, value: int):
+        self.stats.reset(alias)
         self.devices[alias].set_tec_temperature(value)
         
         
@@ -476,6 +1061,7 @@ class Console:
         
         
     def __driver_set(self, alias, value):
+        self.stats.reset(alias)
         if value == 'on':
             self.__driver_on(alias)
             
@@ -506,6 +1092,7 @@ class Console:
     
     
     def __driver_current(self, alias, value: int):
+        self.stats.reset(alias)
         self.devices[alias].set_driver_current(value)
         
     
@@ -538,6 +1125,445 @@ class Console:
 
 
 
+    def __batch(self, filename, execute=True):
+        """
+        Plan a file of commands per port and run the ports in parallel
+        """
+        try:
+            with open(filename, 'r') as f:
+                plan = Planner.Plan(Planner.parse(f.readlines(),
+                                                  self.devices.keys()))
+        except (OSError, ValueError) as e:
+            print("[CONSOLE]: Cannot plan:", e)
+            return
+
+        for line in plan.describe():
+            print(line)
+        if not execute:
+            return
+
+        results, actual, elapsed = plan.execute(self.devices)
+        for alias, (errors, readings) in results.items():
+            print(alias + ':')
+            for error in errors:
+                print("\tFAILED", error)
+            for register, value in readings.items():
+                if register in sf8.state_registers and value is not None:
+                    value = value.decode('ascii')
+                print("\t" + register, "=", value)
+        print("Actual round trips:", actual, "in %.3f s" % elapsed)
+
+
+    def __snapshot(self, alias, filename):
+        """
+        Every register of alias (or all) to a file, one burst per device
+        """
+        devices = dict(self.devices) if alias == 'all' \
+            else {alias: self.devices[alias]}
+
+        t0 = time.perf_counter()
+        snapshot = Snapshot.take(devices)
+        elapsed = time.perf_counter() - t0
+        try:
+            Snapshot.save(filename, snapshot)
+        except OSError as e:
+            print("[CONSOLE]: Cannot save snapshot:", e)
+            return
+
+        for a, entry in snapshot.items():
+            failed = [p for p, v in entry['registers'].items() if v is None]
+            if 'error' in entry:
+                print(a + ':', "FAILED,", entry['error'])
+            elif failed:
+                print(a + ':', "failed to read", ', '.join(failed))
+        print("Snapshot of", len(snapshot), "devices to", filename,
+              "in %.3f s" % elapsed)
+
+
+    def __restore(self, alias, filename):
+        """
+        Write the registers that differ from a snapshot
+        """
+        try:
+            snapshot = Snapshot.load(filename)
+        except (OSError, ValueError) as e:
+            print("[CONSOLE]: Cannot load snapshot:", e)
+            return
+
+        devices = dict(self.devices) if alias == 'all' \
+            else {alias: self.devices[alias]}
+
+        t0 = time.perf_counter()
+        results = Snapshot.restore(devices, snapshot)
+        elapsed = time.perf_counter() - t0
+
+        for a, result in results.items():
+            if result is None:
+                print(a + ':', "not in", filename)
+                continue
+            if isinstance(result, Exception):
+                print(a + ':', "FAILED,", str(result) or type(result).__name__)
+                continue
+            written, unchanged, failed = result
+            print(a + ':', len(written), "written,", unchanged, "unchanged",
+                  end='')
+            if written:
+                print(" (" + ', '.join(written) + ")", end='')
+            if failed:
+                print(", FAILED", ', '.join(failed), end='')
+            print()
+        print("Restored in %.3f s" % elapsed)
+
+
+    def __job(self, id):
+        try:
+            return self.jobs[int(id)]
+        except (ValueError, KeyError):
+            print("[CONSOLE]: No such job. Try \"jobs\".")
+            return None
+
+
+    def __list_jobs(self):
+        for id, job in list(self.jobs.items()):
+            print('[' + str(id) + ']', job.status, "%.1f s" % job.elapsed(),
+                  job.command)
+
+        # forget finished jobs once they have been listed
+        for id, job in list(self.jobs.items()):
+            if job.done.is_set():
+                del self.jobs[id]
+
+
+    def __record(self, filename):
+        """
+        Append every polled sample to a telemetry log
+        """
+        self.__record_stop()
+        try:
+            self.recording = Telemetry.Writer(filename)
+        except (OSError, ValueError) as e:
+            print("[CONSOLE]: Cannot record:", e)
+            return
+
+        self.safety.require(Telemetry.REGISTERS)
+        self.safety.listeners.append(self.recording.listener)
+        if self.isolate:
+            self.recorder = Telemetry.Recorder(self.devices, self.recording,
+                                               self.safety.interval)
+            self.recorder.start()
+        print("Recording to", filename)
+
+
+    def __record_stop(self):
+        if self.recording is None:
+            return
+
+        self.safety.listeners.remove(self.recording.listener)
+        if self.recorder is not None:
+            self.recorder.end_threads = True
+            self.recorder = None
+        self.recording.close()
+        self.recording = None
+
+
+    def __dashboard(self, port, host='127.0.0.1', commands=False):
+        """
+        Serve the status page, fed from the safety engine's polls;
+        commands: also take console commands from a gateway
+        """
+        self.__dashboard_stop()
+        try:
+            self.dashboard = Dashboard.Dashboard(
+                int(port), host, command=self.__remote if commands else None)
+        except (OSError, ValueError) as e:
+            print("[CONSOLE]: Cannot serve dashboard:", e)
+            return
+
+        self.safety.require(Dashboard.REGISTERS)
+        self.safety.listeners.append(self.dashboard.listener)
+        self.dashboard.follow(self.devices)
+        self.dashboard.start()
+        print("Dashboard on http://" + host + ":" + str(self.dashboard.port)
+              + "/" + (" taking remote commands" if commands else ""))
+        if commands and not os.environ.get('SF8_TOKEN'):
+            print("Session token (Gateway.py --token):", self.dashboard.token)
+
+
+    def __remote(self, cmd):
+        """
+        Run a command for the gateway, return its output
+        """
+        tokens = cmd.split()
+        if not tokens or tokens[0] in ('exit', 'bg', 'wait', 'cancel',
+                                       'serve', 'dashboard'):
+            return "[CONSOLE]: Not available remotely.\n"
+
+        with self.writer.capture() as out:
+            try:
+                self.__command(cmd)
+            except Worker.PortTimeout as e:
+                print("[CONSOLE]: Device", e, "not responding. Try",
+                      "\"restart " + str(e) + "\".")
+            except Exception as e:
+                print("[CONSOLE]: Failed:", repr(e))
+        return ''.join(out)
+
+
+    def __serve_forever(self):
+        """
+        Block until SIGINT or SIGTERM
+        """
+        stop = threading.Event()
+        try:
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        except ValueError:  # not the main thread
+            pass
+
+        try:
+            while not stop.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+
+
+    def __dashboard_stop(self):
+        if self.dashboard is None:
+            return
+
+        self.safety.listeners.remove(self.dashboard.listener)
+        self.dashboard.stop()
+        self.dashboard = None
+
+
+    def __settle(self, alias, sel, tolerance, hold, timeout):
+        registers = {'tec': 'TEC_TEMPERATURE_MEASURED',
+                     'dri': 'DRIVER_CURRENT_MEASURED'}
+        if sel not in registers:
+            print("[CONSOLE]: Want: 'tec' or 'dri'.")
+            return
+
+        try:
+            tolerance, hold, timeout = \
+                float(tolerance), float(hold), float(timeout)
+        except ValueError:
+            print("[CONSOLE]: Value not recognised. Want: number.")
+            return
+
+        cancel = Jobs.cancel_event()
+        t = self.devices[alias].wait_until_settled(registers[sel], tolerance,
+                                                   hold, timeout,
+                                                   cancel=cancel)
+        if cancel is not None and cancel.is_set():
+            return
+        if t is None:
+            print(alias + ':', "not settled after", timeout, "s")
+        else:
+            print(alias + ':', "settled in %.2f s" % t)
+
+
+    def __pump(self, filename):
+        """
+        Sequenced power-up from config
+        """
+        try:
+            seq = Sequencer.Sequencer.from_file(self.devices, filename,
+                                                Jobs.cancel_event())
+        except (OSError, ValueError) as e:
+            print("[CONSOLE]: Cannot sequence:", e)
+            return
+
+        ok = seq.run()
+        for line in seq.report():
+            print(line)
+        if not ok:
+            print("[CONSOLE]: Power-up aborted. Drivers whose stage failed",
+                  "or was interrupted are off, stages already up are left",
+                  "on; \"panic\" turns all drivers off.")
+
+
+    def __panic(self):
+        """
+        All drivers off concurrently, confirmed
+        """
+        devices = {alias: dev for alias, dev in self.devices.items()
+                   if getattr(dev, 'connected', False)}
+        if not devices:
+            print("[CONSOLE]: No devices connected.")
+            return
+
+        # stop every job (pump, settle, batch...) first so none switches a
+        # driver back on after it has been confirmed off
+        running = [job for job in list(self.jobs.values())
+                   if not job.done.is_set() and job is not Jobs.current()]
+        for job in running:
+            job.cancel.set()
+
+        report, worst = sf8.panic(devices)
+        for alias, (confirmed, latency) in report.items():
+            if confirmed:
+                print(alias + ':', "driver OFF confirmed in %.1f ms"
+                      % (latency * 1e3))
+            else:
+                print(alias + ':', "DRIVER OFF NOT CONFIRMED!!!")
+        print("Worst case: %.1f ms" % (worst * 1e3))
+        if not running:
+            return
+
+        # a write already queued behind the off frames still went out: once
+        # the jobs have stopped, turn everything off again
+        print("Cancelled jobs:", ', '.join(str(job.id) for job in running))
+        deadline = time.monotonic() + 5
+        for job in running:
+            job.done.wait(max(0, deadline - time.monotonic()))
+        report, worst = sf8.panic(devices)
+        for alias, (confirmed, latency) in report.items():
+            if not confirmed:
+                print(alias + ':', "DRIVER OFF NOT CONFIRMED after the jobs",
+                      "stopped!!!")
+
+
+    def __print_stats(self, alias):
+        if self.isolate:
+            print("[CONSOLE]: Statistics are kept for local devices only.")
+            return
+
+        aliases = list(self.devices) if alias == 'all' else [alias]
+        for a in aliases:
+            if a not in self.stats.devices:
+                continue
+            print(a + ':')
+            for register, st in self.stats.summary(a).items():
+                if not st['n']:
+                    print("\t" + register + ": no samples")
+                    continue
+                print("\t" + register + ":", st['n'], "samples,",
+                      "mean %.4g std %.3g ewma %.4g min %.4g max %.4g"
+                      % (st['mean'], st['std'], st['ewma'], st['min'],
+                         st['max']), end='')
+                if st['baseline'] is not None:
+                    print(", baseline %.4g +- %.3g" % (st['baseline'],
+                                                       st['sigma']), end='')
+                print()
+        print("%.0f ns per update," % self.stats.cost(), self.stats.updates,
+              "updates,", len(self.stats.events), "drift events")
+
+
+    def __drift_event(self, event):
+        sf8.log.warning("(%s) %s: %g, baseline %g +- %g", event['alias'],
+                        event['kind'], event['value'], event['baseline'],
+                        event['sigma'],
+                        extra=Log.fields(event['serial_no'], event['register']))
+
+
+    def __print_queue(self, alias):
+        print(alias + ':')
+        for name, st in self.devices[alias].queue_stats().items():
+            print("\t" + name + ":", st['transactions'], "trans,",
+                  "wait %.2f ms mean %.2f ms max," % (st['mean_wait_ms'],
+                                                     st['max_wait_ms']),
+                  "depth", st['depth'], "max", st['max_depth'])
+
+
+    def __profile(self, cmd, filename=None):
+        """
+        Run cmd in the foreground under the profiler, then say where the
+        time went
+        """
+        run = Profiling.Run()
+        with run:
+            try:
+                self.__command(cmd)
+            except Worker.PortTimeout as e:
+                print("[CONSOLE]: Device", e, "not responding.")
+
+        report = run.breakdown()
+        wall = report['wall']
+        print("[PROFILE]: %.1f ms wall" % (wall * 1e3))
+        for key, name in (('serial', 'serial wait'), ('lock', 'port lock wait'),
+                          ('cpu', 'CPU'), ('other', 'other')):
+            print("\t%-15s %8.2f ms %5.1f%%" % (name, report[key] * 1e3,
+                                                report[key] / wall * 100
+                                                if wall else 0))
+        if report['threads']:
+            print("\t%d threads started: %.2f ms thread time, serial wait "
+                  "%.2f ms, port lock wait %.2f ms"
+                  % (report['threads'], report['thread_total'] * 1e3,
+                     report['thread_serial'] * 1e3,
+                     report['thread_lock'] * 1e3))
+
+        print("\t  ncalls  tottime  cumtime (ms)")
+        for ncalls, tottime, cumtime, where in run.hotspots():
+            print("\t%8d %8.2f %8.2f  %s" % (ncalls, tottime * 1e3,
+                                             cumtime * 1e3, where))
+
+        if filename is not None:
+            try:
+                run.save(filename)
+            except OSError as e:
+                print("[CONSOLE]: Could not save profile:", e)
+                return
+            print("[PROFILE]: Saved to", filename,
+                  "(python -m pstats " + filename + ")")
+
+
+    def __print_link(self, alias):
+        link = self.devices[alias].link_stats()
+        print(alias + ':', "last %.0f s," % link['window'], "turnaround",
+              "%.2f ms" % (link['turnaround'] * 1e3)
+              if link['turnaround'] is not None else "not measured")
+        for name, st in link['consumers'].items():
+            if not st['transactions']:
+                continue
+            print("\t" + name + ":", "%.1f trans/s," % st['transactions_per_s'],
+                  "%.0f B/s out %.0f B/s in," % (st['tx_per_s'], st['rx_per_s']),
+                  "wire %.1f%% port %.1f%%," % (st['wire'] * 100,
+                                                 st['busy'] * 100),
+                  "%.2f ms per trans" % (st['per_transaction'] * 1e3))
+
+
+    def __link_plan(self, budget, apply):
+        """
+        Rates the periodic consumers can have on every port within budget;
+        apply: scale the watchdog and status intervals to them. Every device
+        is polled on each pass, so the busiest port sets the rates.
+        """
+        if self.nominal is None:
+            self.nominal = {sf8.WATCHDOG: 1 / self.safety.interval,
+                            sf8.TELEMETRY: 1 / self.status.interval}
+        demands = {sf8.WATCHDOG: (self.safety.parameters,
+                                  self.nominal[sf8.WATCHDOG]),
+                   sf8.TELEMETRY: (Status.REGISTERS,
+                                   self.nominal[sf8.TELEMETRY])}
+
+        rates = dict(self.nominal)
+        for alias, dev in list(self.devices.items()):
+            if not dev.connected or getattr(dev, 'isolated', False):
+                continue
+            link = dev.link_stats()
+            planned, load = Budget.plan(demands, link, budget)
+            print(alias + ":", "load %.1f%%," % (load * 100),
+                  "interactive %.1f%%," % (Budget.interactive(link) * 100),
+                  "max watchdog rate %.1f Hz" % Budget.max_rate(
+                      self.safety.parameters, link, sf8.WATCHDOG, budget))
+            for consumer in rates:
+                rates[consumer] = min(rates[consumer], planned[consumer])
+
+        for consumer, rate in rates.items():
+            print(sf8.priority_names[consumer] + ":",
+                  "%.2f Hz of %.2f Hz" % (rate, self.nominal[consumer]))
+
+        if not apply:
+            return
+
+        if not all(rates.values()):
+            print("[CONSOLE]: No budget left for polling, not applied.")
+            return
+        self.safety.interval = 1 / rates[sf8.WATCHDOG]
+        self.status.interval = 1 / rates[sf8.TELEMETRY]
+        print("[CONSOLE]: Watchdog every %.2f s, status every %.2f s."
+              % (self.safety.interval, self.status.interval))
+
+
     def __print_pid(self,alias):
         print(alias + ':')
         print('P: ' + str(self.devices[alias].get_pid_p()), end=', ')
@@ -545,8 +1571,48 @@ class Console:
         print('D: ' + str(self.devices[alias].get_pid_d()))
         
     
+    def __load_rules(self, filename):
+        try:
+            self.safety.set_rules(Safety.load_rules(filename))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print("[CONSOLE]: Could not load rules:", e)
+            return
+
+        self.rules = filename
+        for dev in self.devices.values():
+            if getattr(dev, 'isolated', False):
+                dev.load_rules(filename)
+
+
+    def __print_rules(self):
+        if not self.isolate:
+            self.__print_rule_stats(self.safety.stats())
+            return
+
+        # each port worker runs its own engine
+        for alias, dev in self.devices.items():
+            print(alias + ':')
+            self.__print_rule_stats(dev.rule_stats())
+
+
+    def __print_rule_stats(self, stats):
+        for name, st in stats.items():
+            print(name + ':', st['evaluations'], "evals,",
+                  "%.1f us/eval," % st['mean_eval_us'],
+                  st['trips'], "trips", end='')
+            if st['last_latency_ms'] is not None:
+                print(", latency last %.1f ms max %.1f ms"
+                      % (st['last_latency_ms'], st['max_latency_ms']), end='')
+            print()
+
+    
     def __list_devs(self):
         for k, v in self.devices.items():
+            if getattr(v, 'isolated', False) and not v.responsive():
+                print(k, '(' + str(v.serial_no) + ')', "on", v.port,
+                      "NOT RESPONDING")
+                continue
+
             print(k, '(' + str(v.serial_no) + ')', "on", v.port)
 
         
@@ -588,6 +1654,8 @@ class Console:
         print("dial [port] [device] - Connect device at [port], addressable by [device].")
         print("hangup [device] - Disconnect this device.")
         print("load [config] - Load default devpaths, devices etc. from config json.")
+        print("reload [config] - Apply only what changed since load/reload.")
+        print("reload watch [config]/stop - Reload whenever the config changes.")
         print("qrd [device] - Quick RunDown of device status.")
         print("configure [device] - Set device registers for easy lab use.")
         print("int [device] [on/off] - Allow/deny interlock.")
@@ -597,10 +1665,32 @@ class Console:
         print("dri set [device] [on/off] - Turn driver on or off.")
         print("dri cur(max) [device] [current, mA] - Set (max) driver current.")
         print("dri stat [device] - Driver status register contents.")
+        print("record [file/stop] - Append polled readings to a telemetry log.")
+        print("dashboard [port/stop] - Serve a live status page (default port 8080).")
+        print("serve [port] [host] - Status page plus remote commands for Gateway.py.")
+        print("settle [device] [tec/dri] [tol] [hold] [timeout] - Wait until settled.")
+        print("pump [config] - Sequenced power-up in dependency order.")
+        print("panic - All drivers off at once, confirmed.")
+        print("status [each/coherent] - How the status file reads the boards.")
         print("lock [device] - Lock status register contents.")
         print("max [device] - Print current maxima.")
         print("pid get [device] - Print PID coefficients.")
+        print("snapshot [device] [file] - Save every register to a file.")
+        print("restore [device] [file] - Write registers that differ from a snapshot.")
+        print("rules [load [file]] - Safety rule stats, or load a rule set.")
         print("list - Print a list of connected devices with ports.")
+        print("queue [device] - Port queue depth and wait time per class.")
+        print("link [device] - Port bytes, transactions and utilisation per consumer.")
+        print("link plan/apply [budget] - Polling rates that fit the port budget (0.8).")
+        print("stats [reset] [device] - Running statistics of measurements, or reset them.")
+        print("restart [device] - Kill and restart a port worker (--isolate).")
+        print("plan [file] - Show how a file of commands would be batched.")
+        print("batch [file] - Run a file of commands, merged per port, in parallel.")
+        print("profile [save file] [command] - Run a command under the profiler.")
+        print("bg [command] - Run any command as a background job.")
+        print("jobs - List background jobs.")
+        print("wait [job] - Wait for a job (or all jobs) to finish.")
+        print("cancel [job] - Cancel a job.")
         print("exit - Exit program.")
         print("[device] = \"all\" to perform the command for all devices (except for dial and driver current routines).")
         print("Author: Douglas McCulloch, May 2024")
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP status dashboard
+
+Fed by the safety rule engine's listeners (and the shared memory table for
+isolated port workers), so viewers cause no serial traffic. Each poll that
+changes a device's values pushes only the changed fields, as a server-sent
+event, to every connected viewer.
+
+    /         status page
+    /events   text/event-stream: one full state event, then deltas
+    /state    full state as JSON
+    /command  POST a console command line, get its output as text (only
+              when served with a command function, see `serve`)
+
+POSTs must carry the session token in an X-SF8-Token header, and a
+browser's Origin must be the dashboard's own, so other web pages cannot
+post commands. The token is SF8_TOKEN from the environment, else one
+generated at startup; on a loopback address it is embedded in the page
+(whose Host header must then be a loopback name, against DNS rebinding).
+Commands are only served on other addresses with SF8_TOKEN set, and the
+page does not carry it there.
+
+Events are JSON: {"alias": "a", "serial_no": 1000, "t": unix time,
+"values": {register: value}}; state registers are hex strings, decoded
+here (SF8xxx.decode_*_state) into DRIVER_ON, TEC_ON and LOCK_FAULT so the
+page does no bit twiddling of its own.
+
+@author: drm1g20
+"""
+
+import hmac
+import ipaddress
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import SF8xxx as sf8
+
+# polled for the page, on top of what the rules need
+REGISTERS = ('DRIVER_STATE', 'DRIVER_CURRENT_MEASURED', 'DRIVER_CURRENT_VALUE',
+             'TEC_STATE', 'TEC_TEMPERATURE_MEASURED', 'TEC_CURRENT_MEASURED',
+             'LOCK_STATE')
+
+# decoded flags sent alongside the state registers
+FLAGS = {'DRIVER_STATE': ('DRIVER_ON',
+                          lambda state: sf8.decode_driver_state(state)[1]),
+         'TEC_STATE': ('TEC_ON', lambda state: sf8.decode_tec_state(state)[0]),
+         # interlock (the first bit) is an expected state, not a fault
+         'LOCK_STATE': ('LOCK_FAULT',
+                        lambda state: any(sf8.decode_lock_state(state)[1:]))}
+
+KEEPALIVE = 15  # s
+TOKEN_HEADER = 'X-SF8-Token'
+
+
+def loopback(host):
+    """
+    True if host (a name or address, maybe [bracketed]) is this machine only
+    """
+    host = host.strip('[]')
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class Dashboard:
+    """
+    State cache, SSE fan-out and the HTTP server.
+    """
+    def __init__(self, port=8080, host='127.0.0.1', backlog=256,
+                 command=None, token=None):
+        """
+        token: for POSTs; default SF8_TOKEN, else a new one per session
+        """
+        if token is None:
+            token = os.environ.get('SF8_TOKEN')
+        self.local = loopback(host)
+        if command is not None and not self.local and not token:
+            raise ValueError("commands on " + host + " need SF8_TOKEN set")
+
+        self.backlog = backlog    # events a slow viewer may fall behind by
+        self.command = command    # fn(command line) -> output, or None
+        self.token = token or secrets.token_urlsafe(16)
+        self.state = {}           # alias -> event dict with all values
+        self.events = 0
+        self.end_threads = False
+        self.__lock = threading.Lock()
+        self.__viewers = []       # one queue per /events connection
+
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+
+    def start(self):
+        self.run_thread = threading.Thread(target=self.server.serve_forever,
+                                           daemon=True)
+        self.run_thread.start()
+
+
+    def stop(self):
+        self.end_threads = True
+        self.server.shutdown()
+        self.server.server_close()
+        with self.__lock:
+            for viewer in self.__viewers:
+                viewer.put(None)
+
+
+    def update(self, alias, serial_no, sample, timestamp=None):
+        """
+        Merge one sample, push what changed
+        """
+        values = {}
+        for register, value in sample.items():
+            if register in FLAGS:
+                flag, decode = FLAGS[register]
+                if isinstance(value, str):  # relayed by a gateway
+                    value = value.encode('ascii', 'replace')
+                values[flag] = None if not value else bool(decode(value))
+            if isinstance(value, (bytes, bytearray)):
+                value = value.decode('ascii', 'replace')
+            values[register] = value
+
+        with self.__lock:
+            known = self.state.setdefault(alias, {'alias': alias,
+                                                  'serial_no': serial_no,
+                                                  't': None, 'values': {}})
+            changed = {register: value for register, value in values.items()
+                       if known['values'].get(register, ...) != value}
+            known['serial_no'] = serial_no
+            known['t'] = timestamp or time.time()
+            if not changed:
+                return
+
+            known['values'].update(changed)
+            self.__push({'alias': alias, 'serial_no': serial_no,
+                         't': known['t'], 'values': changed})
+
+
+    def remove(self, alias):
+        with self.__lock:
+            if self.state.pop(alias, None) is not None:
+                self.__push({'alias': alias, 'removed': True})
+
+
+    def __push(self, event):
+        """
+        Call with the lock held
+        """
+        self.events += 1
+        data = json.dumps(event)
+        for viewer in list(self.__viewers):
+            try:
+                viewer.put_nowait(data)
+            except queue.Full:
+                # too slow: drop it, its browser reconnects and resyncs
+                self.__viewers.remove(viewer)
+                with viewer.mutex:
+                    viewer.queue.clear()
+                viewer.put_nowait(None)
+
+
+    def subscribe(self):
+        """
+        New viewer queue primed with the full state
+        """
+        viewer = queue.Queue(self.backlog)
+        with self.__lock:
+            for event in self.state.values():
+                viewer.put_nowait(json.dumps(event))
+            self.__viewers.append(viewer)
+        return viewer
+
+
+    def unsubscribe(self, viewer):
+        with self.__lock:
+            if viewer in self.__viewers:
+                self.__viewers.remove(viewer)
+
+
+    def viewers(self):
+        return len(self.__viewers)
+
+
+    def snapshot(self):
+        with self.__lock:
+            return json.dumps(list(self.state.values()))
+
+
+    def listener(self, alias, device, sample):
+        """
+        For Safety.RuleEngine.listeners
+        """
+        self.update(alias, device.serial_no, sample)
+
+
+    def follow(self, devices, interval=1):
+        """
+        Feed isolated port workers' published readings, which the console's
+        rule engine never sees, and drop devices that were hung up
+        """
+        def run():
+            last = {}
+            while not self.end_threads:
+                for alias in list(self.state):
+                    if alias not in devices:
+                        self.remove(alias)
+                        last.pop(alias, None)
+
+                for alias, dev in list(devices.items()):
+                    if not getattr(dev, 'isolated', False):
+                        continue
+                    reading = dev.reading()
+                    if reading is None or not reading['timestamp'] or \
+                            last.get(alias) == reading['timestamp']:
+                        continue
+                    last[alias] = reading['timestamp']
+                    self.update(alias, reading['serial_no'],
+                                {p: reading[p] for p in REGISTERS
+                                 if p in reading}, reading['timestamp'])
+                time.sleep(interval)
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+def _handler(dashboard):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+
+        def __send(self, body, content_type):
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+        def __host_ok(self):
+            """
+            On loopback only loopback names: a rebound DNS name would let
+            another site read the page, token included
+            """
+            if not dashboard.local:
+                return True
+            host = self.headers.get('Host', '')
+            if not host.endswith(']'):
+                host = host.rpartition(':')[0] or host
+            if loopback(host):
+                return True
+            self.send_error(403, "Bad host")
+            return False
+
+
+        def do_GET(self):
+            if not self.__host_ok():
+                return
+            if self.path == '/':
+                self.__send(page(dashboard), 'text/html; charset=utf-8')
+            elif self.path == '/state':
+                self.__send(dashboard.snapshot(), 'application/json')
+            elif self.path == '/events':
+                self.__events()
+            else:
+                self.send_error(404)
+
+
+        def do_POST(self):
+            if not self.__host_ok():
+                return
+            if self.path != '/command':
+                self.send_error(404)
+                return
+            if dashboard.command is None:
+                self.send_error(403, "Commands not enabled")
+                return
+
+            origin = self.headers.get('Origin')
+            if origin is not None and \
+                    origin != 'http://' + self.headers.get('Host', ''):
+                self.send_error(403, "Bad origin")
+                return
+            token = self.headers.get(TOKEN_HEADER, '')
+            if not hmac.compare_digest(token.encode('utf-8'),
+                                       dashboard.token.encode('utf-8')):
+                self.send_error(403, "Bad token")
+                return
+
+            length = int(self.headers.get('Content-Length', 0))
+            line = self.rfile.read(length).decode('utf-8').strip()
+            self.__send(dashboard.command(line), 'text/plain; charset=utf-8')
+
+
+        def __events(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+
+            viewer = dashboard.subscribe()
+            try:
+                while not dashboard.end_threads:
+                    try:
+                        data = viewer.get(timeout=KEEPALIVE)
+                    except queue.Empty:
+                        self.wfile.write(b': keepalive\n\n')
+                        self.wfile.flush()
+                        continue
+                    if data is None:
+                        return
+                    self.wfile.write(b'data: ' + data.encode('utf-8')
+                                     + b'\n\n')
+                    self.wfile.flush()
+            except OSError:  # viewer went away
+                pass
+            finally:
+                dashboard.unsubscribe(viewer)
+
+    return Handler
+
+
+def page(dashboard):
+    """
+    The status page, carrying the token when it may post commands
+    """
+    token = None
+    if dashboard.command is not None and dashboard.local:
+        token = dashboard.token
+    return PAGE.replace('/*TOKEN*/null',
+                        json.dumps(token).replace('<', '\\u003c'))
+
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>SF8xxx</title>
+<style>
+body { font-family: monospace; }
+td, th { padding: 2px 12px; text-align: right; }
+.on { color: green; } .off { color: grey; } .fault { color: red; }
+</style></head>
+<body><h3>SF8xxx controller</h3>
+<table><thead><tr><th>device</th><th>ser_no</th><th>driver</th>
+<th>current (mA)</th><th>setpoint (mA)</th><th>TEC</th><th>temp (C)</th>
+<th>TEC current (A)</th><th>lock</th><th>last change (s)</th></tr></thead>
+<tbody id="rows"></tbody></table>
+<form id="command" hidden><input id="line" size="60" placeholder="command">
+</form><pre id="output"></pre>
+<script>
+var devices = {};
+var token = /*TOKEN*/null;
+function cell(row, text, cls) {
+  var td = row.insertCell();
+  td.textContent = text === undefined || text === null ? '' : text;
+  if (cls) td.className = cls;
+}
+function render() {
+  var rows = document.getElementById('rows'), now = Date.now() / 1000;
+  rows.textContent = '';
+  Object.keys(devices).sort().forEach(function (alias) {
+    var d = devices[alias], v = d.values, row = rows.insertRow();
+    cell(row, alias);
+    cell(row, d.serial_no);
+    cell(row, v.DRIVER_ON ? 'ON' : 'OFF', v.DRIVER_ON ? 'on' : 'off');
+    cell(row, v.DRIVER_CURRENT_MEASURED);
+    cell(row, v.DRIVER_CURRENT_VALUE);
+    cell(row, v.TEC_ON ? 'ON' : 'OFF', v.TEC_ON ? 'on' : 'off');
+    cell(row, v.TEC_TEMPERATURE_MEASURED);
+    cell(row, v.TEC_CURRENT_MEASURED);
+    cell(row, v.LOCK_STATE, v.LOCK_FAULT ? 'fault' : 'off');
+    cell(row, d.t ? (now - d.t).toFixed(1) : '');
+  });
+}
+var source = new EventSource('/events');
+source.onopen = function () { devices = {}; };
+source.onmessage = function (e) {
+  var event = JSON.parse(e.data);
+  if (event.removed) {
+    delete devices[event.alias];
+  } else {
+    var d = devices[event.alias] ||
+      (devices[event.alias] = {serial_no: event.serial_no, values: {}});
+    d.serial_no = event.serial_no;
+    d.t = event.t;
+    Object.assign(d.values, event.values);
+  }
+  render();
+};
+setInterval(render, 1000);
+if (token) {
+  var form = document.getElementById('command');
+  form.hidden = false;
+  form.onsubmit = function (e) {
+    e.preventDefault();
+    var line = document.getElementById('line');
+    fetch('/command', {method: 'POST', body: line.value,
+                       headers: {'X-SF8-Token': token}})
+      .then(function (r) { return r.text(); })
+      .then(function (text) {
+        document.getElementById('output').textContent = text;
+      });
+    line.value = '';
+  };
+}
+</script></body></html>
+"""
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorised access to many SF8xxx boards
+
+Fleet: wraps SF8xxx instances behind one device index. Reads go to every
+port in parallel and come back as NumPy arrays aligned to the index;
+setters take a scalar or an array in the same order.
+
+    fleet = Fleet.from_config('devpaths.json')
+    temps = fleet.get('TEC_TEMPERATURE_MEASURED')   # float64, C
+    fleet.set('DRIVER_CURRENT_VALUE', np.linspace(100, 300, len(fleet)))
+
+Values are in physical units (see SF8xxx.scale). A failed read is NaN; state
+registers come back as int32 bit masks with -1 for a failed read. Needs
+NumPy.
+
+@author: drm1g20
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import SF8xxx as sf8
+
+
+class Fleet:
+    """
+    Many boards, one call per operation.
+    """
+    def __init__(self, devices):
+        """
+        devices: dict alias -> SF8xxx, or a list (aliases are then 0..n-1)
+        """
+        if not isinstance(devices, dict):
+            devices = {str(i): dev for i, dev in enumerate(devices)}
+
+        self.aliases = list(devices)
+        self.devices = list(devices.values())
+        self.__pool = ThreadPoolExecutor(max(1, len(self.devices)),
+                                         thread_name_prefix='fleet')
+
+
+    @classmethod
+    def from_config(cls, filename, watchdog=True):
+        """
+        Dial every device in a `load` format config
+        """
+        with open(filename, 'r') as f:
+            config = json.load(f)
+
+        return cls({alias: sf8.SF8xxx(cfg['devpath'], watchdog=watchdog)
+                    for alias, cfg in config.items()})
+
+
+    def __len__(self):
+        return len(self.devices)
+
+
+    def index(self, alias):
+        return self.aliases.index(alias)
+
+
+    def __map(self, fn):
+        """
+        fn(device) on every connected device in parallel -> list in index
+        order, None for a device that is not connected
+        """
+        def run(dev):
+            if not getattr(dev, 'connected', False):
+                return None
+            return fn(dev)
+
+        return list(self.__pool.map(run, self.devices))
+
+
+    @staticmethod
+    def __column(register, values):
+        if register in sf8.state_registers:
+            return np.array([-1 if v is None else v for v in values],
+                            dtype=np.int32)
+        return np.array([np.nan if v is None else v for v in values],
+                        dtype=np.float64)
+
+
+    def get(self, register):
+        """
+        One register from every device -> array aligned to the index
+        """
+        samples = self.__map(lambda dev: dev.sample((register,))[register])
+        if register in sf8.state_registers:
+            samples = [None if v is None else int(v, 16) for v in samples]
+        return self.__column(register, samples)
+
+
+    def sample(self, registers):
+        """
+        Several registers, one pipelined burst per device -> {register:
+        array}
+        """
+        registers = list(registers)
+        raw = self.__map(lambda dev: dev.read_registers(registers))
+
+        columns = {}
+        for register in registers:
+            values = []
+            for registers_raw in raw:
+                value = None if registers_raw is None \
+                    else registers_raw[register]
+                if value is not None and register not in sf8.state_registers:
+                    value = value / sf8.scale.get(register, 1)
+                values.append(value)
+            columns[register] = self.__column(register, values)
+
+        return columns
+
+
+    def set(self, register, values):
+        """
+        Write a writable register (see SF8xxx.writable) on every device.
+        values: scalar or array aligned to the index, physical units; NaN
+        skips that device. Returns a bool array, True where acknowledged.
+        """
+        if register not in sf8.writable:
+            raise ValueError(register + " is not writable")
+
+        values = np.broadcast_to(np.asarray(values, dtype=np.float64),
+                                 (len(self.devices),))
+        raw = np.rint(values * sf8.scale.get(register, 1))
+        if np.any(raw < 0) or np.any(raw > 0xFFFF):
+            raise ValueError(register + " out of range")
+
+        def write(job):
+            dev, value = job
+            if np.isnan(value):
+                return None
+            if not getattr(dev, 'connected', False):
+                return False
+            return not dev.write_registers({register: int(value)})
+
+        ok = list(self.__pool.map(write, zip(self.devices, raw)))
+        return np.array([bool(x) for x in ok], dtype=bool)
+
+
+    def close(self, hang_up=False):
+        """
+        Stop the worker threads; hang_up also disconnects every device
+        """
+        self.__pool.shutdown()
+        if hang_up:
+            for dev in self.devices:
+                dev.close()
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-host gateway
+
+One console for boards split over several hosts. Each host runs its own
+controller with `SF8xxx-controller.py --serve [host:]port` (or `serve` at
+its console); the gateway puts every device in one namespace, host:alias:
+
+    python Gateway.py lab1=http://10.0.0.5:8080 lab2=http://10.0.0.6:8080
+                      [--port 8090] [--ttl 1] [--token T]
+
+    gw> qrd lab1:a           "qrd a" on lab1
+    gw> tec set lab2:b on    "tec set b on" on lab2
+    gw> qrd all              "qrd all" on every host at once
+    gw> status               merged latest readings of every device
+    gw> hosts                hosts, reachability and device counts
+
+A command naming a host:alias goes to that host only. Anything else (all,
+list, queue...) fans out to every host concurrently, and each line of
+output comes back prefixed with [host]. Output of read-only queries is
+cached for `ttl` seconds so repeated queries do not reach the boards;
+sending any other command to a host drops that host's cache.
+
+The gateway follows every host's /events stream and keeps the merged
+readings (`status`, and the gateway's own dashboard with --port), so
+status views cost nothing at the hosts. File arguments (load, snapshot,
+record...) refer to the host's filesystem.
+
+Hosts only take commands with their token (see Dashboard.py): --token, else
+SF8_TOKEN from the environment, shared by every host.
+
+@author: drm1g20
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import Dashboard
+
+# output of these is cached
+QUERIES = ('qrd', 'qrrd', 'lock', 'max', 'list', 'queue', 'stats', 'rules')
+# with a second word, only these subcommands are queries
+SUBQUERIES = {'tec': ('stat',), 'dri': ('stat',), 'pid': ('get',)}
+
+RETRY = 2  # s between /events reconnects
+
+
+class Host:
+    """
+    One controller served with --serve.
+    """
+    def __init__(self, name, url, timeout=30, token=None):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.timeout = timeout      # s, per command
+        self.token = token
+        self.up = False
+        self.end_threads = False
+
+
+    def command(self, line):
+        """
+        Run a console command line on the host -> its output
+        """
+        request = urllib.request.Request(self.url + '/command',
+                                         data=line.encode('utf-8'),
+                                         method='POST')
+        if self.token:
+            request.add_header(Dashboard.TOKEN_HEADER, self.token)
+        try:
+            with urllib.request.urlopen(request,
+                                        timeout=self.timeout) as response:
+                self.up = True
+                return response.read().decode('utf-8')
+        except urllib.error.HTTPError as e:
+            self.up = True
+            return "[GATEWAY]: " + self.name + " refused: " + str(e.code) + \
+                " " + str(e.reason) + "\n"
+        except OSError as e:
+            self.up = False
+            return "[GATEWAY]: " + self.name + " unreachable: " + \
+                str(getattr(e, 'reason', e)) + "\n"
+
+
+    def state(self):
+        """
+        The host's full dashboard state, or None
+        """
+        try:
+            with urllib.request.urlopen(self.url + '/state',
+                                        timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except (OSError, ValueError):
+            return None
+
+
+    def follow(self, fn):
+        """
+        fn(event) for every event on the host's /events stream, from a
+        thread that reconnects until stop()
+        """
+        def run():
+            while not self.end_threads:
+                try:
+                    with urllib.request.urlopen(self.url + '/events',
+                                                timeout=3 * Dashboard.KEEPALIVE
+                                                ) as stream:
+                        self.up = True
+                        fn(None)  # (re)connected: the full state follows
+                        for line in stream:
+                            if self.end_threads:
+                                return
+                            if line.startswith(b'data: '):
+                                fn(json.loads(line[6:]))
+                except (OSError, ValueError):
+                    self.up = False
+                time.sleep(RETRY)
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+    def stop(self):
+        self.end_threads = True
+
+
+class Gateway:
+    """
+    Routing, fan-out, and the caches.
+    """
+    def __init__(self, hosts, ttl=1, timeout=30, token=None):
+        """
+        hosts: dict name -> url
+        token: the hosts' command token, default SF8_TOKEN
+        """
+        if token is None:
+            token = os.environ.get('SF8_TOKEN')
+        self.token = token
+        self.hosts = {name: Host(name, url, timeout, token)
+                      for name, url in hosts.items()}
+        self.ttl = ttl              # s, query cache lifetime
+        self.dashboard = None
+        self.hits = 0
+        self.misses = 0
+        self.readings = {}          # host:alias -> latest event with values
+        self.__cache = {}           # (host, command) -> (time, output)
+        self.__lock = threading.Lock()
+        self.__pool = ThreadPoolExecutor(max(1, len(self.hosts)),
+                                         thread_name_prefix='gateway')
+
+        for host in self.hosts.values():
+            host.follow(self.__merger(host.name))
+
+
+    def __merger(self, name):
+        def merge(event):
+            with self.__lock:
+                if event is None:
+                    gone = [a for a in self.readings
+                            if a.startswith(name + ':')]
+                    for alias in gone:
+                        del self.readings[alias]
+                    if self.dashboard is not None:
+                        for alias in gone:
+                            self.dashboard.remove(alias)
+                    return
+
+                alias = name + ':' + event['alias']
+                if event.get('removed'):
+                    self.readings.pop(alias, None)
+                else:
+                    known = self.readings.setdefault(
+                        alias, {'alias': alias, 'serial_no': None, 't': None,
+                                'values': {}})
+                    known['serial_no'] = event['serial_no']
+                    known['t'] = event['t']
+                    known['values'].update(event['values'])
+
+            if self.dashboard is not None:
+                if event.get('removed'):
+                    self.dashboard.remove(alias)
+                else:
+                    self.dashboard.update(alias, event['serial_no'],
+                                          event['values'], event['t'])
+
+        return merge
+
+
+    def route(self, line):
+        """
+        -> [(host name, command line for it)]
+        """
+        tokens = line.split()
+        for i, token in enumerate(tokens):
+            name, colon, alias = token.partition(':')
+            if colon and name in self.hosts:
+                tokens[i] = alias
+                return [(name, ' '.join(tokens))]
+
+        return [(name, line) for name in self.hosts]
+
+
+    @staticmethod
+    def query(line):
+        """
+        True if the command only reads
+        """
+        tokens = line.split()
+        if not tokens:
+            return False
+        if tokens[0] in SUBQUERIES:
+            return tokens[1:2] != [] and tokens[1] in SUBQUERIES[tokens[0]]
+        return tokens[0] in QUERIES and 'reset' not in tokens
+
+
+    def __run(self, name, line):
+        if not self.query(line):
+            with self.__lock:
+                for key in [key for key in self.__cache if key[0] == name]:
+                    del self.__cache[key]
+            return self.hosts[name].command(line)
+
+        now = time.monotonic()
+        with self.__lock:
+            cached = self.__cache.get((name, line))
+        if cached is not None and now - cached[0] < self.ttl:
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        output = self.hosts[name].command(line)
+        if self.hosts[name].up:
+            with self.__lock:
+                self.__cache[(name, line)] = (now, output)
+        return output
+
+
+    def command(self, line):
+        """
+        Route a command, run it on its host(s) concurrently -> output, each
+        line prefixed with [host]
+        """
+        routes = self.route(line)
+        outputs = self.__pool.map(lambda route: self.__run(*route), routes)
+
+        lines = []
+        for (name, _), output in zip(routes, outputs):
+            for text in output.splitlines():
+                lines.append('[' + name + '] ' + text)
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+    def status(self):
+        """
+        Merged readings, one line per device
+        """
+        with self.__lock:
+            readings = [dict(r, values=dict(r['values']))
+                        for r in self.readings.values()]
+
+        lines = []
+        now = time.time()
+        for r in sorted(readings, key=lambda r: r['alias']):
+            v = r['values']
+            lines.append('{:<16} {:>6} dri {} {:>8} mA  tec {} {:>7} C  '
+                         'lock {}  ({:.1f} s ago)'.format(
+                             r['alias'], str(r['serial_no']),
+                             v.get('DRIVER_STATE'),
+                             v.get('DRIVER_CURRENT_MEASURED'),
+                             v.get('TEC_STATE'),
+                             v.get('TEC_TEMPERATURE_MEASURED'),
+                             v.get('LOCK_STATE'),
+                             now - r['t'] if r['t'] else 0))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Dashboard of every host's devices; commands posted to it are routed
+        """
+        self.dashboard = Dashboard.Dashboard(port, host, command=self.command,
+                                             token=self.token)
+        with self.__lock:
+            for r in self.readings.values():
+                self.dashboard.update(r['alias'], r['serial_no'], r['values'],
+                                      r['t'])
+        self.dashboard.start()
+
+
+    def close(self):
+        for host in self.hosts.values():
+            host.stop()
+        if self.dashboard is not None:
+            self.dashboard.stop()
+        self.__pool.shutdown()
+
+
+def main(args):
+    port = None
+    ttl = 1
+    token = None
+    hosts = {}
+    while args:
+        arg = args.pop(0)
+        if arg == '--port':
+            port = int(args.pop(0))
+        elif arg == '--ttl':
+            ttl = float(args.pop(0))
+        elif arg == '--token':
+            token = args.pop(0)
+        else:
+            name, _, url = arg.partition('=')
+            hosts[name] = url
+
+    if not hosts:
+        print("Usage: python Gateway.py name=http://host:port ... "
+              "[--port N] [--ttl s] [--token T]")
+        return
+
+    gateway = Gateway(hosts, ttl, token=token)
+    if port is not None:
+        gateway.serve(port)
+        print("Dashboard on http://127.0.0.1:" + str(gateway.dashboard.port)
+              + "/")
+
+    try:
+        while True:
+            try:
+                line = input('gw> ').strip()
+            except EOFError:
+                break
+
+            if line == 'exit':
+                break
+            elif line == '':
+                continue
+            elif line == 'status':
+                print(gateway.status(), end='')
+            elif line == 'hosts':
+                for name, host in gateway.hosts.items():
+                    count = sum(1 for alias in gateway.readings
+                                if alias.startswith(name + ':'))
+                    print(name, host.url, 'up' if host.up else 'down', count,
+                          'devices')
+                print('cache:', gateway.hits, 'hits,', gateway.misses,
+                      'misses')
+            else:
+                print(gateway.command(line), end='')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Gateway check
+
+Starts two controllers with `SF8xxx-controller.py --serve` on simulated
+boards (Simulator.py), two boards behind lab1 and one behind lab2, puts a
+Gateway in front of them and checks
+
+    routing     host:alias commands reach that host only, with the alias
+                rewritten (dial, qrd)
+    fan-out     commands without a host run on both, output prefixed
+    cache       a repeated query is answered from the cache
+    events      the merged readings hold every device, and a setpoint
+                written through the gateway comes back on the host's
+                /events stream
+    token       a host refuses a command posted without its token
+
+    python GatewayCheck.py [--timeout s]
+
+Exits 1 if any check fails.
+
+@author: drm1g20
+"""
+
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import Gateway
+import Simulator
+
+HOSTS = {'lab1': ('a', 'b'), 'lab2': ('c',)}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def launch(port, status, token):
+    """
+    A controller serving on port, no terminal -> (process, url)
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen([sys.executable,
+                                os.path.join(here, 'SF8xxx-controller.py'),
+                                '--serve', '127.0.0.1:' + str(port), status],
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL,
+                               env=dict(os.environ, SF8_TOKEN=token))
+    return process, 'http://127.0.0.1:' + str(port)
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def up(url):
+    try:
+        with urllib.request.urlopen(url + '/state', timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def run(timeout=20, out=sys.stdout):
+    """
+    -> [(check, passed, detail)]
+    """
+    token = secrets.token_urlsafe(16)
+    sims = {name: Simulator.Simulator(len(aliases), first_serial=1000 + 10 * i)
+            .start() for i, (name, aliases) in enumerate(HOSTS.items())}
+    directory = tempfile.TemporaryDirectory()
+    processes = []
+    gateway = None
+    results = []
+
+    def check(name, passed, detail=''):
+        results.append((name, bool(passed), detail))
+        out.write("%-8s %s %s\n" % (name, "ok  " if passed else "FAIL", detail))
+        out.flush()
+
+    try:
+        urls = {}
+        for name in HOSTS:
+            process, urls[name] = launch(free_port(),
+                                         os.path.join(directory.name, name),
+                                         token)
+            processes.append(process)
+        if not all(wait_for(lambda: up(url), timeout)
+                   for url in urls.values()):
+            check('start', False, "controllers not serving")
+            return results
+
+        gateway = Gateway.Gateway(urls, ttl=5, token=token)
+
+        # routing: the host:alias names the host, the host sees the alias
+        for name, aliases in HOSTS.items():
+            for alias, board in zip(aliases, sims[name].boards):
+                gateway.command('dial ' + board.port + ' ' + name + ':'
+                                + alias)
+        output = gateway.command('qrd lab1:a')
+        check('routing', output and all(line.startswith('[lab1] ')
+                                        for line in output.splitlines())
+              and 'Driver' in output, repr(output.splitlines()[:1]))
+
+        # fan-out: every host answers, each device under its own host
+        output = gateway.command('list')
+        listed = {(line.split()[0][1:-1], line.split()[1])
+                  for line in output.splitlines() if len(line.split()) > 1}
+        wanted = {(name, alias) for name, aliases in HOSTS.items()
+                  for alias in aliases}
+        check('fan-out', wanted <= listed,
+              "%d of %d devices listed" % (len(wanted & listed), len(wanted)))
+
+        hits = gateway.hits
+        first = gateway.command('qrd all')
+        second = gateway.command('qrd all')
+        check('cache', gateway.hits == hits + len(HOSTS) and first == second,
+              "%d hits" % (gateway.hits - hits))
+
+        # events: every device merged, and a write shows up in the stream
+        merged = {name + ':' + alias for name, alias in wanted}
+        check('events', wait_for(lambda: merged <= set(gateway.readings),
+                                 timeout),
+              ', '.join(sorted(gateway.readings)))
+
+        gateway.command('dri cur lab2:c 123')
+        check('write', wait_for(
+            lambda: gateway.readings.get('lab2:c', {}).get('values', {})
+            .get('DRIVER_CURRENT_VALUE') == 123.0, timeout),
+            "lab2:c setpoint %s" % gateway.readings.get('lab2:c', {})
+            .get('values', {}).get('DRIVER_CURRENT_VALUE'))
+
+        output = Gateway.Host('lab1', urls['lab1']).command('list')
+        check('token', 'refused: 403' in output, output.strip())
+    finally:
+        if gateway is not None:
+            gateway.close()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for sim in sims.values():
+            sim.stop()
+        directory.cleanup()
+
+    return results
+
+
+def main(args):
+    timeout = 20
+    while args:
+        arg = args.pop(0)
+        if arg == '--timeout':
+            timeout = float(args.pop(0))
+        else:
+            print("Usage: python GatewayCheck.py [--timeout s]")
+            return 2
+
+    results = run(timeout)
+    failed = [name for name, passed, detail in results if not passed]
+    if failed:
+        print("FAIL:", ', '.join(failed))
+    else:
+        print("OK: all", len(results), "checks passed")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
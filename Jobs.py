@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Console background jobs and output
+
+Writer: stands in for sys.stdout so every thread's output goes through one
+ordered queue, whole lines at a time, and the prompt is redrawn after
+output that arrives while it is showing
+Job: a console command running in its own thread
+
+@author: drm1g20
+"""
+
+import contextlib
+import queue
+import sys
+import threading
+import time
+
+local = threading.local()
+
+
+def current():
+    """
+    The Job this thread is running, None on the console thread
+    """
+    return getattr(local, 'job', None)
+
+
+def cancel_event():
+    job = current()
+    return None if job is None else job.cancel
+
+
+class Writer:
+    """
+    Ordered console writer.
+    """
+    def __init__(self, out=None, prompt='> '):
+        self.out = out if out is not None else sys.stdout
+        self.prompt_text = prompt
+        self.tty = hasattr(self.out, 'isatty') and self.out.isatty()
+        self.__queue = queue.Queue()
+        self.__local = threading.local()
+        self.__at_prompt = False
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+
+    def write(self, s):
+        capture = getattr(self.__local, 'capture', None)
+        if capture is not None:
+            capture.append(s)
+            return len(s)
+
+        buf = getattr(self.__local, 'buf', '') + s
+        *lines, rest = buf.split('\n')
+        self.__local.buf = rest
+        if lines:
+            self.__queue.put(('lines', self.__prefix(), lines))
+        return len(s)
+
+
+    def flush(self):
+        if getattr(self.__local, 'capture', None) is not None:
+            return
+        rest = getattr(self.__local, 'buf', '')
+        if rest:
+            self.__local.buf = ''
+            self.__queue.put(('lines', self.__prefix(), [rest]))
+
+
+    def __prefix(self):
+        job = current()
+        return '' if job is None else '[' + str(job.id) + '] '
+
+
+    @contextlib.contextmanager
+    def capture(self):
+        """
+        Collect this thread's output in a list instead of printing it
+        """
+        self.flush()
+        self.__local.capture = []
+        try:
+            yield self.__local.capture
+        finally:
+            self.__local.capture = None
+
+
+    def prompt(self):
+        """
+        Show the prompt once everything queued so far is out
+        """
+        self.flush()
+        self.__queue.put(('prompt',))
+
+
+    def typed(self):
+        """
+        The user pressed return, the prompt line is finished
+        """
+        self.__queue.put(('typed',))
+
+
+    def drain(self):
+        done = threading.Event()
+        self.__queue.put(('drain', done))
+        done.wait()
+
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            kind = item[0]
+
+            if kind == 'close':
+                self.out.flush()
+                return
+
+            if kind == 'prompt':
+                self.out.write(self.prompt_text)
+                self.__at_prompt = True
+            elif kind == 'typed':
+                self.__at_prompt = False
+            elif kind == 'drain':
+                item[1].set()
+            else:
+                prefix, lines = item[1], item[2]
+                if self.__at_prompt and not self.tty:
+                    # piped output: just end the prompt line
+                    self.out.write('\n')
+                    self.__at_prompt = False
+                if self.__at_prompt:
+                    # output arriving under the prompt: clear it, redraw after
+                    self.out.write('\r\033[K')
+                self.out.write(''.join(prefix + line + '\n' for line in lines))
+                if self.__at_prompt:
+                    self.out.write(self.prompt_text)
+
+            self.out.flush()
+
+
+    def close(self):
+        self.flush()
+        self.__queue.put(('close',))
+        self.__thread.join()
+
+
+class Job:
+    """
+    A console command running in the background.
+    """
+    def __init__(self, id, command, run):
+        self.id = id
+        self.command = command
+        self.cancel = threading.Event()
+        self.done = threading.Event()
+        self.start = time.time()
+        self.end = None
+        self.status = 'running'
+        self.thread = threading.Thread(target=self.__run, args=(run,),
+                                       name='job-' + str(id), daemon=True)
+
+
+    def __run(self, run):
+        local.job = self
+        try:
+            run(self.command)
+            self.status = 'cancelled' if self.cancel.is_set() else 'done'
+        except Exception as e:
+            print("Failed:", repr(e))
+            self.status = 'failed'
+        finally:
+            print(self.status + ':', self.command)
+            sys.stdout.flush()
+            self.end = time.time()
+            self.done.set()
+
+
+    def elapsed(self):
+        return (self.end or time.time()) - self.start
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Non-blocking structured log
+
+Callers only build a LogRecord and put it on a queue; one listener thread
+formats it and does the I/O, so a slow or blocked stdout never stretches a
+port's lock hold time. Repeats of one message about one register of one
+device are rate limited before they are queued.
+
+Fields (pass as extra=fields(...)): device (serial number), parameter,
+latency_ms. Missing fields are left out of the line:
+
+    SF8xxx 1003 TEC_TEMPERATURE_MEASURED: Read error (200.4 ms)
+
+@author: drm1g20
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+logger = logging.getLogger('sf8')
+
+
+def fields(device=None, parameter=None, latency=None):
+    """
+    extra= dict for one record; latency in s
+    """
+    return {'device': device, 'parameter': parameter,
+            'latency_ms': None if latency is None else latency * 1e3}
+
+
+class RateLimit(logging.Filter):
+    """
+    Pass at most `burst` records per device, parameter and formatted
+    message every `per` seconds; the next one through says how many were
+    dropped.
+    """
+    def __init__(self, burst=5, per=10):
+        super().__init__()
+        self.burst = burst
+        self.per = per
+        self.__lock = threading.Lock()
+        # (device, parameter, message) -> [window start, count, dropped]
+        self.__windows = {}
+        self.dropped = 0
+
+
+    def filter(self, record):
+        # the formatted message: one format string covers several faults
+        key = (getattr(record, 'device', None),
+               getattr(record, 'parameter', None), record.getMessage())
+        now = time.monotonic()
+        with self.__lock:
+            window = self.__windows.get(key)
+            if window is None or now - window[0] >= self.per:
+                dropped = window[2] if window is not None else 0
+                self.__windows[key] = [now, 1, 0]
+                record.suppressed = dropped
+                return True
+
+            window[1] += 1
+            if window[1] > self.burst:
+                window[2] += 1
+                self.dropped += 1
+                return False
+
+            record.suppressed = 0
+            return True
+
+
+class Formatter(logging.Formatter):
+    def format(self, record):
+        line = 'SF8xxx'
+        if getattr(record, 'device', None) is not None:
+            line += ' ' + str(record.device)
+        if getattr(record, 'parameter', None) is not None:
+            line += ' ' + record.parameter
+        line += ': ' + record.getMessage()
+        if getattr(record, 'latency_ms', None) is not None:
+            line += ' (%.1f ms)' % record.latency_ms
+        if getattr(record, 'suppressed', 0):
+            line += ' [' + str(record.suppressed) + ' repeats suppressed]'
+        return line
+
+
+class StdoutHandler(logging.Handler):
+    """
+    Writes to whatever sys.stdout is at the time (the console swaps it)
+    """
+    def emit(self, record):
+        try:
+            sys.stdout.write(self.format(record) + '\n')
+            sys.stdout.flush()
+        except Exception:
+            self.handleError(record)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueue the record as is: the listener does all the formatting
+    """
+    def prepare(self, record):
+        return record
+
+
+records = queue.SimpleQueue()
+limit = RateLimit()
+listener = None
+
+
+def start(filename=None):
+    """
+    Start the listener thread: stdout, plus filename if given. Calling it
+    again replaces the running listener.
+    """
+    global listener
+
+    handlers = [StdoutHandler()]
+    if filename is not None:
+        handlers.append(logging.FileHandler(filename))
+    for handler in handlers:
+        handler.setFormatter(Formatter())
+
+    stop()
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+
+
+def stop():
+    """
+    Write out everything queued and stop the listener
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(QueueHandler(records))
+logger.addFilter(limit)
+start()
+atexit.register(stop)
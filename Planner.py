@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Batch transaction planner
+
+Takes console-style command lines, expands "all", and plans each port's
+work: duplicate reads are merged into one sweep of the registers needed,
+a write superseded by a later write to the same setting is dropped, and
+writes are ordered so dependencies hold (TEC before driver on, driver off
+before TEC off). Reads run after the writes, so they see the final state.
+Ports are then executed in parallel.
+
+Supported: configure, int, tec temp/set/stat, dri cur/curmax/set/stat,
+qrd, qrrd, lock, max, pid get.
+
+@author: drm1g20
+"""
+
+import threading
+import time
+
+# rank: position in a port's plan; key: later writes with the same key
+# supersede earlier ones; trips: serial round trips
+WRITES = {
+    'configure': (0, 'configure', 5),
+    'int': (1, 'interlock', 1),
+    'tec temp': (2, 'tec temp', 1),
+    'tec on': (3, 'tec switch', 2),
+    'dri curmax': (4, 'dri curmax', 1),
+    'dri cur': (5, 'dri cur', 1),
+    'dri on': (6, 'dri switch', 1),
+    'dri off': (6, 'dri switch', 1),
+    'tec off': (7, 'tec switch', 1),
+    }
+
+READS = {
+    'qrd': ('DRIVER_STATE', 'DRIVER_CURRENT_MEASURED', 'DRIVER_CURRENT_VALUE',
+            'DRIVER_CURRENT_MAXIMUM', 'TEC_STATE', 'TEC_CURRENT_MEASURED',
+            'TEC_TEMPERATURE_MEASURED'),
+    'qrrd': ('DRIVER_CURRENT_MEASURED', 'TEC_CURRENT_MEASURED'),
+    'lock': ('LOCK_STATE',),
+    'max': ('DRIVER_CURRENT_MAXIMUM', 'TEC_CURRENT_LIMIT'),
+    'tec stat': ('TEC_STATE',),
+    'dri stat': ('DRIVER_STATE',),
+    'pid get': ('PID_P', 'PID_I', 'PID_D'),
+    }
+
+
+class Op:
+    """
+    One logical operation on one device.
+    """
+    def __init__(self, alias, name, value=None, line=0):
+        self.alias = alias
+        self.name = name
+        self.value = value
+        self.line = line
+
+        if name in WRITES:
+            self.rank, self.key, self.trips = WRITES[name]
+            self.registers = ()
+        else:
+            self.rank, self.key = 8, None
+            self.registers = READS[name]
+            self.trips = len(self.registers)
+
+
+    def __str__(self):
+        return self.name if self.value is None \
+            else self.name + ' ' + str(self.value)
+
+
+    def execute(self, dev):
+        name, value = self.name, self.value
+        if name == 'configure':
+            dev.set_tec_int()
+            dev.set_driver_state()
+        elif name == 'int':
+            if value == 'on':
+                dev.allow_interlock()
+            else:
+                dev.deny_interlock()
+        elif name == 'tec temp':
+            dev.set_tec_temperature(value)
+        elif name == 'tec on':
+            return dev.set_tec_on()
+        elif name == 'tec off':
+            return dev.set_tec_off()
+        elif name == 'dri curmax':
+            dev.set_driver_current_max(value)
+        elif name == 'dri cur':
+            dev.set_driver_current(value)
+        elif name == 'dri on':
+            return dev.set_driver_on()
+        elif name == 'dri off':
+            return dev.set_driver_off()
+
+
+def parse(lines, aliases):
+    """
+    Console command lines -> list of Op in command order
+    """
+    ops = []
+    for number, line in enumerate(lines, 1):
+        tokens = line.split('#')[0].split()
+        if not tokens:
+            continue
+
+        name, value, targets = _parse_line(tokens, number)
+        if targets == 'all':
+            targets = list(aliases)
+        elif targets not in aliases:
+            raise ValueError("line " + str(number) + ": device " + targets
+                             + " not connected")
+        else:
+            targets = [targets]
+
+        for alias in targets:
+            ops.append(Op(alias, name, value, number))
+
+    return ops
+
+
+def _parse_line(tokens, number):
+    """
+    Returns (op name, value, alias or 'all')
+    """
+    def fail():
+        raise ValueError("line " + str(number) + ": cannot plan '"
+                         + ' '.join(tokens) + "'")
+
+    root = tokens[0]
+    if root in ('qrd', 'qrrd', 'lock', 'max', 'configure') and \
+            len(tokens) == 2:
+        return root, None, tokens[1]
+
+    if root == 'int' and len(tokens) == 3 and tokens[2] in ('on', 'off'):
+        return 'int', tokens[2], tokens[1]
+
+    if root == 'pid' and len(tokens) == 3 and tokens[1] == 'get':
+        return 'pid get', None, tokens[2]
+
+    if root in ('tec', 'dri') and len(tokens) == 3 and tokens[1] == 'stat':
+        return root + ' stat', None, tokens[2]
+
+    if root in ('tec', 'dri') and len(tokens) == 4:
+        sel, alias, value = tokens[1:]
+        if sel == 'set' and value in ('on', 'off'):
+            return root + ' ' + value, None, alias
+        if (root, sel) in (('tec', 'temp'), ('dri', 'cur'), ('dri', 'curmax')):
+            try:
+                return root + ' ' + sel, int(value), alias
+            except ValueError:
+                fail()
+
+    fail()
+
+
+class Plan:
+    """
+    Per-port ordered work built from a list of Op.
+    """
+    def __init__(self, ops):
+        self.ops = ops
+        self.ports = {}  # alias -> (writes, registers to read)
+        self.dropped = []
+
+        for alias in dict.fromkeys(op.alias for op in ops):
+            mine = [op for op in ops if op.alias == alias]
+
+            # last write per key wins; configure is idempotent
+            last = {}
+            for op in mine:
+                if op.key is not None:
+                    last[op.key] = op
+            writes = [op for op in mine if op.key is not None]
+            kept = [op for op in writes if last[op.key] is op]
+            self.dropped += [op for op in writes if last[op.key] is not op]
+            kept.sort(key=lambda op: op.rank)
+
+            registers = []
+            for op in mine:
+                for register in op.registers:
+                    if register not in registers:
+                        registers.append(register)
+
+            self.ports[alias] = (kept, registers)
+
+
+    def estimate(self):
+        """
+        Round trips: (as written, planned)
+        """
+        written = sum(op.trips for op in self.ops)
+        planned = sum(sum(op.trips for op in writes) + len(registers)
+                      for writes, registers in self.ports.values())
+        return written, planned
+
+
+    def describe(self):
+        lines = []
+        for alias, (writes, registers) in self.ports.items():
+            steps = [str(op) for op in writes]
+            if registers:
+                steps.append("read " + str(len(registers)) + " registers")
+            trips = sum(op.trips for op in writes) + len(registers)
+            lines.append(alias + ': ' + ', '.join(steps)
+                         + "  (" + str(trips) + " round trips)")
+        for op in self.dropped:
+            lines.append("dropped: " + op.alias + ' ' + str(op)
+                         + " (line " + str(op.line) + ", superseded)")
+        written, planned = self.estimate()
+        lines.append("Estimated round trips: " + str(written)
+                     + " as written, " + str(planned) + " planned")
+        return lines
+
+
+    def execute(self, devices):
+        """
+        Run every port in parallel. Returns ({alias: (errors, readings)},
+        actual round trips, seconds). An op that raises is recorded in
+        errors, with the exception, and stops the rest of its port's work
+        """
+        results = {}
+
+        def transactions():
+            # watchdog and telemetry reads carry on meanwhile, skip them
+            total = 0
+            for alias in self.ports:
+                stats = devices[alias].queue_stats()
+                total += stats['operator']['transactions'] + \
+                    stats['emergency']['transactions']
+            return total
+
+        def run(alias, writes, registers):
+            dev = devices[alias]
+            errors = []
+            readings = {}
+            try:
+                for op in writes:
+                    step = str(op)
+                    ret = op.execute(dev)
+                    if ret:
+                        errors.append(step + ": " + str(ret))
+                step = "read " + str(len(registers)) + " registers"
+                readings = dev.sample(registers) if registers else {}
+            except Exception as e:
+                errors.append(step + ": " + type(e).__name__ + ": " + str(e)
+                              + ", rest of the port not run")
+            results[alias] = (errors, readings)
+
+        before = transactions()
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=run, args=(alias,) + work,
+                                    daemon=True)
+                   for alias, work in self.ports.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - t0
+
+        return results, transactions() - before, elapsed
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Profiler used by the `profile` console command
+
+Run: cProfile for the thread running a command plus every thread it starts
+(Snapshot, coherent_sample and `all` sweeps read boards from their own
+threads). The command's wall time is split into
+
+    serial wait   inside serial_write/serial_read/serial_read_any, pyserial's
+                  own overhead included
+    lock wait     waiting for the port (SF8xxx.PortQueue.acquire), e.g. behind
+                  the watchdog or the status file
+    CPU           the thread's CPU time outside those (profiler overhead
+                  makes it an upper bound)
+    other         the rest: sleeps, waiting for its threads, the GIL
+
+Threads started by the command are summed separately, in thread time.
+
+@author: drm1g20
+"""
+
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+import SF8xxx as sf8
+
+SERIAL = ('serial_write', 'serial_read', 'serial_read_any')
+LOCK = ('acquire',)  # PortQueue.acquire
+
+
+def _wait(stats, names):
+    """
+    Cumulative time in functions of SF8xxx.py called names
+    """
+    library = os.path.basename(sf8.__file__)
+    return sum(ct for (filename, line, name), (cc, nc, tt, ct, callers)
+               in stats.stats.items()
+               if name in names and os.path.basename(filename) == library)
+
+
+class Run:
+    """
+    Context manager profiling the current thread and the threads it starts.
+    """
+    def __init__(self):
+        self.main = cProfile.Profile()
+        self.threads = []  # one Profile per thread started inside
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.__lock = threading.Lock()
+
+
+    def __bootstrap(self, frame, event, arg):
+        """
+        First profile event of a new thread: hand it its own profiler
+        """
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.__lock:
+            self.threads.append(profile)
+        profile.enable()
+
+
+    def __enter__(self):
+        threading.setprofile(self.__bootstrap)
+        self.t0 = time.perf_counter()
+        self.c0 = time.thread_time()
+        self.main.enable()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.main.disable()
+        self.cpu = time.thread_time() - self.c0
+        self.wall = time.perf_counter() - self.t0
+        threading.setprofile(None)
+        return False
+
+
+    def stats(self):
+        """
+        -> (command thread stats, started threads stats or None)
+        """
+        main = pstats.Stats(self.main)
+        with self.__lock:
+            threads = list(self.threads)
+        if not threads:
+            return main, None
+
+        others = pstats.Stats()
+        for profile in threads:
+            others.add(profile)
+        return main, others
+
+
+    def breakdown(self):
+        main, others = self.stats()
+        serial = _wait(main, SERIAL)
+        lock = _wait(main, LOCK)
+        rest = max(0.0, self.wall - serial - lock)
+        cpu = min(self.cpu, rest)
+        report = {'wall': self.wall, 'serial': serial, 'lock': lock,
+                  'cpu': cpu, 'other': rest - cpu,
+                  'threads': len(self.threads)}
+        if others is not None:
+            report['thread_serial'] = _wait(others, SERIAL)
+            report['thread_lock'] = _wait(others, LOCK)
+            report['thread_total'] = others.total_tt
+        return report
+
+
+    def hotspots(self, top=10):
+        """
+        [(ncalls, tottime, cumtime, 'file:line(function)')] by own time, all
+        threads together
+        """
+        main, others = self.stats()
+        if others is not None:
+            main.add(others)
+
+        rows = sorted(main.stats.items(), key=lambda item: item[1][2],
+                      reverse=True)[:top]
+        return [(nc, tt, ct, '%s:%d(%s)' % (os.path.basename(filename), line,
+                                           name))
+                for (filename, line, name), (cc, nc, tt, ct, callers) in rows]
+
+
+    def save(self, filename):
+        """
+        Raw stats of every thread, for pstats or snakeviz
+        """
+        main, others = self.stats()
+        if others is not None:
+            main.add(others)
+        main.dump_stats(filename)
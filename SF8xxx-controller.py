@@ -9,10 +9,29 @@ Created on Sun May 19 12:03:18 2024
 @author: drm1g20
 """
 
+import Startup
 import Console as co
 import sys
 
-if len(sys.argv) > 1:
-  co.Console(logfile=sys.argv[1])
-else:
-  co.Console()
+# worker processes re-import this file, so only run the console as main
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  isolate = '--isolate' in args  # one worker process per port
+  args = [a for a in args if a != '--isolate']
+
+  # --trace: time to prompt and to first device on stderr
+  Startup.enabled = '--trace' in args
+  args = [a for a in args if a != '--trace']
+
+  # --serve [host:]port: take commands from a gateway (Gateway.py)
+  serve = None
+  if '--serve' in args:
+    i = args.index('--serve')
+    host, _, port = args[i + 1].rpartition(':')
+    serve = (host or '127.0.0.1', int(port))
+    del args[i:i + 2]
+
+  if len(args) > 0:
+    co.Console(logfile=args[0], isolate=isolate, serve=serve)
+  else:
+    co.Console(isolate=isolate, serve=serve)
@@ -13,32 +13,460 @@ Created on Fri May 17 13:35:35 2024
 @author: drm1g20
 """
 
+import collections
+import contextlib
 import threading
-import serial
 import time
 import sys
 
+import Log
+
+log = Log.logger
+
+# divisor to convert raw register integer to physical units
+scale = {
+    'DRIVER_CURRENT_VALUE': 10,
+    'DRIVER_CURRENT_MAXIMUM': 10,
+    'DRIVER_CURRENT_MAXIMUM_LIMIT': 10,
+    'DRIVER_CURRENT_MEASURED': 10,
+    'DRIVER_VOLTAGE_MEASURED': 100,
+    'TEC_TEMPERATURE_VALUE': 100,
+    'TEC_TEMPERATURE_MAXIMUM': 100,
+    'TEC_TEMPERATURE_MAXIMUM_LIMIT': 100,
+    'TEC_TEMPERATURE_MEASURED': 100,
+    'TEC_CURRENT_MEASURED': 10,
+    'TEC_CURRENT_LIMIT': 10,
+    'TEC_VOLTAGE_MEASURED': 100,
+    }
+
+# setpoint register for each measurement register
+setpoints = {
+    'TEC_TEMPERATURE_MEASURED': 'TEC_TEMPERATURE_VALUE',
+    'DRIVER_CURRENT_MEASURED': 'DRIVER_CURRENT_VALUE',
+    }
+
+# registers returned as raw bit masks rather than numbers
+state_registers = ('DRIVER_STATE', 'TEC_STATE', 'LOCK_STATE')
+
+# value registers that can be written back, maxima before the values they
+# clamp; the state registers take commands rather than values
+writable = ('DRIVER_CURRENT_MAXIMUM', 'DRIVER_CURRENT_VALUE',
+            'TEC_TEMPERATURE_MAXIMUM', 'TEC_TEMPERATURE_VALUE',
+            'TEC_CURRENT_LIMIT', 'PID_P', 'PID_I', 'PID_D')
+
+# command priority classes, lowest served first
+EMERGENCY = 0   # driver off
+OPERATOR = 1    # console setters and queries (default)
+WATCHDOG = 2    # safety rule engine reads
+TELEMETRY = 3   # status file and other background reads
+
+priority_names = ('emergency', 'operator', 'watchdog', 'telemetry')
+
+# how long (s) a coherent_sample sweep waits for a busy port before
+# leaving it out: enough for a watchdog poll in progress to finish
+SWEEP_WAIT = 0.1
+
+# 8N1 at 115200 baud: 10 bits on the wire per byte
+BAUD = 115200
+BYTE_TIME = 10 / BAUD  # s
+# frame sizes, bytes: 'J' + code + CR; 'P' + code + ' ' + value + CR;
+# reply 'K' + code + ' ' + value + CR
+GET_FRAME = 6
+SET_FRAME = 11
+REPLY_FRAME = 11
+
+
 def serial_write(dev, payload):
     written = 0
-    while written < length(payload):
+    while written < len(payload):
         try:
-            written += dev.write(payload)
+            written += dev.write(payload[written:])
         except:
             return 0  # not used to this
     return written
 
 def serial_read(dev):
     try:
-        res = self.dev.read_until(expected='\r')
+        res = dev.read_until(expected=b'\r')
     except:
         return ''
     return res
 
+
+def serial_read_any(dev):
+    """
+    Whatever is waiting, or the next byte (b'' after the port timeout)
+    """
+    try:
+        return dev.read(max(1, dev.in_waiting))
+    except:
+        return b''
+
+
+def decode(parameter, data):
+    """
+    Getter reply -> bytes for state registers, physical units otherwise,
+    None for an error or corrupted reply
+    """
+    if not data or len(data) < 10 or data[:1] != b'K':
+        return None
+    if parameter in state_registers:
+        return data[6:10]
+    try:
+        return int(data[6:10], 16) / scale.get(parameter, 1)
+    except ValueError:
+        return None
+
+
+def state_bits(state):
+    """
+    A state register as an integer: state is the reply's 4 hex digits
+    (bytes or str) or already an integer. ValueError if it is not hex
+    """
+    if isinstance(state, int):
+        return state
+    return int(state, 16)
+
+
+def decode_driver_state(state):
+    """
+    Decode DRIVER_STATE bit mask:
+        Device, Driver, Current, Enable, NTC, Interlock
+    """
+    state = state_bits(state)
+    device = state & 0x0001
+    driver = state & 0x0002
+    current = state & 0x0004
+    enable = state & 0x0010
+    ntc = state & 0x0040
+    interlock = state & 0x0080
+
+    return device, driver, current, enable, ntc, interlock
+
+
+def decode_tec_state(state):
+    """
+    Decode TEC_STATE bit mask:
+        TEC, temp set, enable
+    """
+    state = state_bits(state)
+    tec = state & 0x0002
+    temp = state & 0x0004
+    enable = state & 0x0010
+
+    return tec, temp, enable
+
+
+def decode_lock_state(state):
+    """
+    Decode LOCK_STATE bit mask:
+        interlock, LD overcurrent, LD overheat, NTC, TEC error, TEC heat?
+    """
+    state = state_bits(state)
+    interlock = state & 0x0002
+    ld_overcurrent = state & 0x0008
+    ld_overheat = state & 0x0010
+    ntc = state & 0x0020
+    tec_error = state & 0x0040
+    tec_selfheat = state & 0x0080
+
+    return interlock, ld_overcurrent, ld_overheat, ntc, tec_error, \
+            tec_selfheat
+
+
+def panic(devices, timeout=2):
+    """
+    Turn every driver off at once and confirm each is off.
+    devices: dict alias -> SF8xxx (or anything with emergency_off())
+    Returns ({alias: (confirmed, latency s)}, worst latency s); a device
+    that has not confirmed within timeout is reported (False, None).
+    """
+    results = {}
+    barrier = threading.Barrier(len(devices) + 1)
+
+    def off(alias, dev):
+        barrier.wait()
+        try:
+            confirmed = bool(dev.emergency_off())
+        except Exception:
+            confirmed = False
+        results[alias] = (confirmed, time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=off, args=(alias, dev), daemon=True)
+               for alias, dev in devices.items()]
+    for thread in threads:
+        thread.start()
+
+    t0 = time.perf_counter()
+    barrier.wait()
+    deadline = t0 + timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.perf_counter()))
+
+    report = {alias: results.get(alias, (False, None)) for alias in devices}
+    latencies = [latency for ok, latency in report.values() if latency]
+    return report, max(latencies) if latencies else 0.0
+
+
+def coherent_sample(devices, parameters, priority=OPERATOR, timeout=2):
+    """
+    Read parameters from every device at the same moment: the devices'
+    threads meet at a barrier, then each takes its port and fires one
+    pipelined burst. No port is held at the barrier, and a device whose port
+    is not free within SWEEP_WAIT is left out of the sweep (its reads
+    failed), so a wedged port holds up no other.
+    devices: dict alias -> SF8xxx
+    Returns ({alias: {parameter: (value, t_send, t_recv)}}, skew s), times
+    from time.perf_counter(). A board handles each frame of a burst at the
+    same offset after it was sent, so skew is the largest spread across
+    devices of the send times of one register; t_recv - t_send bounds the
+    offset. A failed read is (None, None, None).
+    """
+    parameters = list(parameters)
+    devices = {alias: dev for alias, dev in devices.items()
+               if getattr(dev, 'connected', False)}
+    if not devices:
+        return {}, 0.0
+
+    results = {}
+    barrier = threading.Barrier(len(devices), timeout=timeout)
+
+    def read(alias, dev):
+        try:
+            if getattr(dev, 'isolated', False):
+                # port served by another process: fire from here
+                try:
+                    barrier.wait()
+                except threading.BrokenBarrierError:
+                    pass
+                results[alias] = dev.timed_sample(parameters)
+            else:
+                with dev.priority(priority):
+                    results[alias] = dev.timed_sample(parameters, barrier)
+        except Exception:
+            pass
+
+    threads = [threading.Thread(target=read, args=(alias, dev), daemon=True)
+               for alias, dev in devices.items()]
+    for thread in threads:
+        thread.start()
+
+    deadline = time.perf_counter() + 2 * timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.perf_counter()))
+
+    failed = {parameter: (None, None, None) for parameter in parameters}
+    report = {alias: results.get(alias, failed) for alias in devices}
+
+    skew = 0.0
+    for parameter in parameters:
+        sent = [t_send for value, t_send, t_recv in
+                (readings[parameter] for readings in report.values())
+                if t_send is not None]
+        if len(sent) > 1:
+            skew = max(skew, max(sent) - min(sent))
+
+    return report, skew
+
+
+class PortQueue:
+    """
+    Priority lock serialising transactions on one port.
+
+    Waiters are served by class, FIFO within a class. A waiter passed over
+    max_bypass times is served as OPERATOR, so background reads wait a
+    bounded number of transactions; EMERGENCY always goes first.
+    """
+    def __init__(self, max_bypass=8):
+        self.max_bypass = max_bypass
+        self.__cond = threading.Condition()
+        self.__busy = False
+        self.__waiting = []  # [priority, seq, bypassed]
+        self.__next = None
+        self.__seq = 0
+        self.stats = [{'transactions': 0, 'wait': 0.0, 'max_wait': 0.0,
+                       'depth': 0, 'max_depth': 0}
+                      for name in priority_names]
+
+
+    def __effective(self, entry):
+        priority, seq, bypassed = entry
+        if priority > OPERATOR and bypassed >= self.max_bypass:
+            priority = OPERATOR
+        return priority, seq
+
+
+    def __grant(self):
+        """
+        Pick the next waiter. Call with the condition held.
+        """
+        if not self.__waiting:
+            self.__next = None
+            return
+
+        entry = min(self.__waiting, key=self.__effective)
+        for other in self.__waiting:
+            if other is not entry and other[0] > entry[0]:
+                other[2] += 1
+        self.__next = entry
+        self.__cond.notify_all()
+
+
+    def acquire(self, priority=OPERATOR, timeout=None):
+        """
+        Wait for the port, at most timeout s if given. Returns False if it
+        was not ours in time
+        """
+        t0 = time.perf_counter()
+        stats = self.stats[priority]
+
+        with self.__cond:
+            if self.__busy or self.__waiting:
+                entry = [priority, self.__seq, 0]
+                self.__seq += 1
+                self.__waiting.append(entry)
+                stats['depth'] += 1
+                stats['max_depth'] = max(stats['max_depth'], stats['depth'])
+                if not self.__busy and self.__next is None:
+                    self.__grant()
+
+                while self.__next is not entry:
+                    left = None if timeout is None \
+                        else t0 + timeout - time.perf_counter()
+                    if left is not None and left <= 0:
+                        self.__waiting.remove(entry)
+                        stats['depth'] -= 1
+                        return False
+                    self.__cond.wait(left)
+
+                self.__waiting.remove(entry)
+                self.__next = None
+                stats['depth'] -= 1
+
+            self.__busy = True
+
+        wait = time.perf_counter() - t0
+        stats['transactions'] += 1
+        stats['wait'] += wait
+        stats['max_wait'] = max(stats['max_wait'], wait)
+        return True
+
+
+    def release(self):
+        with self.__cond:
+            self.__busy = False
+            self.__grant()
+
+
+    @contextlib.contextmanager
+    def slot(self, priority=OPERATOR):
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+    def summary(self):
+        """
+        Per class: transactions, mean and max wait (ms), depth now and max
+        """
+        summary = {}
+        for name, st in zip(priority_names, self.stats):
+            n = st['transactions']
+            summary[name] = {'transactions': n,
+                             'mean_wait_ms': st['wait'] / n * 1e3 if n else 0,
+                             'max_wait_ms': st['max_wait'] * 1e3,
+                             'depth': st['depth'],
+                             'max_depth': st['max_depth']}
+        return summary
+
+
+class Link:
+    """
+    Utilisation of one port by consumer (priority class): transactions,
+    bytes each way and how long the port was held, over the last `window`
+    seconds and in total.
+    """
+    def __init__(self, window=10):
+        self.window = window
+        self.created = time.monotonic()
+        self.turnaround = None  # s, board reply latency beyond the wire, EWMA
+        self.__lock = threading.Lock()
+        self.__recent = collections.deque()  # (t, consumer, n, tx, rx, busy)
+        self.totals = [{'transactions': 0, 'tx': 0, 'rx': 0, 'busy': 0.0}
+                       for name in priority_names]
+
+
+    def record(self, consumer, transactions, tx, rx, busy):
+        """
+        One hold of the port: transactions exchanged, bytes sent and
+        received, seconds held
+        """
+        now = time.monotonic()
+        with self.__lock:
+            totals = self.totals[consumer]
+            totals['transactions'] += transactions
+            totals['tx'] += tx
+            totals['rx'] += rx
+            totals['busy'] += busy
+
+            self.__recent.append((now, consumer, transactions, tx, rx, busy))
+            while self.__recent[0][0] < now - self.window:
+                self.__recent.popleft()
+
+            if transactions == 1 and rx:
+                turnaround = max(0.0, busy - (tx + rx) * BYTE_TIME)
+                self.turnaround = turnaround if self.turnaround is None \
+                    else self.turnaround + 0.1 * (turnaround - self.turnaround)
+
+
+    def summary(self):
+        """
+        Per consumer over the window: transactions and bytes per second,
+        wire and port utilisation (fractions of the window), mean port time
+        per transaction (s, over all time)
+        """
+        now = time.monotonic()
+        with self.__lock:
+            recent = [entry for entry in self.__recent
+                      if entry[0] >= now - self.window]
+            totals = [dict(t) for t in self.totals]
+        span = max(min(self.window, now - self.created), 1e-3)
+
+        consumers = {}
+        for consumer, name in enumerate(priority_names):
+            n = tx = rx = 0
+            busy = 0.0
+            for t, c, n_, tx_, rx_, busy_ in recent:
+                if c == consumer:
+                    n += n_
+                    tx += tx_
+                    rx += rx_
+                    busy += busy_
+            total = totals[consumer]
+            consumers[name] = {
+                'transactions_per_s': n / span,
+                'tx_per_s': tx / span,
+                'rx_per_s': rx / span,
+                # request and reply alternate, so both directions count
+                'wire': (tx + rx) * BYTE_TIME / span,
+                'busy': busy / span,
+                'per_transaction': total['busy'] / total['transactions']
+                if total['transactions'] else None,
+                'transactions': total['transactions']}
+
+        return {'window': span, 'turnaround': self.turnaround,
+                'consumers': consumers}
+
+
 class SF8xxx:
     """
     Object handling I/O to and from SF8xxx.
     """
     def __make_connection(self):
+        import serial  # on first dial, not at import
+
         try:
             self.dev = serial.Serial(self.port, 115200, timeout=0.2)
         except serial.SerialException:
@@ -46,58 +474,336 @@ class SF8xxx:
             return
         self.connected = True
         
-    def __init__(self, port):
+    def __init__(self, port, watchdog=True):
         self.port = port
-        self.__lock = threading.Lock()
+        self.__queue = PortQueue()
+        self.__link = Link()
+        self.__local = threading.local()  # per-thread priority class
         self.end_threads = False
         
+        self.watchdog = None
+        self.temperature_thread = None
+        self.serial_no = None
+        self.stats = None  # Stats.DeviceStats fed with every measurement
+        
         self.__make_connection()
+        if not self.connected:
+            return
 
-        # get details and initial status
-        self.serial_no = self.get_serial_no()
-        
-        self.driver_off = not self.driver_state()[1]
-        self.tec_off = not self.tec_state()[0]
+        # get details and initial status, one burst
+        initial = self.read_registers(['SERIAL_NO', 'DRIVER_STATE',
+                                       'TEC_STATE', 'TEC_TEMPERATURE_MEASURED'])
+        if None not in initial.values():
+            self.serial_no = initial['SERIAL_NO']
+            self.driver_off = not decode_driver_state(
+                initial['DRIVER_STATE'])[1]
+            self.tec_off = not decode_tec_state(initial['TEC_STATE'])[0]
+            self.temperature = initial['TEC_TEMPERATURE_MEASURED'] / 100
+        else:
+            # a reply went missing: one at a time
+            self.serial_no = self.get_serial_no()
+
+            self.driver_off = not self.driver_state()[1]
+            self.tec_off = not self.tec_state()[0]
 
-        self.temperature = self.get_tec_temperature()
+            self.temperature = self.get_tec_temperature()
 
         # start temperature limit thread
         # (had issues with TEC turning off spontaneously while driver is on)
-        temperature_threshold = 5
-        poll_interval = 2
-        self.temperature_thread = threading.Thread(target=self.poll_tec_temperature,
-                                              args=(temperature_threshold,
-                                                    poll_interval,))
-        self.temperature_thread.start()
+        # Console runs one Safety.RuleEngine for all devices instead
+        if watchdog:
+            temperature_threshold = 5
+            poll_interval = 2
+            self.temperature_thread = threading.Thread(target=self.poll_tec_temperature,
+                                                  args=(temperature_threshold,
+                                                        poll_interval,))
+            self.temperature_thread.start()
 
     
-    def __del__(self):
-        if not self.connected:
+    def close(self):
+        """
+        Stop the watchdog thread and close the port. Calling it again does
+        nothing.
+        """
+        if not getattr(self, 'connected', False):
             return
+        self.connected = False
         self.end_threads = True
-        self.temperature_thread.join()
+        if self.watchdog is not None:
+            self.watchdog.end_threads = True
+        if self.temperature_thread is not None and \
+                self.temperature_thread is not threading.current_thread():
+            self.temperature_thread.join()
         try:
             self.dev.close()
         except:
-            print("SF8xxx: Could not hang up ", self.serial_no)
+            log.error("Could not hang up", extra=Log.fields(self.serial_no))
+
+
+    def __del__(self):
+        # only for callers that never closed it
+        self.close()
+
+    
+    @contextlib.contextmanager
+    def priority(self, level):
+        """
+        Run this thread's transactions inside the block at priority level
+        """
+        previous = getattr(self.__local, 'priority', None)
+        self.__local.priority = level
+        try:
+            yield
+        finally:
+            self.__local.priority = previous
+
+
+    def __priority(self):
+        level = getattr(self.__local, 'priority', None)
+        return OPERATOR if level is None else level
+
+
+    def queue_stats(self):
+        return self.__queue.summary()
+
+
+    def link_stats(self):
+        return self.__link.summary()
 
     
     def __get_response(self, parameter):
         """
         Return Response object from getter function
         """
-        with self.__lock:
+        priority = self.__priority()
+        with self.__queue.slot(priority):
+            t0 = time.perf_counter()
             cmd = Getter(parameter)
             if not serial_write(self.dev, cmd.data_bytes()):
-                print("SF8xxx: Write error ", self.serial_no)
+                log.warning("Write error", extra=Log.fields(
+                    self.serial_no, parameter, time.perf_counter() - t0))
 
             res_data = serial_read(self.dev)
-            if res_data == '':
-                print("SF8xxx: Read error ", self.serial_no)
+            if not res_data:
+                log.warning("Read error", extra=Log.fields(
+                    self.serial_no, parameter, time.perf_counter() - t0))
+
+            self.__link.record(priority, 1, GET_FRAME, len(res_data),
+                               time.perf_counter() - t0)
+            return Response(res_data, device=self.serial_no,
+                            parameter=parameter)
+
+    
+    def __pipeline(self, commands, window=8, barrier=None, times=None):
+        """
+        Send commands back to back, up to window frames in flight, in one
+        queue slot. Returns {parameter code: reply}; a command whose code is
+        missing got no valid reply.
+        barrier: wait at it, then for the port at most SWEEP_WAIT (nothing
+        is sent if it is not ours by then)
+        times: dict filled with {parameter code: (t0, t1)}: the burst was
+        sent at t0 and the reply read by t1
+        """
+        replies = {}
+        priority = self.__priority()
+        if barrier is None:
+            self.__queue.acquire(priority)
+        else:
+            # rendezvous first: no port is held while the others catch up.
+            # One not ours within SWEEP_WAIT (wedged, or a long burst in
+            # progress) sits the sweep out
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+            if not self.__queue.acquire(priority, SWEEP_WAIT):
+                log.warning("Port busy, left out of the sweep",
+                            extra=Log.fields(self.serial_no))
+                return replies
+
+        try:
+            t_slot = time.perf_counter()
+            tx = rx = 0
+            for i in range(0, len(commands), window):
+                chunk = commands[i:i + window]
+                payload = b''.join(cmd.data_bytes() for cmd in chunk)
+                tx += len(payload)
+                if not serial_write(self.dev, payload):
+                    log.warning("Write error", extra=Log.fields(
+                        self.serial_no))
+                    break
+                t0 = time.perf_counter()
+
+                # read whatever has arrived rather than a byte at a time
+                buf = b''
+                pending = len(chunk)
+                while pending:
+                    data = serial_read_any(self.dev)
+                    t1 = time.perf_counter()
+                    if not data:
+                        log.warning("Read error, %d replies missing", pending,
+                                    extra=Log.fields(self.serial_no, None,
+                                                     t1 - t0))
+                        break
+
+                    buf += data
+                    rx += len(data)
+                    while pending and b'\r' in buf:
+                        res_data, buf = buf.split(b'\r', 1)
+                        res_data += b'\r'
+                        pending -= 1
+                        if res_data[:1] == b'K' and len(res_data) >= 10:
+                            replies[bytes(res_data[1:5])] = res_data
+                            if times is not None:
+                                times[bytes(res_data[1:5])] = (t0, t1)
+
+            self.__link.record(priority, len(commands), tx, rx,
+                               time.perf_counter() - t_slot)
+
+
+        finally:
+            self.__queue.release()
+
+        return replies
+
+
+    def read_registers(self, parameters=None):
+        """
+        Read registers (default: every one in Command.parameters) in one
+        pipelined burst. Returns {parameter: raw integer, None on a failed
+        read}
+        """
+        if parameters is None:
+            parameters = list(Command().parameters)
+
+        commands = [Getter(parameter) for parameter in parameters]
+        replies = self.__pipeline(commands)
+
+        registers = {}
+        for parameter, cmd in zip(parameters, commands):
+            res_data = replies.get(bytes(cmd.data[1:5]))
+            registers[parameter] = None
+            if res_data is not None:
+                try:
+                    registers[parameter] = Response(res_data).rtoi()
+                except ValueError:  # corrupted reply
+                    pass
+
+        return registers
 
-            return Response(res_data)
+
+    def write_registers(self, values):
+        """
+        Write {parameter: raw integer} in one pipelined burst, in order.
+        Returns the parameters whose write was not acknowledged
+        """
+        commands = [Setter(parameter, value)
+                    for parameter, value in values.items()]
+        replies = self.__pipeline(commands)
+
+        if 'TEC_TEMPERATURE_VALUE' in values:
+            self.temperature = values['TEC_TEMPERATURE_VALUE'] / 100
+
+        return [parameter for parameter, cmd in zip(values, commands)
+                if bytes(cmd.data[1:5]) not in replies]
+
+
+    def timed_sample(self, parameters, barrier=None):
+        """
+        Read parameters in one pipelined burst, first waiting at barrier
+        if given (see coherent_sample). Returns {parameter: (value, t_send,
+        t_recv)}, perf_counter times bracketing when the board took the
+        reading; values decoded as in sample()
+        """
+        commands = [Getter(parameter) for parameter in parameters]
+        times = {}
+        replies = self.__pipeline(commands, barrier=barrier, times=times)
+
+        readings = {}
+        for parameter, cmd in zip(parameters, commands):
+            code = bytes(cmd.data[1:5])
+            t_send, t_recv = times.get(code, (None, None))
+            value = decode(parameter, replies.get(code))
+            readings[parameter] = (value, t_send, t_recv) if value is not None \
+                else (None, None, None)
+
+        return readings
+
+
+    def sample(self, parameters):
+        """
+        Read each register in parameters once and return a dict of decoded
+        values: bytes for state registers, physical units otherwise, None on
+        a failed read
+        """
+        sample = {}
+        for parameter in parameters:
+            if parameter in sample:
+                continue
+
+            res = self.__get_response(parameter)
+            value = decode(parameter, res.data)
+            sample[parameter] = value
+            if self.stats is not None and value is not None:
+                self.stats.update(parameter, value)
+
+        return sample
             
     
+    def wait_until_settled(self, register, tolerance, hold_time, timeout,
+                           target=None, min_interval=0.02, max_interval=1,
+                           cancel=None):
+        """
+        Block until register stays within tolerance of target (default: its
+        setpoint register) for hold_time seconds.
+        Returns seconds until settled, None on timeout or when the optional
+        threading.Event cancel is set.
+
+        Sampling is adaptive: far from the band the next read is timed from
+        the observed rate of approach, inside the band reads are spread so
+        the hold window is still checked a few times.
+        """
+        t0 = time.perf_counter()
+        if target is None:
+            target = self.sample((setpoints[register],))[setpoints[register]]
+            if target is None:
+                return None
+
+        since = None
+        last = None
+        while True:
+            value = self.sample((register,))[register]
+            now = time.perf_counter()
+            elapsed = now - t0
+
+            error = None if value is None else abs(value - target)
+            if error is not None and error <= tolerance:
+                if since is None:
+                    since = now
+                if now - since >= hold_time:
+                    return elapsed
+                interval = hold_time / 4
+            else:
+                since = None
+                interval = max_interval
+                if error is not None and last is not None:
+                    rate = (last[1] - error) / (now - last[0])
+                    if rate > 0:  # approaching: aim to arrive at the edge
+                        interval = (error - tolerance) / rate / 2
+            if error is not None:
+                last = (now, error)
+
+            if elapsed >= timeout:
+                return None
+
+            interval = min(max(interval, min_interval), max_interval,
+                           timeout - elapsed)
+            if cancel is None:
+                time.sleep(interval)
+            elif cancel.wait(interval):
+                return None
+
+    
     def get_driver_state(self):
         """
         Return a 8-bit mask representing driver state
@@ -111,25 +817,14 @@ class SF8xxx:
             Device, Driver, Current, Enable, NTC, Interlock
             ON/OFF, ON/OFF, INT/EXT, INT/EXT, DENY/ALLOW, DENY/ALLOW
         """
-        state = self.get_driver_state()
-
-        device = state[3] & 0x1
-        driver = state[3] & 0x2
-        current = state[3] & 0x4
-        enable = state[2] & 0x1
-        ntc = state[2] & 0x4
-        interlock = state[2] & 0x8
-        
-        return device, driver, current, enable, ntc, interlock
+        return decode_driver_state(self.get_driver_state())
         
     
     def driver_on(self):
         """
         Print driver on/off state specifically
         """
-        state = self.get_driver_state()
-        
-        return state[3] & 0x2
+        return decode_driver_state(self.get_driver_state())[1]
         
     
     def get_driver_value(self):
@@ -143,7 +838,10 @@ class SF8xxx:
         """
         Returns driver current measurement
         """
-        return self.__get_response('DRIVER_CURRENT_MEASURED').rtoi() / 10
+        current = self.__get_response('DRIVER_CURRENT_MEASURED').rtoi() / 10
+        if self.stats is not None:
+            self.stats.update('DRIVER_CURRENT_MEASURED', current)
+        return current
     
     
     def get_driver_current_max(self):
@@ -166,19 +864,11 @@ class SF8xxx:
             TEC, temp set, enable
             ON/OFF, INT/EXT, INT/EXT
         """
-        state = self.get_tec_state()
-        
-        tec = state[3] & 0x2
-        temp = state[3] & 0x4
-        enable = state[2] & 0x1
-        
-        return tec, temp, enable
+        return decode_tec_state(self.get_tec_state())
         
     
     def tec_on(self):
-        state = self.get_tec_state()
-        
-        return state[3] & 0x2
+        return decode_tec_state(self.get_tec_state())[0]
         
         
     def get_tec_value(self):
@@ -189,14 +879,20 @@ class SF8xxx:
     
     
     def get_tec_temperature(self):
-        return self.__get_response('TEC_TEMPERATURE_MEASURED').rtoi() / 100
+        temperature = self.__get_response('TEC_TEMPERATURE_MEASURED').rtoi() \
+            / 100
+        if self.stats is not None:
+            self.stats.update('TEC_TEMPERATURE_MEASURED', temperature)
+        return temperature
     
     
     def get_tec_current(self):
         res = self.__get_response('TEC_CURRENT_MEASURED')
-        current = res.rtoi()
+        current = res.rtoi() / 10
+        if self.stats is not None:
+            self.stats.update('TEC_CURRENT_MEASURED', current)
             
-        return current / 10
+        return current
     
     
     def get_tec_current_limit(self):
@@ -213,17 +909,7 @@ class SF8xxx:
             interlock, LD overcurrent, LD overhead, NTC, TEC error, TEC heat?
             ON/OFF, ON/OFF, ON/OFF, ON/OFF, ON/OFF, ON/OFF
         """
-        state = self.get_lock_state()
-        
-        interlock = state[3] & 0x2
-        ld_overcurrent = state[3] & 0x8
-        ld_overheat = state[2] & 0x1
-        ntc = state[2] & 0x2
-        tec_error = state[2] & 0x4
-        tec_selfheat = state[2] & 0x8
-        
-        return interlock, ld_overcurrent, ld_overheat, ntc, tec_error, \
-                tec_selfheat
+        return decode_lock_state(self.get_lock_state())
 
 
     def allow_interlock(self):
@@ -251,16 +937,23 @@ class SF8xxx:
         
   
     def __set_routine(self, parameter, value):
-        with self.__lock:
+        priority = self.__priority()
+        with self.__queue.slot(priority):
+            t0 = time.perf_counter()
             cmd = Setter(parameter, value)
             if not serial_write(self.dev, cmd.data_bytes()):
-                print("SF8xxx: Write error ", self.serial_no)
+                log.warning("Write error", extra=Log.fields(
+                    self.serial_no, parameter, time.perf_counter() - t0))
 
             res_data = serial_read(self.dev)
-            if res_data == '':
-                print("SF8xxx: Read error ", self.serial_no)
+            if not res_data:
+                log.warning("Read error", extra=Log.fields(
+                    self.serial_no, parameter, time.perf_counter() - t0))
+
+            self.__link.record(priority, 1, SET_FRAME, len(res_data),
+                               time.perf_counter() - t0)
                 
-            res = Response(res_data, 'set')
+            res = Response(res_data, 'set', self.serial_no, parameter)
             if res.state == 'error':
                 return 1
             
@@ -288,13 +981,31 @@ class SF8xxx:
             
         
     def set_driver_off(self):
-        if type(self.__set_routine('DRIVER_STATE', 0x0010)) != None:
+        with self.priority(EMERGENCY):
+            res = self.__set_routine('DRIVER_STATE', 0x0010)
+
+        if type(res) != None:
             self.driver_off = True
             return 0
         else:
             return str(self.serial_no) + "Failed to set driver off"
             
     
+    def emergency_off(self):
+        """
+        Driver off ahead of any queued reads, then read back the driver
+        state. True if the driver is confirmed off.
+        """
+        with self.priority(EMERGENCY):
+            self.set_driver_off()
+            state = self.get_driver_state()
+
+        try:
+            return not decode_driver_state(state)[1]
+        except ValueError:  # no valid reply
+            return False
+
+    
     def set_driver_current_max(self, current_mA):
         self.__set_routine('DRIVER_CURRENT_MAXIMUM', current_mA * 10)
         
@@ -343,26 +1054,18 @@ class SF8xxx:
     def poll_tec_temperature(self, tolerance, poll_interval):
         """
         Will turn off driver if the TEC temperature rises 5 deg > setpoint
-        To be run as a thread
+        To be run as a thread. Single-device Safety.RuleEngine with the
+        default rule set.
         """
-        while True:
-            if self.end_threads:
-                break
-            
-            threshold = self.temperature + tolerance
+        import Safety
 
-            temperature = self.get_tec_temperature()
-            
-            if temperature > threshold:
-                self.set_driver_off()
-                print("Device", self.serial_no,
-                      ": Temperature (" + str(temperature)
-                      + ") exceeds set threshold!!! Driver off.", end='\n')
-                print("> ", end='')
-                
-            time.sleep(poll_interval)
-            
-        sys.exit(0)
+        self.watchdog = Safety.RuleEngine({str(self.serial_no): self},
+                                          Safety.default_rules(tolerance),
+                                          interval=poll_interval)
+        if self.end_threads:
+            return
+
+        self.watchdog.run()
 
     
 class Command:
@@ -465,7 +1168,10 @@ class Response:
     """
     SF8xxx response "K" structure.
     """
-    def __init__(self, data, flag='get'):        
+    def __init__(self, data, flag='get', device=None, parameter=None):
+        """
+        device, parameter: only used to log errors
+        """
         self.data = data
         self.state = 'untested'
         
@@ -473,7 +1179,8 @@ class Response:
             if flag == 'set':
                 return
             
-            print("ERROR: Response: no data")
+            log.warning("Response: no data",
+                        extra=Log.fields(device, parameter))
             self.state = 'error'
             return
         
@@ -481,11 +1188,13 @@ class Response:
             self.state = 'error'
         
         if(self.data == b'E0000\r'):
-            print("ERROR:", self.data, "No terminator/buffer/format.")
+            log.warning("E0000 No terminator/buffer/format.",
+                        extra=Log.fields(device, parameter))
         elif(self.data == b'E0001\r'):
-            print("ERROR:", self.data, "Undefined header.")
+            log.warning("E0001 Undefined header.",
+                        extra=Log.fields(device, parameter))
         elif(self.data == b'E0002\r'):
-            print("ERROR:", self.data, "CRC.")
+            log.warning("E0002 CRC.", extra=Log.fields(device, parameter))
         
     
     def raw(self):
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+SF8xxx safety rules
+
+Rule classes: a condition on one polled sample that should turn a driver off
+RuleEngine: polls every device once per pass and evaluates the rule set
+
+Each pass reads the union of the registers the rules need, once per device,
+so adding a rule does not add serial traffic unless it needs a new register.
+
+@author: drm1g20
+"""
+
+import json
+import threading
+import time
+
+import Log
+import SF8xxx as sf8
+
+
+class Rule:
+    """
+    Base rule. check() returns a reason string if the device should trip.
+    """
+    name = 'rule'
+    parameters = ()
+
+    def __init__(self):
+        self.evaluations = 0
+        self.eval_time = 0.0  # s
+        self.trips = 0
+        self.last_latency = None  # s, sample read to driver off
+        self.max_latency = 0.0
+
+
+    def check(self, device, sample):
+        return None
+
+
+    def stats(self):
+        mean = self.eval_time / self.evaluations if self.evaluations else 0
+        return {'evaluations': self.evaluations,
+                'mean_eval_us': mean * 1e6,
+                'trips': self.trips,
+                'last_latency_ms': None if self.last_latency is None
+                                   else self.last_latency * 1e3,
+                'max_latency_ms': self.max_latency * 1e3}
+
+
+class OverTemperature(Rule):
+    """
+    TEC temperature more than tolerance above the setpoint.
+    """
+    name = 'over_temperature'
+    parameters = ('TEC_TEMPERATURE_MEASURED',)
+
+    def __init__(self, tolerance=5):
+        Rule.__init__(self)
+        self.tolerance = tolerance
+
+
+    def check(self, device, sample):
+        temperature = sample['TEC_TEMPERATURE_MEASURED']
+        if temperature is None:
+            return None
+
+        if temperature > device.temperature + self.tolerance:
+            return "Temperature (" + str(temperature) \
+                + ") exceeds set threshold!!!"
+
+
+class LockFault(Rule):
+    """
+    Any of the selected LOCK_STATE fault bits set.
+    """
+    name = 'lock_fault'
+    parameters = ('LOCK_STATE',)
+    fields = ('interlock', 'ld_overcurrent', 'ld_overheat', 'ntc',
+              'tec_error', 'tec_selfheat')
+
+    def __init__(self, flags=('ld_overcurrent', 'ld_overheat', 'tec_error')):
+        Rule.__init__(self)
+        for flag in flags:
+            if flag not in self.fields:
+                raise ValueError("Unknown lock flag " + flag)
+        self.flags = tuple(flags)
+
+
+    def check(self, device, sample):
+        state = sample['LOCK_STATE']
+        if state is None:
+            return None
+
+        bits = dict(zip(self.fields, sf8.decode_lock_state(state)))
+        tripped = [flag for flag in self.flags if bits[flag]]
+        if tripped:
+            return "Lock fault (" + ', '.join(tripped) + ")!!!"
+
+
+class TecOffDriverOn(Rule):
+    """
+    TEC has turned off while the driver is still on.
+    """
+    name = 'tec_off_driver_on'
+    parameters = ('DRIVER_STATE', 'TEC_STATE')
+
+    def check(self, device, sample):
+        driver = sample['DRIVER_STATE']
+        tec = sample['TEC_STATE']
+        if driver is None or tec is None:
+            return None
+
+        if sf8.decode_driver_state(driver)[1] and \
+                not sf8.decode_tec_state(tec)[0]:
+            return "TEC off while driver on!!!"
+
+
+class OverCurrent(Rule):
+    """
+    Driver current more than margin (mA) above the setpoint.
+    """
+    name = 'over_current'
+    parameters = ('DRIVER_CURRENT_MEASURED', 'DRIVER_CURRENT_VALUE')
+
+    def __init__(self, margin=50):
+        Rule.__init__(self)
+        self.margin = margin
+
+
+    def check(self, device, sample):
+        current = sample['DRIVER_CURRENT_MEASURED']
+        setpoint = sample['DRIVER_CURRENT_VALUE']
+        if current is None or setpoint is None:
+            return None
+
+        if current > setpoint + self.margin:
+            return "Driver current (" + str(current) \
+                + ") exceeds setpoint + " + str(self.margin) + "!!!"
+
+
+rules = {
+    OverTemperature.name: OverTemperature,
+    LockFault.name: LockFault,
+    TecOffDriverOn.name: TecOffDriverOn,
+    OverCurrent.name: OverCurrent,
+    }
+
+
+def default_rules(tolerance=5):
+    """
+    The original watchdog: over-temperature only
+    """
+    return [OverTemperature(tolerance)]
+
+
+def build_rules(config):
+    """
+    config: list of dicts, e.g. [{"rule": "over_current", "margin": 50}]
+    """
+    built = []
+    for entry in config:
+        entry = dict(entry)
+        name = entry.pop('rule')
+        if name not in rules:
+            raise ValueError("Unknown rule " + name)
+        built.append(rules[name](**entry))
+
+    return built
+
+
+def load_rules(filename):
+    with open(filename, 'r') as f:
+        return build_rules(json.load(f))
+
+
+class RuleEngine:
+    """
+    Evaluates a rule set against one sample per device per pass. Rules only
+    run while the sample shows the driver on (or its state could not be
+    read), so a condition that outlasts its trip does not trip again every
+    pass.
+    """
+    def __init__(self, devices, rules, interval=2):
+        self.devices = devices  # alias -> SF8xxx, may change while running
+        self.interval = interval
+        self.end_threads = False
+        self.listeners = []  # called as fn(alias, device, sample)
+        self.passes = 0
+        self.pass_time = 0.0
+        self.required = ()  # registers listeners need in every sample
+        self.set_rules(rules)
+
+
+    def require(self, parameters):
+        """
+        Add registers to every sample for the benefit of listeners
+        """
+        self.required = tuple(dict.fromkeys(self.required + tuple(parameters)))
+        self.set_rules(self.rules)
+
+
+    def set_rules(self, rules):
+        parameters = []
+        for rule in rules:
+            for parameter in rule.parameters:
+                if parameter not in parameters:
+                    parameters.append(parameter)
+        # the driver state arms the rules, see evaluate
+        for parameter in ('DRIVER_STATE',) + self.required:
+            if parameter not in parameters:
+                parameters.append(parameter)
+
+        # swap both together so a running pass sees a consistent pair
+        self.rules, self.parameters = list(rules), tuple(parameters)
+
+
+    def evaluate(self, alias, device, sample, t_read):
+        """
+        Run every rule on one sample, trip the driver on the first failure.
+        Nothing to do if the driver is off
+        """
+        driver = sample.get('DRIVER_STATE')
+        if driver is not None and not sf8.decode_driver_state(driver)[1]:
+            return None
+
+        for rule in self.rules:
+            t0 = time.perf_counter()
+            reason = rule.check(device, sample)
+            rule.eval_time += time.perf_counter() - t0
+            rule.evaluations += 1
+
+            if reason is None:
+                continue
+
+            device.set_driver_off()
+            latency = time.perf_counter() - t_read
+            rule.trips += 1
+            rule.last_latency = latency
+            rule.max_latency = max(rule.max_latency, latency)
+
+            sf8.log.error("(%s) %s Driver off.", alias, reason,
+                          extra=Log.fields(device.serial_no,
+                                           ', '.join(rule.parameters),
+                                           latency))
+            return rule
+
+        return None
+
+
+    def poll(self):
+        """
+        One pass over all devices
+        """
+        t_pass = time.perf_counter()
+        parameters = self.parameters
+
+        for alias, device in list(self.devices.items()):
+            if not getattr(device, 'connected', False):
+                continue
+
+            # port workers run their own engine in their own process
+            if getattr(device, 'isolated', False):
+                continue
+
+            # one device failing must not stop the watchdog for the others
+            try:
+                t_read = time.perf_counter()
+                with device.priority(sf8.WATCHDOG):
+                    sample = device.sample(parameters)
+                self.evaluate(alias, device, sample, t_read)
+            except Exception as e:
+                sf8.log.error("(%s) Watchdog poll failed: %r", alias, e,
+                              extra=Log.fields(getattr(device, 'serial_no',
+                                                       None)))
+                continue
+
+            for listener in self.listeners:
+                try:
+                    listener(alias, device, sample)
+                except Exception as e:
+                    sf8.log.error("(%s) Listener %s failed: %r", alias,
+                                  getattr(listener, '__qualname__', listener),
+                                  e, extra=Log.fields(device.serial_no))
+
+        self.passes += 1
+        self.pass_time += time.perf_counter() - t_pass
+
+
+    def run(self):
+        """
+        To be run as a thread
+        """
+        while not self.end_threads:
+            t0 = time.perf_counter()
+            self.poll()
+            elapsed = time.perf_counter() - t0
+            time.sleep(max(0, self.interval - elapsed))
+
+
+    def start(self):
+        self.run_thread = threading.Thread(target=self.run, daemon=True)
+        self.run_thread.start()
+
+
+    def stats(self):
+        return {rule.name: rule.stats() for rule in self.rules}
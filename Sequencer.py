@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Sequenced power-up (fibre amplifier pump order)
+
+Every device has two stages: 'tec' (TEC on, temperature settled) then
+'driver' (driver on, current settled). A device's driver stage also waits
+for the driver stages of the devices listed in its "after" config key.
+Stages start as soon as their dependencies are done, so independent
+branches run in parallel, and each stage ends when the measured value has
+settled rather than after a fixed sleep.
+
+Config (the same JSON file as `load`), per device:
+    "tec_temperature": 25        TEC setpoint, C (optional)
+    "driver_current": 300        driver setpoint, mA (optional)
+    "after": ["a"]               driver after these drivers are stable
+    "tec_tolerance", "tec_hold", "tec_timeout",
+    "current_tolerance", "current_hold", "current_timeout"  (optional)
+
+@author: drm1g20
+"""
+
+import json
+import threading
+import time
+
+defaults = {
+    'tec_tolerance': 0.5,       # C
+    'tec_hold': 2,              # s
+    'tec_timeout': 120,         # s
+    'current_tolerance': 5,     # mA
+    'current_hold': 1,          # s
+    'current_timeout': 30,      # s
+    }
+
+
+class Stage:
+    def __init__(self, alias, kind, deps):
+        self.alias = alias
+        self.kind = kind
+        self.deps = deps
+        self.start = None
+        self.end = None
+        self.error = None
+
+    def name(self):
+        return self.alias + '.' + self.kind
+
+
+class Sequencer:
+    """
+    Brings up devices in dependency order.
+    """
+    def __init__(self, devices, config, cancel=None):
+        self.devices = devices  # alias -> SF8xxx
+        self.config = config    # alias -> device config dict
+        self.cancel = cancel    # optional threading.Event
+        self.stages = {}
+        self.abort = False
+        self.stop = threading.Event()  # set on abort: ends every stage's wait
+        self.__plan()
+
+
+    @classmethod
+    def from_file(cls, devices, filename, cancel=None):
+        with open(filename, 'r') as f:
+            return cls(devices, json.load(f), cancel)
+
+
+    def __option(self, alias, key):
+        return float(self.config[alias].get(key, defaults[key]))
+
+
+    def __plan(self):
+        for alias, cfg in self.config.items():
+            if alias not in self.devices:
+                raise ValueError("Device " + alias + " not connected")
+            for other in cfg.get('after', []):
+                if other not in self.config:
+                    raise ValueError(alias + " after unknown device " + other)
+
+            tec = Stage(alias, 'tec', [])
+            driver = Stage(alias, 'driver', [tec.name()] +
+                           [other + '.driver' for other in cfg.get('after', [])])
+            self.stages[tec.name()] = tec
+            self.stages[driver.name()] = driver
+
+        # reject cycles before anything is switched on
+        state = {}
+
+        def visit(name):
+            if state.get(name) == 'open':
+                raise ValueError("Dependency cycle through " + name)
+            if state.get(name) == 'done':
+                return
+            state[name] = 'open'
+            for dep in self.stages[name].deps:
+                visit(dep)
+            state[name] = 'done'
+
+        for name in self.stages:
+            visit(name)
+
+
+    def __check_cancel(self):
+        """
+        Last check before switching anything on
+        """
+        if self.cancel is not None and self.cancel.is_set():
+            raise RuntimeError("Cancelled")
+        if self.stop.is_set():
+            raise RuntimeError("Aborted, another stage failed")
+
+
+    def __run_tec(self, stage):
+        alias = stage.alias
+        dev = self.devices[alias]
+        cfg = self.config[alias]
+
+        if 'tec_temperature' in cfg:
+            dev.set_tec_temperature(int(cfg['tec_temperature']))
+        self.__check_cancel()
+        if dev.set_tec_on():
+            raise RuntimeError("TEC would not turn on. Interlock?")
+
+        if dev.wait_until_settled('TEC_TEMPERATURE_MEASURED',
+                                  self.__option(alias, 'tec_tolerance'),
+                                  self.__option(alias, 'tec_hold'),
+                                  self.__option(alias, 'tec_timeout'),
+                                  cancel=self.stop) is None:
+            self.__check_cancel()
+            raise RuntimeError("TEC temperature did not settle")
+
+
+    def __run_driver(self, stage):
+        alias = stage.alias
+        dev = self.devices[alias]
+        cfg = self.config[alias]
+
+        if 'driver_current' in cfg:
+            dev.set_driver_current(int(cfg['driver_current']))
+        self.__check_cancel()
+        if dev.set_driver_on():
+            raise RuntimeError("Driver would not turn on")
+
+        if dev.wait_until_settled('DRIVER_CURRENT_MEASURED',
+                                  self.__option(alias, 'current_tolerance'),
+                                  self.__option(alias, 'current_hold'),
+                                  self.__option(alias, 'current_timeout'),
+                                  cancel=self.stop) is None:
+            self.__check_cancel()
+            raise RuntimeError("Driver current did not settle")
+
+
+    def __run_stage(self, stage, finished):
+        stage.start = time.perf_counter()
+        try:
+            if stage.kind == 'tec':
+                self.__run_tec(stage)
+            else:
+                self.__run_driver(stage)
+        except Exception as e:
+            stage.error = str(e)
+            if stage.kind == 'driver':
+                self.devices[stage.alias].set_driver_off()
+
+        with finished:
+            stage.end = time.perf_counter()
+            finished.notify()
+
+
+    def run(self):
+        """
+        Run all stages. True if every stage completed. On a failure or
+        cancel no stage starts, and running ones stop waiting (a driver
+        stage then turns its driver off).
+        """
+        self.t0 = time.perf_counter()
+        finished = threading.Condition()
+        pending = dict(self.stages)
+        running = {}
+        done = set()
+
+        with finished:
+            while pending or running:
+                if self.cancel is not None and self.cancel.is_set():
+                    self.abort = True
+
+                for name, stage in list(running.items()):
+                    if stage.end is None:
+                        continue
+                    del running[name]
+                    if stage.error:
+                        self.abort = True
+                    else:
+                        done.add(name)
+                if self.abort:
+                    self.stop.set()
+
+                if not self.abort:
+                    for name, stage in list(pending.items()):
+                        if all(dep in done for dep in stage.deps):
+                            del pending[name]
+                            running[name] = stage
+                            threading.Thread(target=self.__run_stage,
+                                             args=(stage, finished),
+                                             daemon=True).start()
+                elif not running:
+                    break
+
+                if running:
+                    # short, so a cancel reaches the stages promptly
+                    finished.wait(0.2)
+
+        self.t_end = time.perf_counter()
+        return not self.abort
+
+
+    def report(self):
+        """
+        Lines of: stage, start and end relative to run start, duration
+        """
+        lines = []
+        ordered = sorted(self.stages.values(),
+                         key=lambda s: (s.start is None, s.start or 0))
+        for stage in ordered:
+            if stage.start is None:
+                lines.append("%-16s not started" % stage.name())
+                continue
+
+            line = "%-16s %7.2f s -> %7.2f s  (%.2f s)" % (
+                stage.name(), stage.start - self.t0, stage.end - self.t0,
+                stage.end - stage.start)
+            if stage.error:
+                line += "  FAILED: " + stage.error
+            lines.append(line)
+
+        lines.append("Total %.2f s" % (self.t_end - self.t0))
+        return lines
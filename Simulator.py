@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""
+Virtual SF8xxx fleet
+
+Board: register model of one SF8xxx (thermal model, driver current,
+state/lock bits as SF8xxx decodes them) with fault injection
+Simulator: N boards on pseudo-terminals served by one selector thread
+
+Physical state is advanced analytically when a register is read, so idle
+boards cost nothing and hundreds fit in one process. Point SF8xxx (or
+`load`) at Board.port like any serial device.
+
+python Simulator.py [N] [config.json] - run N boards, write a load config
+
+pySerial waits with select(), which cannot watch fds above 1023, and each
+serial.Serial holds five fds. For more than ~100 boards run the simulator
+in its own process and point the client at the config it writes.
+
+Faults (Board.inject):
+    drop        no reply
+    delay       reply after `value` seconds
+    error       reply `value` (b'E0000\\r', b'E0001\\r', b'E0002\\r')
+    garbage     random bytes before the reply
+    tec_off     TEC shuts down with a TEC error (once, now)
+    overheat    LD overheat lock bit (once, now)
+
+@author: drm1g20
+"""
+
+import heapq
+import json
+import math
+import os
+import pty
+import random
+import selectors
+import sys
+import threading
+import time
+import tty
+
+from SF8xxx import Command
+
+# parameter hex code -> name
+names = {code: name for name, code in Command().parameters.items()}
+
+# DRIVER_STATE bits
+DEVICE_ON = 0x0001
+DRIVER_ON = 0x0002
+CURRENT_INT = 0x0004
+ENABLE_INT = 0x0010
+NTC_DENY = 0x0040
+INTERLOCK_DENY = 0x0080
+
+# TEC_STATE bits
+TEC_ON = 0x0002
+TEMP_INT = 0x0004
+TEC_ENABLE_INT = 0x0010
+
+# LOCK_STATE bits
+LOCK_INTERLOCK = 0x0002
+LOCK_LD_OVERCURRENT = 0x0008
+LOCK_LD_OVERHEAT = 0x0010
+LOCK_NTC = 0x0020
+LOCK_TEC_ERROR = 0x0040
+LOCK_TEC_SELFHEAT = 0x0080
+
+
+class Board:
+    """
+    One simulated SF8xxx. Register values are in raw device units.
+    """
+    def __init__(self, serial_no, ambient=22.0, tau_tec=5.0, tau_current=0.2,
+                 seed=None):
+        self.serial_no = serial_no
+        self.ambient = ambient
+        self.tau_tec = tau_tec          # s
+        self.tau_current = tau_current  # s
+        self.heating = 0.01             # C per mA with the TEC off
+        self.random = random.Random(seed if seed is not None else serial_no)
+
+        self.driver_state = DEVICE_ON
+        self.tec_state = 0
+        self.lock_state = 0
+        self.registers = {
+            'DRIVER_CURRENT_VALUE': 1000,
+            'DRIVER_CURRENT_MAXIMUM': 3500,
+            'DRIVER_CURRENT_MAXIMUM_LIMIT': 15000,
+            'TEC_TEMPERATURE_VALUE': 2500,
+            'TEC_TEMPERATURE_MAXIMUM': 4000,
+            'TEC_TEMPERATURE_MAXIMUM_LIMIT': 5000,
+            'TEC_CURRENT_LIMIT': 20,
+            'PID_P': 100,
+            'PID_I': 10,
+            'PID_D': 0,
+            'SERIAL_NO': serial_no & 0xFFFF,
+            }
+        self.temperature = ambient  # C
+        self.current = 0.0          # mA
+        self.t = time.monotonic()
+        self.faults = {}            # kind -> [probability, count, value]
+        self.requests = 0
+
+        self.port = None
+        self.master = None
+        self.slave = None
+        self.buffer = b''
+
+
+    # physics
+
+    def __advance(self):
+        now = time.monotonic()
+        dt = now - self.t
+        self.t = now
+        if dt <= 0:
+            return
+
+        driver_on = self.driver_state & DRIVER_ON
+        target = self.registers['DRIVER_CURRENT_VALUE'] / 10 if driver_on \
+            else 0.0
+        target = min(target, self.registers['DRIVER_CURRENT_MAXIMUM'] / 10)
+        self.current = target + (self.current - target) * \
+            math.exp(-dt / self.tau_current)
+
+        if self.tec_state & TEC_ON:
+            eq = self.registers['TEC_TEMPERATURE_VALUE'] / 100
+        else:
+            eq = self.ambient + self.heating * self.current
+        self.temperature = eq + (self.temperature - eq) * \
+            math.exp(-dt / self.tau_tec)
+
+
+    def read(self, name):
+        self.__advance()
+        if name == 'DRIVER_STATE':
+            return self.driver_state
+        if name == 'TEC_STATE':
+            return self.tec_state
+        if name == 'LOCK_STATE':
+            return self.lock_state
+        if name == 'DRIVER_CURRENT_MEASURED':
+            return round(self.current * 10)
+        if name == 'DRIVER_VOLTAGE_MEASURED':
+            return round((1.5 + 0.002 * self.current) * 100) \
+                if self.current > 0.05 else 0
+        if name == 'TEC_TEMPERATURE_MEASURED':
+            return round(max(self.temperature, 0) * 100)
+        if name == 'TEC_CURRENT_MEASURED':
+            if not self.tec_state & TEC_ON:
+                return 0
+            error = abs(self.temperature - self.ambient)
+            return min(round(error * 0.8 + 2), self.registers['TEC_CURRENT_LIMIT'])
+        if name == 'TEC_VOLTAGE_MEASURED':
+            return round(self.read('TEC_CURRENT_MEASURED') * 12.5) \
+                if self.tec_state & TEC_ON else 0
+        return self.registers[name]
+
+
+    def write(self, name, value):
+        self.__advance()
+        if name == 'DRIVER_STATE':
+            if value == 0x0008:
+                self.driver_state |= DRIVER_ON
+            elif value == 0x0010:
+                self.driver_state &= ~DRIVER_ON
+            elif value == 0x0020:
+                self.driver_state |= CURRENT_INT
+            elif value == 0x0400:
+                self.driver_state |= ENABLE_INT
+            elif value == 0x1000:
+                self.driver_state &= ~INTERLOCK_DENY
+            elif value == 0x2000:
+                self.driver_state |= INTERLOCK_DENY
+            elif value == 0x4000:
+                self.driver_state |= NTC_DENY
+            return self.driver_state
+
+        if name == 'TEC_STATE':
+            if value == 0x0008:
+                if not self.lock_state & LOCK_TEC_ERROR:
+                    self.tec_state |= TEC_ON
+            elif value == 0x0010:
+                self.tec_state &= ~TEC_ON
+            elif value == 0x0020:
+                self.tec_state |= TEMP_INT
+            elif value == 0x0400:
+                self.tec_state |= TEC_ENABLE_INT
+            return self.tec_state
+
+        if name == 'DRIVER_CURRENT_VALUE':
+            value = min(value, self.registers['DRIVER_CURRENT_MAXIMUM'])
+        elif name == 'DRIVER_CURRENT_MAXIMUM':
+            value = min(value, self.registers['DRIVER_CURRENT_MAXIMUM_LIMIT'])
+        elif name == 'TEC_TEMPERATURE_VALUE':
+            value = min(value, self.registers['TEC_TEMPERATURE_MAXIMUM'])
+        elif name not in self.registers or name in (
+                'SERIAL_NO', 'DRIVER_CURRENT_MAXIMUM_LIMIT',
+                'TEC_TEMPERATURE_MAXIMUM_LIMIT'):
+            return None  # read only
+
+        self.registers[name] = value
+        return value
+
+
+    # faults
+
+    def inject(self, kind, probability=1.0, count=None, value=None):
+        """
+        count: number of times to fire (None: until cleared)
+        """
+        if kind == 'tec_off':
+            self.tec_state &= ~TEC_ON
+            self.lock_state |= LOCK_TEC_ERROR
+            return
+        if kind == 'overheat':
+            self.lock_state |= LOCK_LD_OVERHEAT
+            return
+        if kind not in ('drop', 'delay', 'error', 'garbage'):
+            raise ValueError("Unknown fault " + kind)
+
+        self.faults[kind] = [probability, count, value]
+
+
+    def clear(self, kind=None):
+        if kind is None:
+            self.faults.clear()
+            self.lock_state = 0
+        else:
+            self.faults.pop(kind, None)
+
+
+    def __fires(self, kind):
+        fault = self.faults.get(kind)
+        if fault is None or self.random.random() >= fault[0]:
+            return None
+
+        if fault[1] is not None:
+            fault[1] -= 1
+            if fault[1] <= 0:
+                del self.faults[kind]
+        return fault
+
+
+    # protocol
+
+    def handle(self, frame):
+        """
+        One request frame (without terminator) -> (reply bytes or None,
+        delay s)
+        """
+        self.requests += 1
+        if self.__fires('drop'):
+            return None, 0
+
+        delay = 0
+        fault = self.__fires('delay')
+        if fault:
+            delay = fault[2] if fault[2] is not None else 0.5
+
+        fault = self.__fires('error')
+        if fault:
+            return fault[2] or b'E0002\r', delay
+
+        reply = self.__reply(frame)
+        if self.__fires('garbage'):
+            reply = bytes(self.random.randrange(256)
+                          for i in range(self.random.randrange(1, 8))) + reply
+        return reply, delay
+
+
+    def __reply(self, frame):
+        if len(frame) not in (5, 10) or frame[:1] not in (b'J', b'P'):
+            return b'E0000\r'
+
+        code = frame[1:5].decode('ascii', 'replace')
+        name = names.get(code)
+        if name is None:
+            return b'E0001\r'
+
+        if frame[:1] == b'J':
+            value = self.read(name)
+        else:
+            if frame[5:6] != b' ':
+                return b'E0000\r'
+            try:
+                value = int(frame[6:10], 16)
+            except ValueError:
+                return b'E0000\r'
+            value = self.write(name, value)
+            if value is None:
+                return b'E0001\r'
+
+        return b'K' + code.encode('ascii') + b' ' + \
+            ('%04X' % (value & 0xFFFF)).encode('ascii') + b'\r'
+
+
+class Simulator:
+    """
+    A fleet of boards on pseudo-terminals, served by one thread.
+    """
+    def __init__(self, n=0, first_serial=1000):
+        self.boards = []
+        self.selector = selectors.DefaultSelector()
+        self.timers = []  # (due, seq, board, reply)
+        self.seq = 0
+        self.end_threads = False
+        self.__lock = threading.Lock()
+        self.__wake_r, self.__wake_w = os.pipe()
+        os.set_blocking(self.__wake_r, False)
+        self.selector.register(self.__wake_r, selectors.EVENT_READ, None)
+
+        for i in range(n):
+            self.add(Board(first_serial + i))
+
+
+    def add(self, board):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        os.set_blocking(master, False)
+        board.master, board.slave = master, slave
+        board.port = os.ttyname(slave)
+        with self.__lock:
+            self.boards.append(board)
+            self.selector.register(master, selectors.EVENT_READ, board)
+        self.__wake()
+        return board
+
+
+    def __wake(self):
+        os.write(self.__wake_w, b'x')
+
+
+    def start(self):
+        self.run_thread = threading.Thread(target=self.run, daemon=True)
+        self.run_thread.start()
+        return self
+
+
+    def stop(self):
+        self.end_threads = True
+        self.__wake()
+        self.run_thread.join()
+        for board in self.boards:
+            self.selector.unregister(board.master)
+            os.close(board.master)
+            os.close(board.slave)
+        self.selector.unregister(self.__wake_r)
+        os.close(self.__wake_r)
+        os.close(self.__wake_w)
+        self.selector.close()
+
+
+    def __send(self, board, reply):
+        try:
+            os.write(board.master, reply)
+        except OSError:
+            pass
+
+
+    def run(self):
+        while not self.end_threads:
+            timeout = None
+            if self.timers:
+                timeout = max(0, self.timers[0][0] - time.monotonic())
+
+            for key, events in self.selector.select(timeout):
+                board = key.data
+                if board is None:
+                    os.read(self.__wake_r, 512)
+                    continue
+
+                try:
+                    data = os.read(board.master, 4096)
+                except OSError:
+                    continue
+                board.buffer += data
+                while b'\r' in board.buffer:
+                    frame, board.buffer = board.buffer.split(b'\r', 1)
+                    reply, delay = board.handle(frame)
+                    if reply is None:
+                        continue
+                    if delay:
+                        self.seq += 1
+                        heapq.heappush(self.timers, (time.monotonic() + delay,
+                                                     self.seq, board, reply))
+                    else:
+                        self.__send(board, reply)
+
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                due, seq, board, reply = heapq.heappop(self.timers)
+                self.__send(board, reply)
+
+
+    def config(self, prefix='sim', driver_current_max=350,
+               tec_temperature=25):
+        """
+        Config dict in the `load` format
+        """
+        return {prefix + str(i): {'devpath': board.port,
+                                  'driver_current_max': driver_current_max,
+                                  'tec_temperature': tec_temperature}
+                for i, board in enumerate(self.boards)}
+
+
+    def write_config(self, filename, **kwargs):
+        with open(filename, 'w') as f:
+            json.dump(self.config(**kwargs), f, indent=2)
+
+
+def main(argv):
+    n = int(argv[0]) if argv else 2
+    sim = Simulator(n).start()
+    for board in sim.boards:
+        print(board.serial_no, board.port)
+    if len(argv) > 1:
+        sim.write_config(argv[1])
+        print("Wrote", argv[1])
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Register map snapshots
+
+take: every register in Command.parameters, one pipelined burst per
+device, devices in parallel
+restore: read back the writable registers and write only those that
+differ from the snapshot, again one burst per device, in parallel
+
+File (JSON), register values raw as on the wire:
+    {alias: {"serial_no": n, "time": unix time,
+             "registers": {"DRIVER_CURRENT_VALUE": "0BB8", ...}}}
+A failed read is stored as null and never restored. A device that could
+not be read at all (e.g. its port worker timed out) gets every register
+null and an "error" field.
+
+@author: drm1g20
+"""
+
+import json
+import threading
+import time
+
+import SF8xxx as sf8
+
+
+def parallel(devices, fn):
+    """
+    fn(alias, device) for every device in its own thread -> {alias: result},
+    the exception instead for a device where fn raised
+    """
+    results = {}
+
+    def run(alias, dev):
+        try:
+            results[alias] = fn(alias, dev)
+        except Exception as e:
+            results[alias] = e
+
+    threads = [threading.Thread(target=run, args=(alias, dev), daemon=True)
+               for alias, dev in devices.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {alias: results[alias] for alias in devices}
+
+
+def take(devices):
+    """
+    Snapshot dict for devices (alias -> SF8xxx)
+    """
+    def snap(alias, dev):
+        registers = dev.read_registers()
+        return {'serial_no': dev.serial_no,
+                'time': time.time(),
+                'registers': {parameter: None if value is None
+                              else '%04X' % value
+                              for parameter, value in registers.items()}}
+
+    snapshot = parallel(devices, snap)
+    for alias, entry in snapshot.items():
+        if isinstance(entry, Exception):
+            snapshot[alias] = {'serial_no': devices[alias].serial_no,
+                               'time': time.time(),
+                               'registers': dict.fromkeys(
+                                   sf8.Command().parameters),
+                               'error': str(entry) or type(entry).__name__}
+
+    return snapshot
+
+
+def save(filename, snapshot):
+    with open(filename, 'w') as f:
+        json.dump(snapshot, f, indent=1)
+
+
+def load(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def entry_for(snapshot, alias):
+    """
+    The snapshot entry to restore onto alias: its own, or the only entry
+    in the file (cloning one board onto others)
+    """
+    if alias in snapshot:
+        return snapshot[alias]
+    if len(snapshot) == 1:
+        return next(iter(snapshot.values()))
+    return None
+
+
+def restore(devices, snapshot):
+    """
+    Write the writable registers that differ from the snapshot.
+    Returns {alias: (written, unchanged, failed)} with written and failed
+    lists of register names, None for a device with no entry, or the
+    exception that stopped the restore of a device (what was written
+    before it is unknown)
+    """
+    def push(alias, dev):
+        entry = entry_for(snapshot, alias)
+        if entry is None:
+            return None
+
+        wanted = {parameter: int(value, 16)
+                  for parameter, value in entry['registers'].items()
+                  if parameter in sf8.writable and value is not None}
+        # keep the maxima-first order
+        wanted = {parameter: wanted[parameter] for parameter in sf8.writable
+                  if parameter in wanted}
+
+        current = dev.read_registers(list(wanted))
+        changes = {parameter: value for parameter, value in wanted.items()
+                   if current[parameter] != value}
+        failed = dev.write_registers(changes) if changes else []
+
+        return ([parameter for parameter in changes if parameter not in failed],
+                len(wanted) - len(changes), failed)
+
+    return parallel(devices, push)
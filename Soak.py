@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Long-run soak test
+
+Drives a Console through thousands of dial / query / hang-up cycles against
+simulated boards (Simulator.py), feeding it one command at a time, and
+samples the process every `every` cycles: RSS, the traced Python heap
+(tracemalloc), live threads and open file descriptors. The sample taken
+after `warmup` cycles is the baseline; the run fails when, at the end, any
+of them has grown past its limit, and lists the allocation sites that grew
+most.
+
+    python Soak.py [--cycles 2000] [--devices 4] [--every 100]
+                   [--warmup 100] [--rss MB] [--heap KB] [--threads N]
+                   [--fds N] [--isolate]
+
+Exits 1 on growth. Reads /proc/self, so Linux only.
+
+@author: drm1g20
+"""
+
+import gc
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import Simulator
+
+# allowed growth from the baseline to the end of the run
+LIMITS = {'rss': 20 * 1024,     # kB
+          'heap': 1024,         # kB
+          'threads': 0,
+          'fds': 0}
+
+# per device and cycle, between dial and hangup
+QUERIES = ('qrd', 'tec stat', 'dri stat', 'lock', 'max', 'stats')
+
+
+def rss():
+    """
+    Resident set size, kB
+    """
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def sample(cycle):
+    gc.collect()
+    return {'cycle': cycle, 'time': time.perf_counter(), 'rss': rss(),
+            'heap': tracemalloc.get_traced_memory()[0] // 1024,
+            'threads': threading.active_count(), 'fds': fds()}
+
+
+def run(cycles=2000, devices=4, every=100, warmup=100, isolate=False,
+        out=sys.stdout):
+    """
+    -> (samples, tracemalloc statistics that grew most since the baseline)
+    """
+    import Console
+
+    sim = Simulator.Simulator(devices).start()
+    ports = [('s' + str(i), board.port) for i, board in enumerate(sim.boards)]
+    directory = tempfile.TemporaryDirectory()
+    samples = []
+    baseline = []
+
+    def log(s):
+        out.write("%6d %9.1f %9.1f %8d %6d %8.1f\n"
+                  % (s['cycle'], s['rss'] / 1024, s['heap'] / 1024,
+                     s['threads'], s['fds'], len(samples) > 1 and
+                     (s['cycle'] - samples[-2]['cycle'])
+                     / (s['time'] - samples[-2]['time']) or 0))
+        out.flush()
+
+    def commands():
+        for cycle in range(1, cycles + 1):
+            for alias, port in ports:
+                yield 'dial ' + port + ' ' + alias
+            for query in QUERIES:
+                for alias, port in ports:
+                    yield query + ' ' + alias
+            for alias, port in ports:
+                yield 'hangup ' + alias
+
+            # resumed once the last hangup has returned
+            if cycle == warmup:
+                samples.append(sample(cycle))
+                baseline.append(tracemalloc.take_snapshot())
+                log(samples[-1])
+            elif cycle % every == 0 or cycle == cycles:
+                samples.append(sample(cycle))
+                log(samples[-1])
+        yield 'exit'
+
+    out.write("% 6s %9s %9s %8s %6s %8s\n" % ('cycle', 'rss MB', 'heap MB',
+                                              'threads', 'fds', 'cycles/s'))
+    tracemalloc.start()
+    feed = commands()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        Console.Console(os.path.join(directory.name, 'status'), isolate=isolate,
+                        source=lambda: next(feed))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        sim.stop()
+        directory.cleanup()
+
+    grown = []
+    if baseline:
+        grown = tracemalloc.take_snapshot().compare_to(baseline[0], 'lineno')
+    tracemalloc.stop()
+    return samples, grown
+
+
+def check(samples, limits=LIMITS):
+    """
+    -> [(measure, growth, limit)] over the limit, from the baseline (first
+    sample) to the last
+    """
+    if len(samples) < 2:
+        return []
+    first, last = samples[0], samples[-1]
+    return [(measure, last[measure] - first[measure], limit)
+            for measure, limit in limits.items()
+            if last[measure] - first[measure] > limit]
+
+
+def main(args):
+    options = {'cycles': 2000, 'devices': 4, 'every': 100, 'warmup': 100,
+               'isolate': False}
+    limits = dict(LIMITS)
+    while args:
+        arg = args.pop(0)
+        if arg == '--isolate':
+            options['isolate'] = True
+        elif arg[2:] in options:
+            options[arg[2:]] = int(args.pop(0))
+        elif arg == '--rss':
+            limits['rss'] = float(args.pop(0)) * 1024
+        elif arg[2:] in limits:
+            limits[arg[2:]] = float(args.pop(0))
+        else:
+            print("Usage: python Soak.py [--cycles N] [--devices N] "
+                  "[--every N] [--warmup N] [--rss MB] [--heap KB] "
+                  "[--threads N] [--fds N] [--isolate]")
+            return 2
+
+    options['warmup'] = min(options['warmup'], options['cycles'])
+    samples, grown = run(**options)
+
+    print("Top growth since cycle", samples[0]['cycle'] if samples else 0)
+    for stat in grown[:10]:
+        print("\t%+9.1f kB %+7d blocks  %s" % (stat.size_diff / 1024,
+                                               stat.count_diff,
+                                               stat.traceback))
+
+    failed = check(samples, limits)
+    for measure, growth, limit in failed:
+        print("FAIL: %s grew by %g (limit %g)" % (measure, growth, limit))
+    if not failed:
+        print("OK: no growth over the limits in", options['cycles'],
+              "cycles")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
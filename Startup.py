@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Startup: lazy modules, the startup trace and its benchmark
+
+Lazy: stands in for a module until one of its attributes is first used, so
+the console imports pyserial, logging, http.server, multiprocessing... only
+for the commands that need them.
+trace: with `SF8xxx-controller.py --trace`, milestones (prompt, first
+device) go to stderr as
+
+    [STARTUP]: prompt 48.1 ms
+
+measured from launch when the launcher put its time.time() in SF8_LAUNCH,
+else from this module's import.
+
+    python Startup.py [--runs 5] [--prompt ms] [--device ms]
+
+launches the controller against one simulated board `runs` times, dials it,
+and exits non-zero when the median time to prompt or to the first device is
+over budget.
+
+@author: drm1g20
+"""
+
+import importlib
+import os
+import sys
+import time
+
+# budgets, ms from launch
+PROMPT = 100
+DEVICE = 250
+
+T0 = time.time()
+if 'SF8_LAUNCH' in os.environ:
+    try:
+        T0 = float(os.environ['SF8_LAUNCH'])
+    except ValueError:
+        pass
+
+enabled = False
+marks = {}  # milestone -> ms from launch
+
+
+class Lazy:
+    """
+    A module, imported on first attribute access.
+    """
+    def __init__(self, name):
+        self.__name = name
+
+
+    def __getattr__(self, attr):
+        # import_module holds the import lock, and is a dict lookup once
+        # the module is loaded
+        return getattr(importlib.import_module(self.__name), attr)
+
+
+    def __repr__(self):
+        return '<lazy module ' + repr(self.__name) + '>'
+
+
+def mark(milestone):
+    """
+    Record a milestone the first time it is reached
+    """
+    if milestone in marks:
+        return
+    marks[milestone] = (time.time() - T0) * 1e3
+    if enabled:
+        sys.stderr.write("[STARTUP]: %s %.1f ms\n" % (milestone,
+                                                     marks[milestone]))
+        sys.stderr.flush()
+
+
+def _launch(config, logfile):
+    """
+    One controller run: dial the simulated board, exit -> {milestone: ms}
+    """
+    import json
+    import subprocess
+
+    with open(config, 'r') as f:
+        devpath = next(iter(json.load(f).values()))['devpath']
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, SF8_LAUNCH=repr(time.time()))
+    run = subprocess.run([sys.executable,
+                          os.path.join(here, 'SF8xxx-controller.py'),
+                          '--trace', logfile],
+                         input='dial ' + devpath + ' a\nexit\n', env=env,
+                         capture_output=True, text=True, timeout=60)
+
+    times = {}
+    for line in run.stderr.splitlines():
+        if line.startswith('[STARTUP]: '):
+            milestone, ms, unit = line[len('[STARTUP]: '):].rsplit(' ', 2)
+            times[milestone] = float(ms)
+    return times
+
+
+def main(args):
+    import statistics
+    import tempfile
+
+    import Simulator
+
+    runs = 5
+    budget = {'prompt': PROMPT, 'first device': DEVICE}
+    while args:
+        arg = args.pop(0)
+        if arg == '--runs':
+            runs = int(args.pop(0))
+        elif arg == '--prompt':
+            budget['prompt'] = float(args.pop(0))
+        elif arg == '--device':
+            budget['first device'] = float(args.pop(0))
+        else:
+            print("Usage: python Startup.py [--runs N] [--prompt ms] "
+                  "[--device ms]")
+            return 2
+
+    sim = Simulator.Simulator(1).start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            config = os.path.join(directory, 'startup.json')
+            sim.write_config(config)
+            results = [_launch(config, os.path.join(directory, 'status'))
+                       for i in range(runs)]
+    finally:
+        sim.stop()
+
+    failed = False
+    for milestone, limit in budget.items():
+        times = [r[milestone] for r in results if milestone in r]
+        if len(times) < runs:
+            print(milestone + ": not reached in", runs - len(times), "runs")
+            failed = True
+            continue
+        median = statistics.median(times)
+        over = median > limit
+        failed = failed or over
+        print("%s: median %.1f ms, min %.1f, max %.1f, budget %.0f ms%s"
+              % (milestone, median, min(times), max(times), limit,
+                 " OVER BUDGET" if over else ""))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
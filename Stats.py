@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Online statistics and drift detection for polled measurements
+
+Running: constant-memory statistics for one register of one device: EWMA,
+Welford mean/variance, min/max, plus a two-sided CUSUM against a baseline
+learned over the first `warmup` samples. A CUSUM alarm or a sample more than
+`band` sigma from the baseline raises an event once, then the baseline is
+relearned, so a step change is reported once rather than on every poll.
+DeviceStats: the Running objects of one device, fed by SF8xxx's measurement
+getters and sample() once attached (SF8xxx.stats)
+Stats: all devices, event listeners, and the measured cost per update
+
+Every update is O(1) in time and memory.
+
+@author: drm1g20
+"""
+
+import collections
+import math
+import threading
+import time
+
+import SF8xxx as sf8
+
+TRACKED = ('TEC_TEMPERATURE_MEASURED', 'TEC_CURRENT_MEASURED',
+           'DRIVER_CURRENT_MEASURED')
+
+
+class Running:
+    """
+    Statistics and drift detector for one register.
+    """
+    __slots__ = ('alpha', 'warmup', 'k', 'h', 'band', 'resolution', 'n',
+                 'mean', 'm2', 'ewma', 'min', 'max', 'base_n', 'base_mean',
+                 'base_m2', 'sigma', 'pos', 'neg')
+
+    def __init__(self, resolution, alpha=0.1, warmup=60, k=0.5, h=10, band=5):
+        self.alpha = alpha              # EWMA weight of a new sample
+        self.warmup = warmup            # samples to learn the baseline
+        self.k = k                      # CUSUM slack, sigma
+        self.h = h                      # CUSUM alarm threshold, sigma
+        self.band = band                # out of band, sigma
+        self.resolution = resolution    # sigma floor: one register LSB
+        self.reset()
+
+
+    def reset(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.ewma = None
+        self.min = math.inf
+        self.max = -math.inf
+        self.rebase()
+
+
+    def rebase(self):
+        self.base_n = 0
+        self.base_mean = 0.0
+        self.base_m2 = 0.0
+        self.sigma = None
+        self.pos = 0.0
+        self.neg = 0.0
+
+
+    def update(self, x):
+        """
+        Returns None, or the kind of event: 'drift up', 'drift down',
+        'out of band'
+        """
+        # Welford
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+        self.ewma = x if self.ewma is None else \
+            self.ewma + self.alpha * (x - self.ewma)
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+
+        if self.sigma is None:
+            self.base_n += 1
+            delta = x - self.base_mean
+            self.base_mean += delta / self.base_n
+            self.base_m2 += delta * (x - self.base_mean)
+            if self.base_n >= self.warmup:
+                self.sigma = max(math.sqrt(self.base_m2 / (self.base_n - 1)),
+                                 self.resolution)
+            return None
+
+        z = (x - self.base_mean) / self.sigma
+        self.pos = max(0.0, self.pos + z - self.k)
+        self.neg = max(0.0, self.neg - z - self.k)
+
+        if abs(z) > self.band:
+            return 'out of band'
+        if self.pos > self.h:
+            return 'drift up'
+        if self.neg > self.h:
+            return 'drift down'
+        return None
+
+
+    def std(self):
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+
+    def summary(self):
+        return {'n': self.n, 'mean': self.mean, 'std': self.std(),
+                'ewma': self.ewma, 'min': self.min, 'max': self.max,
+                'baseline': self.base_mean if self.sigma else None,
+                'sigma': self.sigma}
+
+
+class DeviceStats:
+    """
+    Running statistics of the tracked registers of one device.
+    """
+    def __init__(self, alias, serial_no, owner, **options):
+        self.alias = alias
+        self.serial_no = serial_no
+        self.owner = owner
+        self.registers = {register: Running(1 / sf8.scale.get(register, 1),
+                                            **options)
+                          for register in TRACKED}
+
+
+    def update(self, register, value):
+        """
+        Called by SF8xxx for every measurement it reads
+        """
+        t0 = time.perf_counter()
+        running = self.registers.get(register)
+        if running is None:
+            return
+
+        kind = running.update(value)
+        owner = self.owner
+        owner.updates += 1
+        if kind is not None:
+            baseline, sigma = running.base_mean, running.sigma
+            running.rebase()
+            owner.event({'alias': self.alias, 'serial_no': self.serial_no,
+                         'register': register, 'kind': kind, 'value': value,
+                         'baseline': baseline, 'sigma': sigma,
+                         'time': time.time()})
+        owner.update_time += time.perf_counter() - t0
+
+
+    def reset(self):
+        for running in self.registers.values():
+            running.reset()
+
+
+class Stats:
+    """
+    Statistics of every attached device.
+    """
+    def __init__(self, **options):
+        self.options = options      # Running parameters
+        self.devices = {}           # alias -> DeviceStats
+        self.listeners = []         # fn(event)
+        self.events = collections.deque(maxlen=100)
+        self.updates = 0
+        self.update_time = 0.0      # s
+        self.__lock = threading.Lock()
+
+
+    def attach(self, alias, device):
+        stats = DeviceStats(alias, device.serial_no, self, **self.options)
+        self.devices[alias] = stats
+        device.stats = stats
+
+
+    def detach(self, alias, device=None):
+        self.devices.pop(alias, None)
+        if device is not None:
+            device.stats = None
+
+
+    def reset(self, alias=None):
+        """
+        Forget the statistics and baseline, e.g. after a setpoint change
+        """
+        for a, stats in list(self.devices.items()):
+            if alias is None or a == alias:
+                stats.reset()
+
+
+    def event(self, event):
+        with self.__lock:
+            self.events.append(event)
+        for listener in self.listeners:
+            listener(event)
+
+
+    def cost(self):
+        """
+        Mean time per update, ns
+        """
+        return self.update_time / self.updates * 1e9 if self.updates else 0.0
+
+
+    def summary(self, alias):
+        return {register: running.summary() for register, running in
+                self.devices[alias].registers.items()}
@@ -1,51 +1,104 @@
 import threading
 import time
 
+import SF8xxx as sf8
+
+# read per device at TELEMETRY priority, or with coherent all at the same
+# moment (SF8xxx.coherent_sample; a busy port sits a sweep out)
+REGISTERS = ('DRIVER_STATE', 'DRIVER_CURRENT_MEASURED', 'TEC_STATE',
+             'TEC_CURRENT_MEASURED')
+
 class Status:
-  def __init__(self, devices, fn="/tmp/sf8_status"):
+  def __init__(self, devices, fn="/tmp/sf8_status", coherent=False):
     self.devices = devices  # a dict of the connected device objects
     self.filename = fn
     self.end_threads = False
     self.interval = 1
+    self.run_thread = None
+    self.coherent = coherent  # one barrier sweep per pass, see REGISTERS
+    self.skew = None  # s, last coherent sweep
 
 
   def __del__(self):
     self.end_threads = True
-    self.run_thread.join()
+    if self.run_thread is not None:
+      self.run_thread.join()
+
 
-  
   def __run(self):
     while not self.end_threads:
-      f = open(self.filename, "w")
-      f.write(__str_status_header())
-      for dev in self.devices.values():
-        f.write(__str_status_line(dev))
+      if self.coherent:
+        lines = self.__coherent_lines()
+      else:
+        lines = [_str_status_header()]
+        for dev in list(self.devices.values()):
+          if getattr(dev, 'connected', False):
+            lines.append(_str_status_line(dev))
+
+      with open(self.filename, "w") as f:
+        f.write(''.join(lines))
       time.sleep(self.interval)
-      
-    self.run_thread.join()
+
+
+  def __coherent_lines(self):
+    devices = dict(self.devices)
+    # port workers publish their own readings
+    local = {alias: dev for alias, dev in devices.items()
+             if not hasattr(dev, 'reading')}
+    report, self.skew = sf8.coherent_sample(local, REGISTERS, sf8.TELEMETRY)
+
+    lines = [_str_status_header()]
+    for alias, dev in devices.items():
+      if not getattr(dev, 'connected', False):
+        continue
+      if alias in report:
+        values = {p: v for p, (v, t_send, t_recv) in report[alias].items()}
+        good = values['DRIVER_STATE'] is not None  # else left out
+        lines.append(_str_values_line(dev.serial_no, good, values))
+      else:
+        lines.append(_str_status_line(dev))
+    if len(report) > 1:
+      lines.append("skew %.1f ms\n" % (self.skew * 1e3))
+    return lines
 
 
   def run(self):
-    self.run_thread = threading.Thread(target=self.__run,
-                                        args=(,))
+    self.run_thread = threading.Thread(target=self.__run, daemon=True)
     self.run_thread.start()
-    
 
-def __str_status_header():
+
+def _str_status_header():
   return "ser_no\tConnection\tDriver\tCurrent (mA)\tTec\tCurrent (A)\n"
 
 
-def __str_status_line(device):
-  serial_no = device.serial_no
-  is_connected = device.connected
-  is_driver_on = device.driver_on()
-  is_tec_on = device.tec_on()
-  dri_cur = device.get_driver_current()
-  tec_cur = device.get_tec_current()
-
-  return str(serial_no) + 
-        "\tGOOD" if is_connected else "\tBAD" +
-        "\tON\t" if is_driver_on else "\tOFF\t" + 
-        str(dri_cur) +
-        "\tON\t" if is_tec_on else "\tOFF\t" +
-        str(tec_cur) + "\n"
+def _str_status_line(device):
+  if hasattr(device, 'reading'):
+    # port worker: latest published reading, no serial I/O
+    return _str_reading_line(device.reading())
+
+  with device.priority(sf8.TELEMETRY):
+    values = device.sample(REGISTERS)
+
+  return _str_values_line(device.serial_no, device.connected, values)
+
+
+def _str_reading_line(reading):
+  if reading is None:
+    return "?\tBAD\n"
+
+  stale = time.time() - reading['timestamp'] > 10
+  return _str_values_line(reading['serial_no'],
+                          reading['connected'] and not stale, reading)
+
+
+def _str_values_line(serial_no, good, values):
+  driver = values['DRIVER_STATE']
+  tec = values['TEC_STATE']
+
+  return str(serial_no) + \
+        ("\tGOOD" if good else "\tBAD") + \
+        ("\tON\t" if driver and sf8.decode_driver_state(driver)[1]
+         else "\tOFF\t") + \
+        str(values['DRIVER_CURRENT_MEASURED']) + \
+        ("\tON\t" if tec and sf8.decode_tec_state(tec)[0] else "\tOFF\t") + \
+        str(values['TEC_CURRENT_MEASURED']) + "\n"
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only binary telemetry log
+
+Writer: batches polled samples and appends them as fixed-size records
+Reader: memory-maps a log for time-range queries and downsampled export
+
+Data file: 8-byte header (magic b'SF8L', version u16, record size u16),
+then 36-byte little-endian records in time order (the writer never lets a
+timestamp go backwards, see Writer.append):
+    timestamp f64 (Unix time), serial_no u32,
+    driver current (mA), driver setpoint (mA), TEC temperature (C),
+    TEC current (A) as f32 (NaN = failed read),
+    DRIVER_STATE, TEC_STATE, LOCK_STATE as u16, 2 pad bytes
+
+Index file (<log>.idx): (timestamp f64, record number u64) for every
+INDEX_EVERY-th record, so a query only touches the blocks it needs.
+
+python Telemetry.py [log] [--from t] [--to t] [--every s] [--csv file]
+
+@author: drm1g20
+"""
+
+import bisect
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+MAGIC = b'SF8L'
+HEADER = struct.Struct('<4sHH')
+RECORD = struct.Struct('<dI4f3H2x')
+INDEX = struct.Struct('<dQ')
+INDEX_EVERY = 256
+
+# registers in record order
+REGISTERS = ('DRIVER_CURRENT_MEASURED', 'DRIVER_CURRENT_VALUE',
+             'TEC_TEMPERATURE_MEASURED', 'TEC_CURRENT_MEASURED',
+             'DRIVER_STATE', 'TEC_STATE', 'LOCK_STATE')
+VALUES = REGISTERS[:4]
+STATES = REGISTERS[4:]
+
+FIELDS = ('timestamp', 'serial_no') + REGISTERS
+
+
+class Writer:
+    """
+    Appends samples to a log, one write() per batch. An existing log must
+    have a matching header; a partial record or index entry left by a crash
+    is cut off before appending.
+    """
+    def __init__(self, filename, flush_every=64, flush_interval=5):
+        self.filename = filename
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.__lock = threading.Lock()
+        self.__buffer = bytearray()
+        self.__pending = 0
+        self.__last_flush = time.monotonic()
+        self.writes = 0  # write() calls, data and index
+        self.last_timestamp = -math.inf
+
+        self.fd = os.open(filename, os.O_RDWR | os.O_APPEND | os.O_CREAT,
+                          0o644)
+        try:
+            self.records = self.__open_data()
+            self.index_fd = os.open(filename + '.idx',
+                                    os.O_RDWR | os.O_APPEND | os.O_CREAT,
+                                    0o644)
+        except (OSError, ValueError):
+            os.close(self.fd)
+            raise
+        self.__open_index()
+        self.__index = bytearray()
+
+
+    def __open_data(self):
+        """
+        Check the header (or write it), cut a partial last record ->
+        records in the log
+        """
+        size = os.fstat(self.fd).st_size
+        if size == 0:
+            os.write(self.fd, HEADER.pack(MAGIC, 1, RECORD.size))
+            return 0
+
+        header = os.pread(self.fd, HEADER.size, 0)
+        if len(header) < HEADER.size or \
+                HEADER.unpack(header)[::2] != (MAGIC, RECORD.size):
+            raise ValueError("Not an SF8xxx telemetry log: " + self.filename)
+
+        records = (size - HEADER.size) // RECORD.size
+        whole = HEADER.size + records * RECORD.size
+        if size != whole:
+            os.ftruncate(self.fd, whole)
+        if records:
+            self.last_timestamp = struct.unpack(
+                '<d', os.pread(self.fd, 8, whole - RECORD.size))[0]
+        return records
+
+
+    def __open_index(self):
+        """
+        Keep only whole index entries for records that made it to the log
+        """
+        raw = os.pread(self.index_fd, os.fstat(self.index_fd).st_size, 0)
+        entries = len(raw) // INDEX.size
+        while entries and \
+                INDEX.unpack_from(raw, (entries - 1) * INDEX.size)[1] \
+                >= self.records:
+            entries -= 1
+        if entries * INDEX.size != len(raw):
+            os.ftruncate(self.index_fd, entries * INDEX.size)
+
+
+    def append(self, serial_no, sample, timestamp=None):
+        """
+        sample: dict as returned by SF8xxx.sample (missing keys are NaN/0).
+        A timestamp older than the last one appended (a port worker's
+        reading published before another's, the clock stepping back) is
+        stored as that one, so the log stays in time order for Reader.find
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        values = []
+        for parameter in VALUES:
+            value = sample.get(parameter)
+            values.append(math.nan if value is None else value)
+        for parameter in STATES:
+            value = sample.get(parameter)
+            values.append(int(value, 16) if value else 0)
+
+        with self.__lock:
+            timestamp = max(timestamp, self.last_timestamp)
+            self.last_timestamp = timestamp
+            number = self.records + self.__pending
+            if number % INDEX_EVERY == 0:
+                self.__index += INDEX.pack(timestamp, number)
+            self.__buffer += RECORD.pack(timestamp, serial_no or 0, *values)
+            self.__pending += 1
+
+            if self.__pending >= self.flush_every or \
+                    time.monotonic() - self.__last_flush > self.flush_interval:
+                self.__flush()
+
+
+    def __flush(self):
+        if self.__buffer:
+            os.write(self.fd, self.__buffer)
+            self.writes += 1
+        if self.__index:
+            os.write(self.index_fd, self.__index)
+            self.writes += 1
+        self.records += self.__pending
+        self.__buffer = bytearray()
+        self.__index = bytearray()
+        self.__pending = 0
+        self.__last_flush = time.monotonic()
+
+
+    def flush(self):
+        with self.__lock:
+            self.__flush()
+
+
+    def close(self):
+        with self.__lock:
+            if self.fd is None:
+                return
+            self.__flush()
+            os.close(self.fd)
+            os.close(self.index_fd)
+            self.fd = None
+
+
+    def listener(self, alias, device, sample):
+        """
+        For Safety.RuleEngine.listeners
+        """
+        self.append(device.serial_no, sample)
+
+
+class Reader:
+    """
+    Memory-mapped view of a log. Nothing is read until it is queried.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.__data = None
+        self.refresh()
+
+
+    def refresh(self):
+        """
+        Map records appended since opening
+        """
+        self.close()
+        with open(self.filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            magic, version, record_size = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or record_size != RECORD.size:
+                raise ValueError("Not an SF8xxx telemetry log: "
+                                 + self.filename)
+            self.records = (size - HEADER.size) // RECORD.size
+            self.__data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if self.records else None
+
+        self.index = []  # (timestamp, record number)
+        try:
+            with open(self.filename + '.idx', 'rb') as f:
+                raw = f.read()
+            self.index = [entry for entry in INDEX.iter_unpack(
+                raw[:len(raw) - len(raw) % INDEX.size])
+                if entry[1] < self.records]
+        except OSError:
+            pass
+        self.__index_times = [t for t, n in self.index]
+
+
+    def close(self):
+        if self.__data is not None:
+            self.__data.close()
+            self.__data = None
+
+
+    def __len__(self):
+        return self.records
+
+
+    def __timestamp(self, n):
+        return struct.unpack_from('<d', self.__data,
+                                  HEADER.size + n * RECORD.size)[0]
+
+
+    def record(self, n):
+        return RECORD.unpack_from(self.__data, HEADER.size + n * RECORD.size)
+
+
+    def find(self, t):
+        """
+        Number of the first record at or after t
+        """
+        if not self.records:
+            return 0
+
+        lo, hi = 0, self.records
+        if self.index:
+            block = bisect.bisect_left(self.__index_times, t) - 1
+            if block >= 0:
+                lo = self.index[block][1]
+            if block + 1 < len(self.index):
+                hi = self.index[block + 1][1]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__timestamp(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+    def range(self, t0=None, t1=None):
+        """
+        Record numbers [first, last) with t0 <= timestamp < t1
+        """
+        first = 0 if t0 is None else self.find(t0)
+        last = self.records if t1 is None else self.find(t1)
+        return first, max(first, last)
+
+
+    def query(self, t0=None, t1=None, serial_no=None):
+        """
+        Yield records as tuples in FIELDS order
+        """
+        first, last = self.range(t0, t1)
+        for n in range(first, last):
+            record = self.record(n)
+            if serial_no is None or record[1] == serial_no:
+                yield record
+
+
+    def downsample(self, every, t0=None, t1=None, serial_no=None):
+        """
+        Yield one row per device per `every` seconds: bucket start time,
+        serial_no, the mean of each value and the last of each state
+        """
+        buckets = {}
+        current = None
+        for record in self.query(t0, t1, serial_no):
+            bucket = record[0] - record[0] % every
+            if bucket != current:
+                yield from self.__emit(buckets)
+                buckets = {}
+                current = bucket
+
+            acc = buckets.setdefault(record[1],
+                                     [bucket, [0.0] * 4, [0] * 4, None])
+            for i, value in enumerate(record[2:6]):
+                if not math.isnan(value):
+                    acc[1][i] += value
+                    acc[2][i] += 1
+            acc[3] = record[6:9]
+
+        yield from self.__emit(buckets)
+
+
+    def __emit(self, buckets):
+        for serial_no, (bucket, sums, counts, states) in sorted(
+                buckets.items()):
+            means = [s / c if c else math.nan for s, c in zip(sums, counts)]
+            yield (bucket, serial_no) + tuple(means) + tuple(states)
+
+
+    def export_csv(self, filename, t0=None, t1=None, every=None,
+                   serial_no=None):
+        rows = self.query(t0, t1, serial_no) if every is None \
+            else self.downsample(every, t0, t1, serial_no)
+        with open(filename, 'w') as f:
+            f.write(','.join(FIELDS) + '\n')
+            for row in rows:
+                f.write('%.3f,%d,%g,%g,%g,%g,%04X,%04X,%04X\n' % row)
+
+
+    def to_numpy(self, t0=None, t1=None):
+        """
+        Structured array over the mapped records (no copy)
+        """
+        import numpy as np
+
+        dtype = np.dtype({'names': FIELDS,
+                          'formats': ['<f8', '<u4'] + ['<f4'] * 4
+                                     + ['<u2'] * 3,
+                          'offsets': [0, 8, 12, 16, 20, 24, 28, 30, 32],
+                          'itemsize': RECORD.size})
+        first, last = self.range(t0, t1)
+        if last == first:
+            return np.zeros(0, dtype=dtype)
+
+        return np.frombuffer(self.__data, dtype=dtype, count=last - first,
+                             offset=HEADER.size + first * RECORD.size)
+
+
+class Recorder:
+    """
+    Logs the shared memory readings of isolated port workers, which run
+    their own rule engines out of reach of the console's listeners.
+    """
+    def __init__(self, devices, writer, interval=2):
+        self.devices = devices
+        self.writer = writer
+        self.interval = interval
+        self.end_threads = False
+        self.__last = {}
+
+
+    def poll(self):
+        readings = []
+        for alias, dev in list(self.devices.items()):
+            if not getattr(dev, 'isolated', False):
+                continue
+            reading = dev.reading()
+            if reading is None or not reading['timestamp'] or \
+                    self.__last.get(alias) == reading['timestamp']:
+                continue
+            self.__last[alias] = reading['timestamp']
+            readings.append(reading)
+
+        # each worker stamps its own readings: append them in time order
+        for reading in sorted(readings, key=lambda r: r['timestamp']):
+            sample = {p: reading[p] for p in REGISTERS}
+            self.writer.append(reading['serial_no'], sample,
+                               reading['timestamp'])
+
+
+    def run(self):
+        while not self.end_threads:
+            self.poll()
+            time.sleep(self.interval)
+
+
+    def start(self):
+        self.run_thread = threading.Thread(target=self.run, daemon=True)
+        self.run_thread.start()
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query a telemetry log")
+    parser.add_argument('log')
+    parser.add_argument('--from', dest='t0', type=float)
+    parser.add_argument('--to', dest='t1', type=float)
+    parser.add_argument('--every', type=float, help="downsample, seconds")
+    parser.add_argument('--serial', type=int)
+    parser.add_argument('--csv', help="export to this file")
+    args = parser.parse_args(argv)
+
+    reader = Reader(args.log)
+    if args.csv:
+        reader.export_csv(args.csv, args.t0, args.t1, args.every, args.serial)
+        return
+
+    first, last = reader.range(args.t0, args.t1)
+    print(len(reader), "records,", last - first, "in range")
+    if last > first:
+        print("from", time.ctime(reader.record(first)[0]),
+              "to", time.ctime(reader.record(last - 1)[0]))
+    reader.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,549 @@
+# -*- coding: utf-8 -*-
+"""
+Process-per-port execution
+
+StateTable: fixed-layout shared memory table of the latest reading per port
+RemoteSF8xxx: stands in for SF8xxx, forwarding calls to a worker process
+serve: worker process main, owns one SF8xxx and its safety rule engine
+
+A wedged serial adapter only blocks its own worker. The console, Status
+writer and external readers read the table without locks or serial I/O.
+
+Each controller creates its own table, sf8_state_<pid>, and only it unlinks
+it. Header (little endian, 20 bytes): magic b'SF8T', version u32, slots
+u32, record size u32, owner pid i32.
+
+Record layout (little endian, 88 bytes, slot i at 20 + 88 * i):
+    seq u32, pid i32, serial_no i32, flags u32, timestamp f64,
+    driver current (mA), driver setpoint (mA), TEC temperature (C),
+    TEC current (A) as f64 (NaN = failed read),
+    DRIVER_STATE, TEC_STATE, LOCK_STATE raw 4 bytes each, alias 16 bytes
+
+seq is odd while a record is being written; readers retry until they see
+the same even value either side of a copy.
+
+@author: drm1g20
+"""
+
+import math
+import multiprocessing as mp
+import os
+import struct
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import SF8xxx as sf8
+import Safety
+
+TABLE_NAME = 'sf8_state'  # + '_' + the owner's pid
+SLOTS = 32
+
+MAGIC = b'SF8T'
+VERSION = 2
+HEADER = struct.Struct('<4sIIIi')  # magic, version, slots, record size, pid
+RECORD = struct.Struct('<IiiId4d4s4s4s16s4x')
+SEQ = struct.Struct('<I')
+
+FLAG_USED = 0x1
+FLAG_CONNECTED = 0x2
+
+# registers published per record, in record order
+REGISTERS = ('DRIVER_CURRENT_MEASURED', 'DRIVER_CURRENT_VALUE',
+             'TEC_TEMPERATURE_MEASURED', 'TEC_CURRENT_MEASURED',
+             'DRIVER_STATE', 'TEC_STATE', 'LOCK_STATE')
+
+FIELDS = ('pid', 'serial_no', 'flags', 'timestamp') + REGISTERS + ('alias',)
+
+
+class PortTimeout(Exception):
+    """
+    A port worker did not answer in time.
+    """
+
+
+class StateTable:
+    """
+    Shared memory table of per-port readings.
+    """
+    def __init__(self, name=None, slots=SLOTS, create=True):
+        """
+        name: default sf8_state_<our pid> when creating. A table of that
+        name whose owner is still running is not replaced (FileExistsError)
+        """
+        if name is None:
+            name = TABLE_NAME + '_' + str(os.getpid())
+        self.name = name
+        self.created = False  # only the creator unlinks
+        self.allocated = {}  # alias -> slot, owner side only
+
+        if create:
+            size = HEADER.size + slots * RECORD.size
+            try:
+                self.shm = shared_memory.SharedMemory(name, create=True,
+                                                      size=size)
+            except FileExistsError:
+                owner = _owner(name)
+                if owner is not None:
+                    raise FileExistsError("State table " + name
+                                          + " in use by pid " + str(owner))
+                # left behind by a controller that did not exit cleanly
+                stale = shared_memory.SharedMemory(name)
+                stale.close()
+                stale.unlink()
+                self.shm = shared_memory.SharedMemory(name, create=True,
+                                                      size=size)
+            self.created = True
+            self.shm.buf[:size] = bytes(size)
+            HEADER.pack_into(self.shm.buf, 0, MAGIC, VERSION, slots,
+                             RECORD.size, os.getpid())
+        else:
+            self.shm = shared_memory.SharedMemory(name)
+
+        magic, version, self.slots, size, self.owner = \
+            HEADER.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            self.shm.close()
+            raise ValueError("Not an SF8xxx state table: " + name)
+
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Read-only access from an unrelated process
+        """
+        table = cls(name, create=False)
+        # otherwise our resource tracker unlinks the table when we exit
+        resource_tracker.unregister(table.shm._name, 'shared_memory')
+        return table
+
+
+    def allocate(self, alias):
+        if alias in self.allocated:
+            return self.allocated[alias]
+
+        used = set(self.allocated.values())
+        for slot in range(self.slots):
+            if slot not in used:
+                self.allocated[alias] = slot
+                return slot
+
+        raise ValueError("State table full")
+
+
+    def release(self, alias):
+        slot = self.allocated.pop(alias, None)
+        if slot is not None:
+            self.clear(slot)
+
+
+    def __offset(self, slot):
+        return HEADER.size + slot * RECORD.size
+
+
+    def __begin(self, offset):
+        """
+        Mark a record as being written, return the odd sequence number.
+        A writer killed mid-write leaves it odd; carry on from there.
+        """
+        seq = SEQ.unpack_from(self.shm.buf, offset)[0]
+        odd = (seq | 1) if not seq & 1 else seq
+        SEQ.pack_into(self.shm.buf, offset, odd)
+        return odd
+
+
+    def write(self, slot, alias, pid, serial_no, connected, sample):
+        """
+        Publish a sample (dict as returned by SF8xxx.sample)
+        """
+        buf = self.shm.buf
+        offset = self.__offset(slot)
+
+        values = []
+        for parameter in REGISTERS:
+            value = sample.get(parameter)
+            if parameter in sf8.state_registers:
+                values.append(bytes(value) if value is not None else b'')
+            else:
+                values.append(math.nan if value is None else value)
+
+        flags = FLAG_USED | (FLAG_CONNECTED if connected else 0)
+        seq = self.__begin(offset)
+        RECORD.pack_into(buf, offset, seq, pid, serial_no or 0, flags,
+                         time.time(), *values,
+                         alias.encode('ascii', 'replace')[:16])
+        SEQ.pack_into(buf, offset, (seq + 1) & 0xFFFFFFFF)
+
+
+    def clear(self, slot):
+        buf = self.shm.buf
+        offset = self.__offset(slot)
+        seq = self.__begin(offset)
+        buf[offset + SEQ.size:offset + RECORD.size] = \
+            bytes(RECORD.size - SEQ.size)
+        SEQ.pack_into(buf, offset, (seq + 1) & 0xFFFFFFFF)
+
+
+    def read(self, slot):
+        """
+        Return a consistent copy of a record as a dict, None if unused
+        """
+        buf = self.shm.buf
+        offset = self.__offset(slot)
+        for attempt in range(1000):
+            before = SEQ.unpack_from(buf, offset)[0]
+            if before & 1:
+                continue
+            record = RECORD.unpack_from(buf, offset)
+            if SEQ.unpack_from(buf, offset)[0] == before:
+                break
+        else:
+            return None  # writer died mid-record
+
+        if not record[3] & FLAG_USED:
+            return None
+
+        reading = dict(zip(FIELDS, record[1:]))
+        reading['alias'] = reading['alias'].rstrip(b'\x00').decode('ascii')
+        for parameter in REGISTERS:
+            if parameter in sf8.state_registers:
+                if reading[parameter] == bytes(4):
+                    reading[parameter] = None
+            elif math.isnan(reading[parameter]):
+                reading[parameter] = None
+        reading['connected'] = bool(reading['flags'] & FLAG_CONNECTED)
+
+        return reading
+
+
+    def read_all(self):
+        readings = (self.read(slot) for slot in range(self.slots))
+        return [r for r in readings if r is not None]
+
+
+    def close(self):
+        self.shm.close()
+
+
+    def unlink(self):
+        """
+        Close, and remove the table if this instance created it
+        """
+        self.shm.close()
+        if self.created:
+            self.shm.unlink()
+            self.created = False
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # someone else's
+        return True
+    return True
+
+
+def _owner(name):
+    """
+    pid of the running process that created table name, else None
+    """
+    try:
+        shm = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return None
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        if shm.size < HEADER.size:
+            return None
+        magic, version, slots, size, pid = HEADER.unpack_from(shm.buf, 0)
+    finally:
+        shm.close()
+    if magic != MAGIC or version != VERSION or pid <= 0 or not _alive(pid):
+        return None
+    return pid
+
+
+def tables():
+    """
+    Names of the state tables of running controllers (Linux: /dev/shm)
+    """
+    try:
+        names = sorted(os.listdir('/dev/shm'))
+    except OSError:
+        return []
+    return [name for name in names if name.startswith(TABLE_NAME + '_')
+            and _owner(name) is not None]
+
+
+def _device_state(dev):
+    return (dev.connected, dev.serial_no, getattr(dev, 'driver_off', True),
+            getattr(dev, 'tec_off', True), getattr(dev, 'temperature', None))
+
+
+def serve(port, alias, slot, table_name, rules, interval, conn):
+    """
+    Worker process main. Requests are (id, method, args), replies are
+    (id, ok, result, device state).
+    """
+    table = StateTable(table_name, create=False)
+    dev = sf8.SF8xxx(port, watchdog=False)
+    conn.send((0, True, None, _device_state(dev)))
+
+    if not dev.connected:
+        table.write(slot, alias, os.getpid(), None, False, {})
+        return
+
+    def publish(alias, device, sample):
+        table.write(slot, alias, os.getpid(), device.serial_no, True, sample)
+
+    engine = Safety.RuleEngine({alias: dev}, Safety.load_rules(rules),
+                               interval=interval)
+    engine.require(REGISTERS)
+    engine.listeners.append(publish)
+    engine.start()
+
+    while True:
+        try:
+            ident, name, args = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        if name == 'close':
+            break
+
+        try:
+            if name == 'load_rules':
+                engine.set_rules(Safety.load_rules(*args))
+                result = None
+            elif name == 'rule_stats':
+                result = engine.stats()
+            elif name.startswith('_'):
+                raise AttributeError(name)
+            else:
+                result = getattr(dev, name)(*args)
+            reply = (ident, True, result, _device_state(dev))
+        except Exception as e:
+            reply = (ident, False, repr(e), _device_state(dev))
+
+        try:
+            conn.send(reply)
+        except (BrokenPipeError, OSError):
+            break
+
+    engine.end_threads = True
+    dev.close()
+    table.close()
+    sys.exit(0)
+
+
+class RemoteSF8xxx:
+    """
+    SF8xxx served by its own worker process. Methods not defined here are
+    forwarded to the SF8xxx in the worker; PortTimeout if it does not reply.
+    """
+    isolated = True
+
+    def __init__(self, port, alias, table, rules, interval=2, timeout=2):
+        self.port = port
+        self.alias = alias
+        self.table = table
+        self.rules = rules
+        self.interval = interval
+        self.timeout = timeout
+        self.startup_timeout = 10
+        self.connected = False
+        self.serial_no = None
+        self.driver_off = True
+        self.tec_off = True
+        self.temperature = None
+        self.process = None
+        self.slot = None
+        self.__lock = threading.Lock()
+        self.__ident = 0
+        self.slot = table.allocate(alias)
+
+        self.__start()
+
+
+    def __start(self):
+        ctx = mp.get_context('spawn')
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=serve, name='sf8-' + self.alias,
+                                   args=(self.port, self.alias, self.slot,
+                                         self.table.name, self.rules,
+                                         self.interval, child),
+                                   daemon=True)
+        self.process.start()
+        child.close()
+
+        if not self.conn.poll(self.startup_timeout):
+            self.kill()
+            return
+
+        try:
+            state = self.conn.recv()[3]
+        except (EOFError, OSError):
+            # poll() is also true at EOF: the worker died before reporting
+            self.kill()
+            return
+        self.__update(state)
+
+
+    def __update(self, state):
+        self.connected, self.serial_no, self.driver_off, self.tec_off, \
+            self.temperature = state
+
+
+    def __call(self, name, *args):
+        if not self.__lock.acquire(timeout=self.timeout):
+            raise PortTimeout(self.alias)
+
+        try:
+            self.__ident += 1
+            ident = self.__ident
+            try:
+                self.conn.send((ident, name, args))
+            except (BrokenPipeError, OSError):
+                raise PortTimeout(self.alias)
+
+            deadline = time.monotonic() + self.timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.conn.poll(remaining):
+                    raise PortTimeout(self.alias)
+
+                try:
+                    reply, ok, result, state = self.conn.recv()
+                except (EOFError, OSError):
+                    raise PortTimeout(self.alias)
+
+                if reply == ident:  # drop replies to calls that timed out
+                    break
+        finally:
+            self.__lock.release()
+
+        self.__update(state)
+        if not ok:
+            raise RuntimeError(self.alias + ": " + result)
+
+        return result
+
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        return lambda *args: self.__call(name, *args)
+
+
+    # runs here, one remote sample() per read, so it can be cancelled and
+    # each call stays well inside the reply timeout
+    wait_until_settled = sf8.SF8xxx.wait_until_settled
+
+
+    def load_rules(self, filename):
+        self.rules = filename
+        return self.__call('load_rules', filename)
+
+
+    def reading(self):
+        """
+        Latest published reading, no I/O
+        """
+        if self.slot is None:  # closed
+            return None
+        return self.table.read(self.slot)
+
+
+    def age(self):
+        """
+        Seconds since the worker last published, None before the first
+        """
+        reading = self.reading()
+        if reading is None or not reading['timestamp']:
+            return None
+
+        return time.time() - reading['timestamp']
+
+
+    def responsive(self):
+        age = self.age()
+        return self.process is not None and self.process.is_alive() and \
+            (age is None or age < 3 * self.interval + self.timeout)
+
+
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.join(1)
+        self.connected = False
+        if self.slot is not None:
+            self.table.clear(self.slot)
+
+
+    def restart(self):
+        self.kill()
+        with self.__lock:
+            self.conn.close()
+            self.__start()
+
+
+    def close(self):
+        """
+        Stop the worker, which closes the port, and free the table slot.
+        Attributes are looked up in __dict__: on an object __init__ did not
+        finish, missing ones would resolve to forwarding lambdas
+        """
+        process = self.__dict__.get('process')
+        if process is not None:
+            if process.is_alive():
+                try:
+                    self.conn.send((0, 'close', ()))
+                except (BrokenPipeError, OSError):
+                    pass
+                process.join(self.timeout)
+            if process.is_alive():
+                self.kill()
+
+            self.conn.close()
+            try:
+                process.close()
+            except ValueError:  # would not die
+                pass
+            self.process = None
+        self.connected = False
+
+        slot = self.__dict__.get('slot')
+        if slot is not None:
+            # only if the alias has not been given a new slot since
+            if self.table.allocated.get(self.alias) == slot:
+                self.table.release(self.alias)
+            self.slot = None
+
+
+    def __del__(self):
+        self.close()
+
+
+def print_table(name):
+    table = StateTable.attach(name)
+    print(name, "(pid " + str(table.owner) + ")")
+    for r in table.read_all():
+        print(r['alias'], r['serial_no'],
+              "GOOD" if r['connected'] else "BAD",
+              "%.1f s ago" % (time.time() - r['timestamp']),
+              r['DRIVER_CURRENT_MEASURED'], "mA",
+              r['TEC_TEMPERATURE_MEASURED'], "C",
+              r['TEC_CURRENT_MEASURED'], "A")
+    table.close()
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or tables()
+    if not names:
+        print("No running controller tables")
+    for name in names:
+        print_table(name)